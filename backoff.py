@@ -0,0 +1,29 @@
+#           Capped exponential backoff with jitter
+#
+#           This module does not depend on Domoticz. The delay before the n-th
+#           retry is drawn between (1 - jitter) and 1 times min(maximum,
+#           initial * factor**n), so clients which lost the same broker at the
+#           same moment spread out instead of reconnecting in lockstep.
+#
+import random
+
+class Backoff:
+    __slots__ = ('initial', 'maximum', 'factor', 'jitter', 'attempts', 'rng')
+
+    def __init__(self, initial=1.0, maximum=300.0, factor=2.0, jitter=0.5, rng=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0       # Failed attempts since the last reset
+        self.rng = rng or random.Random()
+
+    # Returns the delay before the next attempt and counts an attempt
+    def next(self):
+        delay = min(self.maximum, self.initial * self.factor ** min(self.attempts, 64))
+        self.attempts += 1
+        return delay * (1.0 - self.jitter * self.rng.random())
+
+    # Called after a successful attempt
+    def reset(self):
+        self.attempts = 0
@@ -0,0 +1,7 @@
+#           Benchmarks for the Kamstrup plugin
+#
+#           Usage:
+#             python -m benchmarks                          run all cases
+#             python -m benchmarks --save baseline.json     save results as baseline
+#             python -m benchmarks --compare baseline.json  fail on regressions
+#
@@ -0,0 +1,44 @@
+#           python -m benchmarks [--save baseline.json] [--compare baseline.json]
+#
+import argparse
+import json
+import sys
+
+from benchmarks import runner
+from benchmarks.cases import CASES
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Kamstrup plugin benchmarks')
+    parser.add_argument('cases', nargs='*', help='only run cases whose name contains one of these strings')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per timing run (default 0.2)')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare with a JSON baseline, exit 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown or allocation growth (default 0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, setup in CASES:
+            print(name)
+        return 0
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = runner.run(CASES, args.cases, args.min_time)
+    if args.save:
+        runner.save(args.save, results)
+
+    if baseline is not None:
+        regressions = runner.compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+        print('No regressions')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
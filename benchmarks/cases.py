@@ -0,0 +1,163 @@
+#           Benchmark cases
+#
+#           Each case is (name, setup), setup prepares the case and returns a
+#           function performing one operation.
+#
+import json
+import os
+
+from capture import bulk
+import kmp
+import recording
+from simulator import domoticz
+from simulator.harness import Harness
+
+# GetRegister and GetType responses recorded from the simulated MC402
+RESPONSES = {
+    'power': '403F100050160441000000A924830D',
+    'power_energy': '403F100050160441000000A9003C0304430001283E17F70D',
+    'eight_registers': '403F10003C0304430001283E00442804420002507D004A290400000002D90050160441000000A9005625044200001EA7005725044200001BF2F80059250442000010AF03EA2F040000005DC0CC890D',
+    'type': '403F01110100010ADC0D',
+}
+
+FRAME_SIZES = (8, 32, 128)
+
+class NullClient:
+    def Publish(self, topic, payload, retain = 0):
+        pass
+
+    def Subscribe(self, topics):
+        pass
+
+# Loads plugin.py against the fake Domoticz, without connecting to the broker
+def load_plugin(meters=0, options=None):
+    harness = Harness(meters=meters, options=options)
+    plugin = harness.load()
+    plugin._plugin.onStart()
+    plugin._plugin.mqttClient = NullClient()
+    return (harness, plugin._plugin)
+
+#######################################################################
+# Codec
+#
+def crc_case(fn, size):
+    def setup():
+        data = bytes(range(size))
+        return lambda: fn(data)
+    return setup
+
+def recv_case(name):
+    def setup():
+        (harness, plugin) = load_plugin()
+        s = RESPONSES[name]
+        return lambda: plugin.recv(s)
+    return setup
+
+def readvars_case(name):
+    def setup():
+        (harness, plugin) = load_plugin()
+        b = plugin.recv(RESPONSES[name])
+        return lambda: list(plugin.readvars(b))
+    return setup
+
+def readvars_fixed_case(name):
+    def setup():
+        (harness, plugin) = load_plugin()
+        b = plugin.recv(RESPONSES[name])
+        return lambda: list(kmp.read_registers_fixed(b))
+    return setup
+
+def readvar_case(name):
+    def setup():
+        (harness, plugin) = load_plugin()
+        b = plugin.recv(RESPONSES[name])
+        return lambda: plugin.readvar(b)
+    return setup
+
+# Bulk decoding of captured payloads, one operation decodes a chunk of
+# records of 10 meters
+def bulk_case(records, vectorized):
+    def setup():
+        names = ('power', 'power_energy', 'eight_registers')
+        chunk = [(float(i), 'tasmota/meter_%03d' % (i % 10), RESPONSES[names[i % 3]]) for i in range(records)]
+        return lambda: bulk.BulkDecoder(records, vectorized).decode_chunk(chunk)
+    return setup
+
+# Capture of a received SerialReceived message, buffered like in the plugin,
+# without the disk
+def record_case(name):
+    def setup():
+        recorder = recording.Recorder(os.devnull)
+        message = {'Verb': 'PUBLISH', 'Topic': 'tasmota/meter_000/tele/RESULT', 'QoS': 0, 'Retain': False,
+                   'Payload': json.dumps({'SerialReceived': RESPONSES[name]}).encode('utf8')}
+        return lambda: recorder.record(1500000000.0, recording.RECEIVED, message)
+    return setup
+
+def send_case(regs):
+    def setup():
+        (harness, plugin) = load_plugin()
+        msg = kmp.get_register_request(regs)
+        return lambda: plugin.send(kmp.START_REQUEST, msg, 'tasmota/meter/cmnd/serialsend4')
+    return setup
+
+#######################################################################
+# Dispatch
+#
+# Devices are created the way updateDeviceSettings does, the message is a
+# GetRegister response for the last device
+def dispatch_case(devices, role):
+    def setup():
+        (harness, plugin) = load_plugin()
+        for i in range(devices):
+            basetopic = 'tasmota/meter_%04d' % i
+            plugin.devicetopics.append(basetopic)
+            plugin.devicetopicSet.add(basetopic)
+            plugin.updateDeviceSettings('Meter', basetopic, 'kWh', 'kamstrup_402_heat')
+        if role == 'result_topic':
+            topic = basetopic + '/tele/RESULT'
+            payload = json.dumps({'SerialReceived': RESPONSES['power_energy']}).encode('utf8')
+        elif role == 'availability_topic':
+            topic = basetopic + '/tele/LWT'
+            payload = b'Online'
+        else:
+            topic = 'tasmota/unknown/tele/RESULT'
+            payload = json.dumps({'SerialReceived': RESPONSES['power']}).encode('utf8')
+        return lambda: plugin.onMQTTPublish(topic, payload)
+    return setup
+
+#######################################################################
+# Polling
+#
+# One operation is poll_seconds of simulated time with the plugin polling
+# simulated meters through the simulated broker
+def poll_case(meters, poll_seconds=10):
+    def setup():
+        harness = Harness(meters=meters)
+        harness.start()
+        harness.run(60) # Discover the meters and fill the pipeline
+        if len(domoticz.Devices) != meters:
+            raise RuntimeError('Discovered %d of %d meters' % (len(domoticz.Devices), meters))
+        return lambda: harness.run(poll_seconds)
+    return setup
+
+CASES = []
+for size in FRAME_SIZES:
+    CASES.append(('crc/crc_1021/%dB' % size, crc_case(kmp.crc_1021, size)))
+    CASES.append(('crc/crc16/%dB' % size, crc_case(kmp.crc16, size)))
+for name in ('power', 'power_energy', 'eight_registers'):
+    CASES.append(('recv/%s' % name, recv_case(name)))
+    CASES.append(('readvars/%s' % name, readvars_case(name)))
+    CASES.append(('readvars_fixed/%s' % name, readvars_fixed_case(name)))
+CASES.append(('readvar/power', readvar_case('power')))
+CASES.append(('record/eight_registers', record_case('eight_registers')))
+CASES.append(('bulk/scalar/1000_payloads', bulk_case(1000, False)))
+if bulk.numpy is not None:
+    CASES.append(('bulk/vectorized/1000_payloads', bulk_case(1000, True)))
+CASES.append(('send/1_register', send_case((0x50,))))
+CASES.append(('send/8_registers', send_case((0x3c, 0x44, 0x4a, 0x50, 0x56, 0x57, 0x59, 0x3ea))))
+for devices in (10, 100, 1000):
+    CASES.append(('dispatch/%d/result' % devices, dispatch_case(devices, 'result_topic')))
+    CASES.append(('dispatch/%d/availability' % devices, dispatch_case(devices, 'availability_topic')))
+    CASES.append(('dispatch/%d/unknown' % devices, dispatch_case(devices, 'unknown')))
+CASES.append(('poll/1_meter/10s', poll_case(1)))
+CASES.append(('poll/10_meters/10s', poll_case(10)))
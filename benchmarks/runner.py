@@ -0,0 +1,95 @@
+#           Measures operations per second and memory allocated per operation
+#
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+# Runs fn repeatedly. Returns the best ops/sec of repeats runs of at least
+# min_time seconds each.
+def measure_speed(fn, min_time=0.2, repeats=3):
+    # Calibrate the number of calls per run
+    n = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(n):
+            fn()
+        elapsed = time.perf_counter() - t
+        if elapsed >= min_time / 4:
+            break
+        n *= 4
+    n = max(1, int(n * min_time / max(elapsed, 1e-9)))
+
+    best = 0.0
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            t = time.perf_counter()
+            for _ in range(n):
+                fn()
+            elapsed = time.perf_counter() - t
+            best = max(best, n / elapsed)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+# Returns (allocated, retained) bytes per call: the peak traced memory above
+# the starting point during a call, and the memory kept after all calls
+def measure_allocations(fn, calls=200):
+    fn() # Warm up caches
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        peak = 0
+        for _ in range(calls):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn()
+            peak += tracemalloc.get_traced_memory()[1] - current
+        retained = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    return (peak / calls, retained / calls)
+
+def run(cases, select=None, min_time=0.2, out=sys.stdout):
+    results = {}
+    for name, setup in cases:
+        if select and not any(s in name for s in select):
+            continue
+        fn = setup()
+        ops = measure_speed(fn, min_time)
+        (allocated, retained) = measure_allocations(fn)
+        results[name] = {'ops_per_sec': round(ops, 1), 'alloc_bytes': round(allocated, 1), 'retained_bytes': round(retained, 1)}
+        out.write('%-40s %14.1f ops/s %10.1f B/op %8.1f B/op retained\n' % (name, ops, allocated, retained))
+        out.flush()
+    return results
+
+def save(path, results):
+    data = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+# Returns a list of regression descriptions. A case regresses if its speed
+# dropped, or its allocations grew, by more than threshold (0.2 = 20%).
+# Allocation changes below slack bytes are ignored.
+def compare(results, baseline, threshold, slack=64):
+    regressions = []
+    for name, base in baseline['results'].items():
+        if name not in results:
+            continue
+        result = results[name]
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - threshold):
+            regressions.append('%s: %.1f ops/s, baseline %.1f ops/s' % (name, result['ops_per_sec'], base['ops_per_sec']))
+        if result['alloc_bytes'] > base['alloc_bytes'] * (1 + threshold) + slack:
+            regressions.append('%s: %.1f B/op allocated, baseline %.1f B/op' % (name, result['alloc_bytes'], base['alloc_bytes']))
+    return regressions
@@ -0,0 +1,7 @@
+#           Offline analysis of captured meter traffic
+#
+#           Usage:
+#             python -m capture decode mqtt.kmqr                    decode SerialReceived payloads of a recording or log
+#             python -m capture decode domoticz.log --csv out.csv   write the decoded values as CSV
+#             python -m capture replay mqtt.kmqr [--speed 1]        feed a recording to the plugin in the simulator
+#
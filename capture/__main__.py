@@ -0,0 +1,78 @@
+#           python -m capture decode LOG [--csv FILE] [--chunk-size N] [--scalar]
+#           python -m capture replay RECORDING [--speed X] [--options JSON] [--topics T1,T2]
+#
+import argparse
+import csv
+import json
+import sys
+import time
+
+from capture import bulk, replay
+import recording
+
+def decode(args):
+    decoder = bulk.BulkDecoder(args.chunk_size, False if args.scalar else None)
+    writer = None
+    out = None
+    if args.csv:
+        out = open(args.csv, 'w', newline='')
+        writer = csv.writer(out)
+        writer.writerow(('timestamp', 'meter', 'register', 'value', 'unit'))
+    t = time.perf_counter()
+    values = 0
+
+    def decodeRecords(records):
+        n = 0
+        for columns in decoder.decode(records):
+            n += len(columns)
+            if writer is not None:
+                writer.writerows(columns.rows())
+        return n
+
+    try:
+        if recording.is_recording(args.log):
+            with recording.Recording(args.log) as rec:
+                values = decodeRecords(bulk.parse_recording(rec))
+        else:
+            with open(args.log, 'r', encoding='utf8', errors='replace') as f:
+                values = decodeRecords(bulk.parse_log(f))
+    finally:
+        if out is not None:
+            out.close()
+    stats = decoder.stats()
+    stats['values'] = values
+    stats['vectorized'] = decoder.vectorized
+    stats['wall_seconds'] = round(time.perf_counter() - t, 3)
+    json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return 0
+
+def run_replay(args):
+    stats = replay.replay(args.recording, json.loads(args.options) if args.options else None,
+                          args.topics.split(',') if args.topics else None, args.speed, args.debug, args.echo)
+    json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m capture', description='Offline analysis of captured Kamstrup meter traffic')
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_decode = commands.add_parser('decode', help='decode the SerialReceived payloads of a recording or of a Domoticz log written with Verbose debugging')
+    parser_decode.add_argument('log', help='recording or Domoticz log file')
+    parser_decode.add_argument('--csv', metavar='FILE', help='write timestamp, meter, register, value and unit rows')
+    parser_decode.add_argument('--chunk-size', type=int, default=65536, help='payloads decoded at once (default 65536)')
+    parser_decode.add_argument('--scalar', action='store_true', help='decode frame by frame, also when NumPy is installed')
+    parser_decode.set_defaults(run=decode)
+    parser_replay = commands.add_parser('replay', help='feed the received messages of a recording to the plugin in the simulator')
+    parser_replay.add_argument('recording', help='file written with the capture option')
+    parser_replay.add_argument('--speed', type=float, default=0.0, help='multiple of real time, 0 replays as fast as possible (default)')
+    parser_replay.add_argument('--options', default='', help='plugin options as JSON')
+    parser_replay.add_argument('--topics', default='', help='device topics, comma separated, default the topics with SerialReceived results')
+    parser_replay.add_argument('--debug', default='Normal', choices=['Normal', 'Debug', 'Verbose', 'Verbose+'])
+    parser_replay.add_argument('--echo', action='store_true', help='print the plugin log')
+    parser_replay.set_defaults(run=run_replay)
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
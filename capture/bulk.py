@@ -0,0 +1,432 @@
+#           Bulk decoder for captured meter traffic
+#
+#           Decodes many SerialReceived payloads at once into columns:
+#           timestamp, meter, register, value and unit. Payloads are read from
+#           a Domoticz log written with Verbose debugging (see
+#           DumpMQTTMessageToLog in plugin.py), a recording (see recording.py),
+#           or passed as (timestamp, topic, hex) records.
+#
+#           Payloads are decoded in chunks. Frames split across messages are
+#           reassembled per meter, then the frames of a chunk are grouped by
+#           length and register layout: with NumPy, the CRC and the register
+#           values of a group are computed for all its frames at once, one
+#           byte column at a time. Without NumPy, every frame is decoded with
+#           the kmp functions and the columns are array.array.
+#
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from datetime import datetime
+import re
+
+import kmp
+import recording
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Domoticz log line of onMQTTPublish with Verbose debugging, e.g.
+# 2024-01-17 12:00:00.123  Kamstrup: onMQTTPublish: tasmota/meter_1/tele/RESULT:b'{"SerialReceived":"40..0d"}'
+PUBLISH = 'onMQTTPublish: '
+TIMESTAMP = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(\.\d+)?')
+HEX = re.compile(r'[0-9A-Fa-f]*')
+SERIAL_RECEIVED = re.compile(r'"SerialReceived"\s*:\s*"([0-9A-Fa-f]*)"')
+
+COLUMNS = ('timestamp', 'meter', 'register', 'value', 'unit')
+
+# Groups smaller than this are decoded frame by frame
+MIN_GROUP = 8
+
+# Yields (timestamp, topic, hex) of the SerialReceived payloads in the lines
+# of a Domoticz log. Lines without a timestamp get timestamp 0. Lines are
+# split with str methods, a regular expression per line is much slower.
+def parse_log(lines):
+    minutes = {}        # 'YYYY-MM-DD HH:MM' -> timestamp, parsed once per minute
+    for line in lines:
+        i = line.find(PUBLISH)
+        if i < 0:
+            continue
+        i += len(PUBLISH)
+        j = line.find(":b'", i)
+        if j < 0:
+            continue
+        hexdata = SERIAL_RECEIVED.search(line, j)
+        if hexdata is None:
+            continue
+        topic = line[i:j]
+        if topic.endswith('/tele/RESULT'):
+            topic = topic[:-len('/tele/RESULT')]
+        t = 0.0
+        stamp = TIMESTAMP.match(line)
+        if stamp is not None:
+            t = minutes.get(line[:16])
+            if t is None:
+                t = minutes[line[:16]] = datetime.strptime(line[:16], '%Y-%m-%d %H:%M').timestamp()
+            t += int(line[17:19])
+            if stamp.group(1):
+                t += float(stamp.group(1))
+        yield (t, topic, hexdata.group(1))
+
+# Yields (timestamp, topic, hex) of the received SerialReceived payloads of
+# a recording.Recording
+def parse_recording(rec):
+    publish = recording.VERB_CODES['PUBLISH']
+    for (t, direction, code, flags, topic, payload) in rec.raw_records():
+        if direction != recording.RECEIVED or code != publish or b'SerialReceived' not in payload:
+            continue
+        hexdata = SERIAL_RECEIVED.search(payload.decode('utf8', 'replace'))
+        if hexdata is None:
+            continue
+        topic = topic.decode('utf8', 'replace')
+        if topic.endswith('/tele/RESULT'):
+            topic = topic[:-len('/tele/RESULT')]
+        yield (t, topic, hexdata.group(1))
+
+# Decoded register values, one row per value. meter is an index into
+# meters, unit is the KMP unit code, see kmp.UNITS.
+class Columns:
+    __slots__ = ('timestamp', 'meter', 'register', 'value', 'unit', 'meters')
+
+    def __init__(self, meters=None):
+        self.timestamp = array('d')
+        self.meter = array('I')
+        self.register = array('H')
+        self.value = array('d')
+        self.unit = array('B')
+        self.meters = meters if meters is not None else []
+
+    def __len__(self):
+        return len(self.value)
+
+    # Append the columns of another chunk, as arrays of the same kind
+    def extend(self, other):
+        for name in COLUMNS:
+            column = getattr(self, name)
+            if numpy is not None and isinstance(getattr(other, name), numpy.ndarray):
+                if not isinstance(column, numpy.ndarray):
+                    column = numpy.asarray(column)
+                setattr(self, name, numpy.concatenate((column, getattr(other, name))))
+            else:
+                column.extend(getattr(other, name))
+
+    # Yields (timestamp, topic, register, value, unit name) rows
+    def rows(self):
+        meters = self.meters
+        units = kmp.UNITS
+        for t, m, reg, x, u in zip(self.timestamp, self.meter, self.register, self.value, self.unit):
+            yield (float(t), meters[m], int(reg), float(x), units.get(int(u), ''))
+
+class BulkDecoder:
+    def __init__(self, chunk_size=65536, vectorized=None):
+        self.chunk_size = chunk_size
+        self.vectorized = numpy is not None if vectorized is None else vectorized
+        if self.vectorized and numpy is None:
+            raise ValueError("vectorized decoding needs NumPy")
+        self.meters = []                # Topics, the meter column indexes this
+        self.meterIndex = {}            # topic -> index in meters
+        self.pending = {}               # meter index -> hex of an incomplete frame at the end of the previous chunk
+        self.max_pending = 2048         # Hex digits, like kmp.FrameReassembler.max_size
+        self.payloads = 0
+        self.frames = 0
+        self.frame_errors = 0           # Invalid hex, bad framing or escapes
+        self.crc_errors = 0
+        self.other_frames = 0           # Valid frames other than GetRegister responses
+
+    def stats(self):
+        return {'payloads': self.payloads, 'frames': self.frames, 'frame_errors': self.frame_errors,
+                'crc_errors': self.crc_errors, 'other_frames': self.other_frames, 'meters': len(self.meters)}
+
+    # Decode (timestamp, topic, hex) records, yields Columns per chunk
+    def decode(self, records):
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= self.chunk_size:
+                yield self.decode_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield self.decode_chunk(chunk)
+
+    # Decode all records into a single Columns
+    def decode_all(self, records):
+        result = Columns(self.meters)
+        for columns in self.decode(records):
+            result.extend(columns)
+        return result
+
+    def decode_chunk(self, records):
+        streams = self.streams(records)
+        if self.vectorized:
+            return self.decode_vectorized(streams)
+        return self.decode_scalar(self.frames_of(streams))
+
+    # Joins the hex payloads of each meter after the incomplete frame of
+    # the previous chunk, so frames split across messages are reassembled
+    # and converted at once. Returns [(meter index, record indexes,
+    # timestamps, bytes, ends)] where ends are the hex digits up to the end
+    # of each record. Payloads with invalid hex are dropped.
+    def streams(self, records):
+        bymeter = {}            # meter index -> ([record index], [timestamp], [hex])
+        meterIndex = self.meterIndex
+        for k, (t, topic, hexdata) in enumerate(records):
+            m = meterIndex.get(topic)
+            if m is None:
+                m = meterIndex[topic] = len(self.meters)
+                self.meters.append(topic)
+            payloads = bymeter.get(m)
+            if payloads is None:
+                payloads = bymeter[m] = ([], [], [])
+            payloads[0].append(k)
+            payloads[1].append(t)
+            payloads[2].append(hexdata)
+        self.payloads += len(records)
+
+        streams = []
+        for m, (indexes, timestamps, hexes) in bymeter.items():
+            pending = self.pending.pop(m, '')
+            text = pending + ''.join(hexes)
+            try:
+                raw = bytes.fromhex(text[:len(text) & ~1])
+            except ValueError:
+                raw = b''
+            if 2 * len(raw) != len(text) & ~1:
+                # Invalid hex, or whitespace which bytes.fromhex skips
+                (indexes, timestamps, hexes) = self.valid_hex(indexes, timestamps, hexes)
+                text = pending + ''.join(hexes)
+                raw = bytes.fromhex(text[:len(text) & ~1])
+            ends = list(accumulate((len(h) for h in hexes), initial=len(pending)))[1:]
+            streams.append((m, indexes, timestamps, text, raw, ends))
+        return streams
+
+    # Drops the records of a meter with invalid hex payloads
+    def valid_hex(self, indexes, timestamps, hexes):
+        valid = ([], [], [])
+        for k, t, h in zip(indexes, timestamps, hexes):
+            if HEX.fullmatch(h) is None:
+                self.frame_errors += 1
+                continue
+            valid[0].append(k)
+            valid[1].append(t)
+            valid[2].append(h)
+        return valid
+
+    # Keeps the hex from the first start byte after the last frame of a
+    # stream for the next chunk, bytes outside frames are dropped
+    def keep_pending(self, m, text, raw, i):
+        start = raw.find(kmp.START_RESPONSE, i)
+        if start < 0:
+            start = len(raw)    # Only the trailing hex digit of an odd length stream, if any
+        rest = text[2 * start:]
+        if rest and len(rest) <= self.max_pending:
+            self.pending[m] = rest
+
+    # Destuffed frame raw[start + 1:stop], address and CRC included, or
+    # None if it is invalid
+    def unstuff(self, raw, start, stop):
+        if kmp.ESCAPE in raw[start:stop]:
+            try:
+                (buf, bad_escapes) = kmp.unstuff(raw, start + 1, stop)
+            except kmp.KmpError:
+                self.frame_errors += 1
+                return None
+            buf = bytes(buf)
+        else:
+            buf = raw[start + 1:stop]
+        if len(buf) < 4:
+            self.frame_errors += 1
+            return None
+        return buf
+
+    #######################################################################
+    # Frame by frame
+    #
+    # A frame is the last start byte before a stop byte, like in
+    # kmp.FrameReassembler, and gets the timestamp of the record with its
+    # stop byte. Returns [(record index, timestamp, meter index, frame)]
+    # ordered by record.
+    def frames_of(self, streams):
+        frames = []
+        (start_byte, stop_byte) = (kmp.START_RESPONSE, kmp.STOP)
+        for (m, indexes, timestamps, text, raw, ends) in streams:
+            i = 0
+            while True:
+                start = raw.find(start_byte, i)
+                if start < 0:
+                    break
+                stop = raw.find(stop_byte, start)
+                if stop < 0:
+                    break
+                start = raw.rfind(start_byte, start, stop)
+                i = stop + 1
+                self.frames += 1
+                buf = self.unstuff(raw, start, stop)
+                if buf is not None:
+                    r = bisect_left(ends, 2 * stop + 2)
+                    frames.append((indexes[r], timestamps[r], m, buf))
+            self.keep_pending(m, text, raw, i)
+        frames.sort(key=lambda frame: frame[0])
+        return frames
+
+    def decode_scalar(self, frames):
+        columns = Columns(self.meters)
+        (timestamps, meters, registers, values, units) = (columns.timestamp, columns.meter, columns.register, columns.value, columns.unit)
+        (pow10, crc16) = (kmp.POW10, kmp.crc16)
+        for (k, t, m, buf) in frames:
+            if crc16(buf):
+                self.crc_errors += 1
+                continue
+            if buf[1] != kmp.CID_GET_REGISTER:
+                self.other_frames += 1
+                continue
+            data = memoryview(buf)[1:-2]
+            i = 1
+            try:
+                while i < len(data):
+                    (reg, mantissa, e, unit, end) = kmp.read_register_fixed(data, i)
+                    timestamps.append(t)
+                    meters.append(m)
+                    registers.append(reg)
+                    values.append(mantissa * pow10[e] if e >= 0 else mantissa / pow10[-e])
+                    units.append(data[i + 2])
+                    i = end
+            except kmp.KmpError:
+                self.frame_errors += 1
+        return columns
+
+    #######################################################################
+    # Vectorized, with NumPy
+    #
+    # Frames are found in the byte stream of each meter with array
+    # operations and gathered into one uint8 matrix per frame length.
+    # Returns {length: [(record indexes, timestamps, meters, rows)]}.
+    def rows_of(self, streams):
+        groups = {}
+        for (m, indexes, timestamps, text, raw, ends) in streams:
+            b = numpy.frombuffer(raw, dtype=numpy.uint8)
+            stops = numpy.flatnonzero(b == kmp.STOP)
+            starts = numpy.flatnonzero(b == kmp.START_RESPONSE)
+            escapes = numpy.flatnonzero(b == kmp.ESCAPE)
+            # The frame of a stop byte starts at the last start byte before
+            # it, which must be after the previous stop byte
+            last = numpy.searchsorted(starts, stops) - 1
+            first = starts[numpy.maximum(last, 0)] if len(starts) else numpy.zeros(len(stops), numpy.int64)
+            previous = numpy.concatenate(([-1], stops[:-1]))
+            found = (last >= 0) & (first > previous)
+            (first, stops) = (first[found], stops[found])
+            self.keep_pending(m, text, raw, int(stops[-1]) + 1 if len(stops) else 0)
+            self.frames += len(stops)
+            if not len(stops):
+                continue
+            completed = numpy.searchsorted(numpy.asarray(ends), 2 * stops + 2)      # Record with the stop byte
+            records = numpy.asarray(indexes, dtype=numpy.int64)[completed]
+            times = numpy.asarray(timestamps, dtype=numpy.float64)[completed]
+            escaped = numpy.searchsorted(escapes, stops) > numpy.searchsorted(escapes, first)
+            lengths = stops - first - 1
+            plain = ~escaped & (lengths >= 4)
+            self.frame_errors += int(numpy.count_nonzero(~escaped & (lengths < 4)))
+            meters = numpy.full(len(stops), m, dtype=numpy.uint32)
+            for length in numpy.unique(lengths[plain]):
+                select = plain & (lengths == length)
+                rows = b[first[select, None] + 1 + numpy.arange(length)]
+                groups.setdefault(int(length), []).append((records[select], times[select], meters[select], rows))
+            for i in numpy.flatnonzero(escaped):
+                buf = self.unstuff(raw, int(first[i]), int(stops[i]))
+                if buf is not None:
+                    rows = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(1, len(buf))
+                    groups.setdefault(len(buf), []).append((records[i:i + 1], times[i:i + 1], meters[i:i + 1], rows))
+        return groups
+
+    def decode_vectorized(self, streams):
+        parts = []              # (record index, timestamp, meter, register, value, unit) columns
+        for length, group in self.rows_of(streams).items():
+            (records, timestamps, meters, rows) = [numpy.concatenate([part[k] for part in group]) for k in range(4)]
+            valid = crc16_rows(rows) == 0
+            getregister = valid & (rows[:, 1] == kmp.CID_GET_REGISTER)
+            self.crc_errors += len(rows) - int(numpy.count_nonzero(valid))
+            self.other_frames += int(numpy.count_nonzero(valid)) - int(numpy.count_nonzero(getregister))
+            parts.extend(self.decode_rows(rows[getregister], records[getregister], timestamps[getregister], meters[getregister]))
+        columns = Columns(self.meters)
+        if parts:
+            (records, columns.timestamp, columns.meter, columns.register, columns.value, columns.unit) = \
+                [numpy.concatenate([part[k] for part in parts]) for k in range(6)]
+            # Back in the order of the records, the groups were decoded one after the other
+            order = numpy.argsort(records, kind='stable')
+            for name in COLUMNS:
+                setattr(columns, name, getattr(columns, name)[order])
+        else:
+            for name in COLUMNS:
+                setattr(columns, name, numpy.asarray(getattr(columns, name)))
+        return columns
+
+    # Decode GetRegister frames of equal length, grouped by the register
+    # layout of their first frame. Returns a list of column tuples.
+    def decode_rows(self, rows, records, timestamps, meters):
+        parts = []
+        while len(rows):
+            layout = register_layout(rows[0])
+            if layout is None:
+                match = numpy.zeros(len(rows), dtype=bool)
+                match[0] = True
+            else:
+                positions = [p for (p, n) in layout for p in (p, p + 1, p + 2, p + 3)]
+                match = numpy.all(rows[:, positions] == rows[0, positions], axis=1)
+            if layout is None or numpy.count_nonzero(match) < MIN_GROUP:
+                # Unusual layout, decode frame by frame
+                for i in numpy.flatnonzero(match):
+                    columns = self.decode_scalar([(records[i], timestamps[i], meters[i], rows[i].tobytes())])
+                    parts.append((numpy.full(len(columns), records[i], numpy.int64),) +
+                                 tuple(numpy.asarray(getattr(columns, name)) for name in COLUMNS))
+            else:
+                parts.append(decode_layout(rows[match], layout, records[match], timestamps[match], meters[match]))
+            keep = ~match
+            (rows, records, timestamps, meters) = (rows[keep], records[keep], timestamps[keep], meters[keep])
+        return parts
+
+# CRC of each row of a uint8 matrix, one byte column per step
+def crc16_rows(rows):
+    table = numpy.asarray(kmp.CRC_TABLE, dtype=numpy.uint16)
+    crc = numpy.zeros(len(rows), dtype=numpy.uint16)
+    for j in range(rows.shape[1]):
+        crc = (crc << numpy.uint16(8)) ^ table[(crc >> numpy.uint16(8)) ^ rows[:, j]]
+    return crc
+
+# Positions of the values in a destuffed GetRegister frame, address and
+# CRC included: [(position of the register id, mantissa length)]. None if
+# the frame is truncated or a mantissa does not fit in 64 bits.
+def register_layout(row):
+    layout = []
+    (i, end) = (2, len(row) - 2)
+    while i < end:
+        if i + 5 > end:
+            return None
+        n = int(row[i + 3])
+        if n > 8 or i + 5 + n > end:
+            return None
+        layout.append((i, n))
+        i += 5 + n
+    return layout
+
+# Decode the register values of frames with the same layout, returns the
+# (record index, timestamp, meter, register, value, unit) columns, row major
+# per frame
+def decode_layout(rows, layout, records, timestamps, meters):
+    (nframes, nregs) = (len(rows), len(layout))
+    registers = numpy.empty((nframes, nregs), dtype=numpy.uint16)
+    values = numpy.empty((nframes, nregs), dtype=numpy.float64)
+    units = numpy.empty((nframes, nregs), dtype=numpy.uint8)
+    for k, (p, n) in enumerate(layout):
+        registers[:, k] = rows[:, p].astype(numpy.uint16) << 8 | rows[:, p + 1]
+        units[:, k] = rows[:, p + 2]
+        mantissa = numpy.zeros(nframes, dtype=numpy.uint64)
+        for j in range(n):
+            mantissa = (mantissa << numpy.uint64(8)) | rows[:, p + 5 + j]
+        siex = rows[:, p + 4]
+        exponent = (siex & 0x3f).astype(numpy.float64)
+        x = mantissa.astype(numpy.float64)
+        # Dividing by an exact power of ten rounds correctly, multiplying by 10**-e does not
+        x = numpy.where(siex & 0x40, x / 10.0 ** exponent, x * 10.0 ** exponent)
+        values[:, k] = numpy.where(siex & 0x80, -x, x)
+    return (numpy.repeat(records, nregs), numpy.repeat(timestamps, nregs), numpy.repeat(meters, nregs),
+            registers.ravel(), values.ravel(), units.ravel())
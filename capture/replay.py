@@ -0,0 +1,80 @@
+#           Replay of a recording through the plugin
+#
+#           The received PUBLISH messages of a recording (see recording.py) are
+#           fed to BasePlugin.onMessage of plugin.py running in the simulator
+#           (simulator/harness.py), at their recorded times. Time is
+#           simulated, so heartbeats, polling and update intervals behave as
+#           they did, and a replay is deterministic. With speed > 0, messages
+#           are also delivered at that multiple of real time, 0 replays as
+#           fast as possible.
+#
+#           The simulated broker answers CONNECT, SUBSCRIBE and PING itself,
+#           the recorded replies are skipped. There are no meters, requests
+#           sent by the plugin during the replay are not answered.
+#
+import time
+
+import recording
+from simulator.harness import Harness
+
+PUBLISH = recording.VERB_CODES['PUBLISH']
+
+# Device topics of the meters in a recording: the topics of received
+# SerialReceived results, without '/tele/RESULT'
+def meter_topics(rec):
+    topics = set()
+    for (t, direction, code, flags, topic, payload) in rec.raw_records():
+        if direction == recording.RECEIVED and code == PUBLISH and topic.endswith(b'/tele/RESULT') and b'SerialReceived' in payload:
+            topics.add(topic[:-len(b'/tele/RESULT')].decode('utf8', 'replace'))
+    return sorted(topics)
+
+# Replays the recording at path, returns statistics like the simulator
+def replay(path, options=None, topics=None, speed=0.0, debug='Normal', echo=False):
+    with recording.Recording(path) as rec:
+        first = next((t for (t, direction, code, flags, topic, payload) in rec.raw_records()), None)
+        if first is None:
+            raise ValueError("%s: empty recording" % path)
+        if not topics:
+            topics = meter_topics(rec)
+        if not topics:
+            raise ValueError("%s: no meter responses, pass the device topics" % path)
+        options = dict(options or {})
+        options['capture'] = ""         # Do not record the replay
+
+        harness = Harness(meters=0, options=options, debug=debug, start=first - 1.0, echo=echo)
+        harness.parameters['Mode2'] = ','.join(topics)
+        harness.start()
+        harness.run(1.0)                # Connected when the first message is replayed
+
+        (replayed, skipped, recordedSent) = (0, 0, 0)
+        wallStart = time.perf_counter()
+        for (t, direction, code, flags, topic, payload) in rec.raw_records():
+            if code != PUBLISH:
+                continue
+            if direction == recording.SENT:
+                recordedSent += 1
+                continue
+            harness.clock.run_until(t)
+            if speed > 0:
+                delay = (t - first) / speed - (time.perf_counter() - wallStart)
+                if delay > 0:
+                    time.sleep(delay)
+            connection = harness.plugin._plugin.mqttClient.mqttConn
+            if connection is None or not connection.connected:
+                skipped += 1
+                continue
+            harness.onMessage(connection, recording.decode_message(code, flags, topic.decode('utf8', 'replace'), payload))
+            replayed += 1
+        harness.run(1.0)
+        harness.stop()
+        wall = time.perf_counter() - wallStart
+
+    stats = harness.stats()
+    stats['topics'] = topics
+    stats['replayed'] = replayed
+    stats['skipped'] = skipped          # Received while the plugin was not connected
+    stats['recorded_sent'] = recordedSent
+    stats['wall_seconds'] = round(wall, 3)
+    stats['messages_per_second'] = round(replayed / wall, 1) if wall > 0 else None
+    stats['values'] = dict((unit, device.sValue) for unit, device in harness.plugin.Devices.items())
+    return stats
@@ -0,0 +1,5 @@
+#           Standalone asyncio service polling Kamstrup meters over MQTT
+#
+#           Runs the plugin's KMP polling outside of Domoticz and publishes the
+#           decoded register values. See python -m daemon --help.
+#
@@ -0,0 +1,151 @@
+#           python -m daemon --host 127.0.0.1 --topics tasmota/meter_1,tasmota/meter_2
+#
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import threading
+import time
+
+from daemon.broker import Broker
+from daemon.mqtt import Client
+from daemon.service import KamstrupService
+from daemon.supervisor import Supervisor
+
+# Real time clock for the simulated meters
+class WallClock:
+    def time(self):
+        return time.time()
+
+    def call_at(self, t, fn, *args):
+        asyncio.get_running_loop().call_later(max(0.0, t - time.time()), fn, *args)
+
+    def call_later(self, delay, fn, *args):
+        asyncio.get_running_loop().call_later(delay, fn, *args)
+
+def simulateMeters(broker, n, seed):
+    from simulator.meter import MC402, TasmotaBridge
+    clock = WallClock()
+    rng = random.Random(seed)
+    topics = []
+    for i in range(n):
+        topic = 'tasmota/meter_%03d' % i
+        TasmotaBridge(topic, MC402(70000000 + i, clock, rng), broker, clock, rng).start()
+        topics.append(topic)
+    return topics
+
+def parseTopics(args):
+    return [topic.strip() for topic in args.topics.split(',') if topic.strip()]
+
+# Starts the local broker, simulated meters are added to topics
+async def startBroker(args, topics):
+    broker = Broker()
+    port = await broker.start(args.host, args.port)
+    logging.info("Local broker listening on %s:%d", args.host, port)
+    if args.simulate:
+        topics += simulateMeters(broker, args.simulate, args.seed)
+    return (broker, port)
+
+# Runs the local broker on an event loop in a background thread, returns its port
+def startBrokerThread(args, topics):
+    ready = threading.Event()
+    result = []
+    def run():
+        loop = asyncio.new_event_loop()
+        result.append(loop.run_until_complete(startBroker(args, topics)))
+        ready.set()
+        loop.run_forever()
+    threading.Thread(target=run, name='broker', daemon=True).start()
+    ready.wait()
+    return result[0][1]
+
+async def main(args):
+    topics = parseTopics(args)
+    options = json.loads(args.options) if args.options else {}
+    broker = None
+    port = args.port
+    if args.local_broker:
+        (broker, port) = await startBroker(args, topics)
+
+    client = Client(args.client_id, args.keepalive, args.username, args.password)
+    service = KamstrupService(client, topics, options)
+    task = asyncio.ensure_future(service.run(args.host, port))
+    try:
+        if args.duration:
+            await asyncio.sleep(args.duration)
+        else:
+            await task
+    finally:
+        task.cancel()
+        await client.disconnect()
+        service.reportMetrics(time.monotonic())
+        if broker is not None:
+            await broker.stop()
+
+# Runs the meters in args.workers processes. SIGUSR1 adds a worker and
+# SIGUSR2 removes one, the meters are rebalanced.
+def supervise(args):
+    topics = parseTopics(args)
+    options = json.loads(args.options) if args.options else {}
+    port = args.port
+    if args.local_broker:
+        port = startBrokerThread(args, topics)
+
+    config = {'clientPrefix': args.client_id, 'keepalive': args.keepalive, 'username': args.username,
+              'password': args.password, 'options': options, 'logLevel': args.log_level.upper()}
+    supervisor = Supervisor(topics, args.host, port, config)
+    supervisor.start(args.workers)
+
+    resize = []
+    signal.signal(signal.SIGUSR1, lambda signum, frame: resize.append(1))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: resize.append(-1))
+
+    started = time.monotonic()
+    lastReport = started
+    try:
+        while not args.duration or time.monotonic() - started < args.duration:
+            supervisor.poll(1.0)
+            while resize:
+                if resize.pop() > 0:
+                    supervisor.addWorker()
+                elif len(supervisor.workers) > 1:
+                    supervisor.removeWorker(sorted(supervisor.workers)[-1])
+            if time.monotonic() - lastReport >= args.report_interval:
+                lastReport = time.monotonic()
+                logging.info("Metrics: %s", json.dumps(supervisor.aggregate(), sort_keys=True))
+    finally:
+        supervisor.stop()
+        logging.info("Metrics: %s", json.dumps(supervisor.aggregate(), sort_keys=True))
+    return supervisor
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m daemon', description='Poll Kamstrup meters behind Tasmota devices over MQTT')
+    parser.add_argument('--host', default='127.0.0.1', help='MQTT broker address')
+    parser.add_argument('--port', type=int, default=1883, help='MQTT broker port, 0 picks a free port with --local-broker')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--client-id', default='kamstrup_%d' % os.getpid())
+    parser.add_argument('--keepalive', type=int, default=60, help='MQTT keepalive in seconds')
+    parser.add_argument('--topics', default='', help='comma separated Tasmota base topics, like the plugin Mode2 parameter')
+    parser.add_argument('--options', help='options as JSON, see daemon/service.py')
+    parser.add_argument('--local-broker', action='store_true', help='run the local broker stand-in on --host and --port')
+    parser.add_argument('--simulate', type=int, default=0, metavar='N', help='add N simulated meters to the local broker')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the simulated meters')
+    parser.add_argument('--workers', type=int, default=0, help='shard the meters over this many worker processes')
+    parser.add_argument('--report-interval', type=float, default=60, help='seconds between supervisor metrics reports')
+    parser.add_argument('--duration', type=float, default=0, help='stop after this many seconds')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+    if args.simulate and not args.local_broker:
+        parser.error("--simulate requires --local-broker")
+    try:
+        if args.workers:
+            supervise(args)
+        else:
+            asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
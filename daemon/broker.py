@@ -0,0 +1,143 @@
+#           Local MQTT broker stand-in for testing the daemon
+#
+#           Accepts MQTT 3.1.1 clients on a TCP port and routes QoS 0 messages,
+#           retained messages included. QoS 1 messages are acknowledged and
+#           delivered as QoS 0. There is no authentication or persistence. Like
+#           a real broker, it closes the connection of a client which sends a
+#           SUBSCRIBE or UNSUBSCRIBE without topics.
+#
+#           In-process subscribers, like the simulated Tasmota devices, are
+#           attached with subscribe() and receive deliver(topic, payload, retain)
+#           calls.
+#
+import asyncio
+import struct
+
+from daemon import mqtt
+from subscriptions import topic_matches
+
+class Session:
+    def __init__(self, broker, reader, writer):
+        self.task = asyncio.current_task()
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.subscriptions = set()
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    async def run(self):
+        try:
+            (ptype, flags, body) = await mqtt.read_packet(self.reader)
+            if ptype != mqtt.CONNECT:
+                return
+            (protocol, i) = mqtt.unpack_str(body, 0)
+            (self.client_id, i) = mqtt.unpack_str(body, i + 4)
+            self.send(mqtt.packet(mqtt.CONNACK, 0, b'\x00\x00'))
+            while True:
+                (ptype, flags, body) = await mqtt.read_packet(self.reader)
+                if ptype == mqtt.PUBLISH:
+                    (topic, payload, qos, retain, packet_id) = mqtt.parse_publish(flags, body)
+                    if qos:
+                        self.send(mqtt.packet(mqtt.PUBACK, 0, struct.pack('!H', packet_id)))
+                    self.broker.publish(topic, payload, retain)
+                elif ptype == mqtt.SUBSCRIBE:
+                    (packet_id,) = struct.unpack_from('!H', body)
+                    (i, topics) = (2, [])
+                    while i < len(body):
+                        (topic, i) = mqtt.unpack_str(body, i)
+                        topics.append(topic)
+                        i += 1 # Requested QoS
+                    if not topics:
+                        return          # A SUBSCRIBE without topic filters is a protocol violation [MQTT-3.8.3-3]
+                    self.subscriptions.update(topics)
+                    self.send(mqtt.packet(mqtt.SUBACK, 0, struct.pack('!H', packet_id) + bytes(len(topics))))
+                    for topic in topics:
+                        self.broker.sendRetained(self, topic)
+                elif ptype == mqtt.UNSUBSCRIBE:
+                    (packet_id,) = struct.unpack_from('!H', body)
+                    if len(body) <= 2:
+                        return          # [MQTT-3.10.3-2]
+                    i = 2
+                    while i < len(body):
+                        (topic, i) = mqtt.unpack_str(body, i)
+                        self.subscriptions.discard(topic)
+                    self.send(mqtt.packet(mqtt.UNSUBACK, 0, struct.pack('!H', packet_id)))
+                elif ptype == mqtt.PINGREQ:
+                    self.send(mqtt.packet(mqtt.PINGRESP, 0))
+                elif ptype == mqtt.DISCONNECT:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError, mqtt.MqttError, struct.error):
+            pass
+        finally:
+            self.broker.sessions.discard(self)
+            self.writer.close()
+
+    def matches(self, topic):
+        for pattern in self.subscriptions:
+            if topic_matches(pattern, topic):
+                return True
+        return False
+
+class Broker:
+    def __init__(self):
+        self.sessions = set()
+        self.retained = {}      # topic -> payload
+        self.local = {}         # in-process subscriber -> topic patterns
+        self.server = None
+        self.published = 0
+        self.delivered = 0
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.onClient, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        tasks = [session.task for session in self.sessions]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def onClient(self, reader, writer):
+        session = Session(self, reader, writer)
+        self.sessions.add(session)
+        try:
+            await session.run()
+        except asyncio.CancelledError:
+            pass # Broker stopped
+
+    def subscribe(self, subscriber, patterns):
+        self.local.setdefault(subscriber, set()).update(patterns)
+        for pattern in patterns:
+            for topic, payload in self.retained.items():
+                if topic_matches(pattern, topic):
+                    asyncio.get_running_loop().call_soon(subscriber.deliver, topic, payload, True)
+
+    def publish(self, topic, payload, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf8')
+        self.published += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        data = mqtt.publish_packet(topic, payload)
+        for session in self.sessions:
+            if session.matches(topic):
+                session.send(data)
+                self.delivered += 1
+        for subscriber, patterns in self.local.items():
+            if any(topic_matches(pattern, topic) for pattern in patterns):
+                asyncio.get_running_loop().call_soon(subscriber.deliver, topic, payload, retain)
+                self.delivered += 1
+
+    def sendRetained(self, session, pattern):
+        for topic, payload in self.retained.items():
+            if topic_matches(pattern, topic):
+                session.send(mqtt.publish_packet(topic, payload, True))
@@ -0,0 +1,209 @@
+#           Minimal asyncio MQTT 3.1.1 client
+#
+#           Supports what the daemon needs: CONNECT with clean session,
+#           username and password, QoS 0 PUBLISH, QoS 1 PUBLISH received from
+#           the broker, SUBSCRIBE, UNSUBSCRIBE, keepalive and DISCONNECT.
+#
+import asyncio
+import struct
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+class MqttError(Exception):
+    pass
+
+#######################################################################
+# Packet encoding
+#
+def pack_str(s):
+    if isinstance(s, str):
+        s = s.encode('utf8')
+    return struct.pack('!H', len(s)) + s
+
+def unpack_str(b, i):
+    (n,) = struct.unpack_from('!H', b, i)
+    return (b[i + 2:i + 2 + n].decode('utf8'), i + 2 + n)
+
+def packet(ptype, flags, body=b''):
+    header = bytearray(((ptype << 4) | flags,))
+    n = len(body)
+    while True:
+        digit = n & 0x7f
+        n >>= 7
+        header.append(digit | 0x80 if n else digit)
+        if not n:
+            break
+    return bytes(header) + body
+
+def publish_packet(topic, payload, retain=False, qos=0, packet_id=0):
+    if isinstance(payload, str):
+        payload = payload.encode('utf8')
+    body = pack_str(topic)
+    if qos:
+        body += struct.pack('!H', packet_id)
+    return packet(PUBLISH, (qos << 1) | (1 if retain else 0), body + bytes(payload))
+
+# Returns (type, flags, body), raises asyncio.IncompleteReadError on EOF
+async def read_packet(reader):
+    first = (await reader.readexactly(1))[0]
+    n = 0
+    shift = 0
+    while True:
+        digit = (await reader.readexactly(1))[0]
+        n |= (digit & 0x7f) << shift
+        if not digit & 0x80:
+            break
+        shift += 7
+        if shift > 21:
+            raise MqttError("Malformed remaining length")
+    body = await reader.readexactly(n) if n else b''
+    return (first >> 4, first & 0x0f, body)
+
+# Returns (topic, payload, qos, retain, packet_id)
+def parse_publish(flags, body):
+    qos = (flags >> 1) & 0x03
+    (topic, i) = unpack_str(body, 0)
+    packet_id = 0
+    if qos:
+        (packet_id,) = struct.unpack_from('!H', body, i)
+        i += 2
+    return (topic, body[i:], qos, bool(flags & 0x01), packet_id)
+
+#######################################################################
+# Client
+#
+class Client:
+    def __init__(self, client_id, keepalive=60, username=None, password=None, on_message=None):
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.username = username
+        self.password = password
+        self.on_message = on_message    # Called with (topic, payload, retain)
+        self.reader = None
+        self.writer = None
+        self.connected = False
+        self.closed = None              # Future, set when the connection is lost
+        self.packet_id = 0
+        self.pending = {}               # packet id -> future waiting for SUBACK / UNSUBACK
+        self.tasks = []
+        self.published = 0
+        self.received = 0
+
+    async def connect(self, host, port, timeout=10):
+        (self.reader, self.writer) = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        flags = 0x02 # Clean session
+        payload = pack_str(self.client_id)
+        if self.username is not None:
+            flags |= 0x80
+            payload += pack_str(self.username)
+            if self.password is not None:
+                flags |= 0x40
+                payload += pack_str(self.password)
+        self.writer.write(packet(CONNECT, 0, pack_str('MQTT') + struct.pack('!BBH', 4, flags, self.keepalive) + payload))
+        (ptype, pflags, body) = await asyncio.wait_for(read_packet(self.reader), timeout)
+        if ptype != CONNACK or len(body) < 2:
+            raise MqttError("Expected CONNACK")
+        if body[1] != 0:
+            raise MqttError("Connection refused, return code %d" % body[1])
+        self.connected = True
+        self.closed = asyncio.get_running_loop().create_future()
+        self.tasks = [asyncio.ensure_future(self._read_loop())]
+        if self.keepalive:
+            self.tasks.append(asyncio.ensure_future(self._ping_loop()))
+
+    def _next_id(self):
+        self.packet_id = self.packet_id % 0xffff + 1
+        return self.packet_id
+
+    async def _request(self, data, packet_id):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[packet_id] = future
+        self.writer.write(data)
+        try:
+            return await future
+        finally:
+            self.pending.pop(packet_id, None)
+
+    async def subscribe(self, topics, qos=0):
+        packet_id = self._next_id()
+        body = struct.pack('!H', packet_id) + b''.join(pack_str(topic) + bytes((qos,)) for topic in topics)
+        return await self._request(packet(SUBSCRIBE, 0x02, body), packet_id)
+
+    async def unsubscribe(self, topics):
+        packet_id = self._next_id()
+        body = struct.pack('!H', packet_id) + b''.join(pack_str(topic) for topic in topics)
+        return await self._request(packet(UNSUBSCRIBE, 0x02, body), packet_id)
+
+    def publish(self, topic, payload, retain=False):
+        if not self.connected:
+            return False
+        self.writer.write(publish_packet(topic, payload, retain))
+        self.published += 1
+        return True
+
+    async def drain(self):
+        if self.connected:
+            await self.writer.drain()
+
+    async def disconnect(self):
+        if self.connected:
+            self.writer.write(packet(DISCONNECT, 0))
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                pass
+        self._close(None)
+
+    def _close(self, exc):
+        if self.writer is None:
+            return
+        self.connected = False
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self.writer.close()
+        self.writer = None
+        for future in self.pending.values():
+            if not future.done():
+                # Callers only handle MqttError, not the IncompleteReadError of a closed connection
+                future.set_exception(MqttError("Connection lost: %s" % exc) if exc is not None else MqttError("Disconnected"))
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(exc)
+
+    async def _read_loop(self):
+        exc = None
+        try:
+            while True:
+                (ptype, flags, body) = await read_packet(self.reader)
+                if ptype == PUBLISH:
+                    (topic, payload, qos, retain, packet_id) = parse_publish(flags, body)
+                    if qos:
+                        self.writer.write(packet(PUBACK, 0, struct.pack('!H', packet_id)))
+                    self.received += 1
+                    if self.on_message is not None:
+                        self.on_message(topic, payload, retain)
+                elif ptype in (SUBACK, UNSUBACK):
+                    (packet_id,) = struct.unpack_from('!H', body)
+                    future = self.pending.get(packet_id)
+                    if future is not None and not future.done():
+                        future.set_result(list(body[2:]))
+        except (asyncio.IncompleteReadError, ConnectionError, MqttError) as e:
+            exc = e
+        finally:
+            self._close(exc)
+
+    async def _ping_loop(self):
+        while self.connected:
+            await asyncio.sleep(self.keepalive / 2)
+            if self.connected:
+                self.writer.write(packet(PINGREQ, 0))
@@ -0,0 +1,53 @@
+#           Consistent hash ring
+#
+#           Each node is placed on the ring at replicas points, a key belongs to
+#           the node at the first point at or after the key's hash. Adding or
+#           removing a node only moves the keys between it and its neighbours.
+#
+from bisect import bisect_left, insort
+import hashlib
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.sha1(key.encode('utf8')).digest()[:8], 'big')
+
+class HashRing:
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.points = []        # Sorted hashes
+        self.owners = {}        # hash -> node
+        for node in nodes:
+            self.add(node)
+
+    def __contains__(self, node):
+        return ring_hash('%s#0' % node) in self.owners
+
+    def __len__(self):
+        return len(self.points) // self.replicas
+
+    def add(self, node):
+        for i in range(self.replicas):
+            h = ring_hash('%s#%d' % (node, i))
+            if h not in self.owners:
+                insort(self.points, h)
+            self.owners[h] = node
+
+    def remove(self, node):
+        for i in range(self.replicas):
+            h = ring_hash('%s#%d' % (node, i))
+            if self.owners.get(h) == node:
+                del self.owners[h]
+                self.points.pop(bisect_left(self.points, h))
+
+    # Returns the node owning key, None if the ring is empty
+    def node(self, key):
+        if not self.points:
+            return None
+        i = bisect_left(self.points, ring_hash(key))
+        return self.owners[self.points[i % len(self.points)]]
+
+    # Returns node -> set of keys
+    def assign(self, keys):
+        assignment = {}
+        for key in keys:
+            assignment.setdefault(self.node(key), set()).add(key)
+        return assignment
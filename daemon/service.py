@@ -0,0 +1,267 @@
+#           Polls Kamstrup meters behind Tasmota devices and publishes the values
+#
+#           The KMP codec (kmp.py), polling (poller.py) and metrics (metrics.py)
+#           are shared with the Domoticz plugin. Each meter is identified by
+#           its Tasmota base topic, like the plugin's Mode2 device topics.
+#
+import asyncio
+import json
+import logging
+import time
+
+from backoff import Backoff
+import kmp
+import metrics
+import poller
+import registermap
+from daemon import mqtt
+from metrics import timed
+
+log = logging.getLogger('kamstrup')
+
+OPTIONS = {"registersPerRequest":kmp.MAX_REGISTERS_PER_REQUEST, # Registers read by a single GetRegister
+           "pollIntervals":{},              # Poll interval in seconds per register, e.g. {"80": 30}
+           "meterTypes":{},                 # Meter type per GetType id, e.g. {"0x4401": "kamstrup_602_heat"}
+           "adaptivePolling":{},            # Min and max poll interval per register, e.g. {"80": {"min": 5, "max": 300}}, or per meter topic
+           "adaptiveThreshold":0.05,        # Relative change between two readings which polls a register at its minimum interval
+           "requestTimeout":2.0,            # Seconds to wait for a KMP response
+           "requestRetries":2,              # Number of times a KMP request is resent
+           "discoveryInterval":10,          # Seconds between GetType requests to unidentified meters
+           "tick":0.1,                      # Seconds between checks for timeouts and due registers
+           "valueTopic":"{meter}/tele/KAMSTRUP", # Decoded register values, JSON
+           "metricsInterval":300,           # Seconds between metrics reports, 0 disables them
+           "metricsTopic":"kamstrup/{client_id}/metrics", # Retained metrics, null disables publishing
+           "reconnectDelay":1,              # Seconds before the first reconnect attempt, doubled per attempt, with jitter
+           "reconnectMaxDelay":300}         # Maximum seconds between reconnect attempts
+
+class Meter:
+    __slots__ = ('topic', 'regmap', 'reassembler', 'stats')
+
+    def __init__(self, topic, stats):
+        self.topic = topic
+        self.regmap = None              # registermap.RegisterMap, set by the GetType response
+        self.reassembler = kmp.FrameReassembler()
+        self.stats = stats              # metrics.MeterMetrics
+
+class KamstrupService:
+    def __init__(self, client, topics, options=None):
+        self.client = client            # daemon.mqtt.Client, or anything with the same interface
+        self.client.on_message = self.onMessage
+        self.options = dict(OPTIONS)
+        if options:
+            self.options.update(options)
+        self.metrics = metrics.Metrics()
+        self.meters = {}                # base topic -> Meter
+        self.resultTopics = {}          # result topic -> Meter
+        for topic in topics:
+            self.addMeter(topic)
+        self.meterPoller = poller.MeterPoller(int(self.options['registersPerRequest']),
+                                              float(self.options['requestTimeout']), int(self.options['requestRetries']),
+                                              float(self.options['adaptiveThreshold']))
+        self.meterTypes = registermap.type_ids(self.options['meterTypes'])
+        self.lastDiscovery = None
+        self.lastMetricsReport = time.monotonic()
+        self.values = 0                 # Number of decoded register values
+        self.onValues = None            # Called with (topic, values) for each GetRegister response
+
+    def addMeter(self, topic):
+        meter = Meter(topic, self.metrics.meter(topic))
+        self.meters[topic] = meter
+        self.resultTopics[topic + '/tele/RESULT'] = meter
+
+    def removeMeter(self, topic):
+        del self.meters[topic]
+        del self.resultTopics[topic + '/tele/RESULT']
+        self.meterPoller.remove_meter(topic)
+        self.metrics.meters.pop(topic, None)
+
+    # Poll exactly the meters in topics, subscriptions are updated if connected
+    async def setTopics(self, topics):
+        added = [topic for topic in topics if topic not in self.meters]
+        removed = [topic for topic in self.meters if topic not in topics]
+        for topic in removed:
+            self.removeMeter(topic)
+        for topic in added:
+            self.addMeter(topic)
+        if added:
+            self.lastDiscovery = None # Identify the new meters on the next tick
+        if self.client.connected:
+            if removed:
+                await self.client.unsubscribe([topic + '/tele/RESULT' for topic in removed])
+            if added:
+                await self.client.subscribe([topic + '/tele/RESULT' for topic in added])
+        return (added, removed)
+
+    #######################################################################
+    # Main loop, reconnects until cancelled
+    #
+    async def run(self, host, port):
+        backoff = Backoff(float(self.options['reconnectDelay']), float(self.options['reconnectMaxDelay']))
+        while True:
+            try:
+                await self.client.connect(host, port)
+                backoff.reset()
+                log.info("Connected to %s:%s, polling %d meters", host, port, len(self.meters))
+                if self.resultTopics:
+                    await self.client.subscribe(list(self.resultTopics))
+                await self.pollLoop()
+            except (OSError, asyncio.TimeoutError, mqtt.MqttError) as e:
+                log.error("MQTT connection to %s:%s failed: %s", host, port, e)
+            self.abortRequests()
+            delay = backoff.next()
+            log.info("Reconnecting in %.1fs", delay)
+            await asyncio.sleep(delay)
+
+    async def pollLoop(self):
+        tick = float(self.options['tick'])
+        while self.client.connected:
+            self.tick(time.monotonic())
+            await self.client.drain()
+            await asyncio.sleep(tick)
+
+    # Requests outstanding when the connection was lost are sent again when polled
+    def abortRequests(self):
+        for link in self.meterPoller.links.values():
+            link.abort()
+
+    @timed('tick')
+    def tick(self, now):
+        if self.lastDiscovery is None or now - self.lastDiscovery >= float(self.options['discoveryInterval']):
+            self.lastDiscovery = now
+            for meter in self.meters.values():
+                if meter.regmap is None:
+                    self.send(meter, bytes((kmp.ADDRESS, kmp.CID_GET_TYPE)))
+
+        for (topic, status, t) in self.meterPoller.expire(now):
+            if status == poller.MeterLink.RETRY:
+                log.debug("%s: Request timed out, retry %d", topic, t.attempts - 1)
+                self.send(self.meters[topic], t.msg)
+            else:
+                log.warning("%s: No response to request for registers %s after %d attempts", topic, list(t.regs), t.attempts)
+
+        for topic in self.meterPoller.ready(now):
+            self.poll(self.meters[topic], now)
+
+        interval = float(self.options['metricsInterval'])
+        if interval and now - self.lastMetricsReport >= interval:
+            self.lastMetricsReport = now
+            self.reportMetrics(now)
+
+    # Request the next batch of due registers of a meter
+    def poll(self, meter, now):
+        request = self.meterPoller.request(meter.topic, now)
+        if request is None:
+            return
+        (t, missed, due) = request
+        for reg, lateness in missed:
+            log.info("%s: Missed poll deadline of register %d by %ds", meter.topic, reg, lateness)
+        meter.stats.queue_depth.observe(due)
+        self.send(meter, t.msg)
+
+    def send(self, meter, msg):
+        meter.stats.frames_sent += 1
+        self.client.publish(meter.topic + '/cmnd/serialsend4', kmp.encode(kmp.START_REQUEST, msg))
+
+    #######################################################################
+    # Responses
+    #
+    @timed('onMessage')
+    def onMessage(self, topic, payload, retain):
+        meter = self.resultTopics.get(topic)
+        if meter is None:
+            return
+        try:
+            s = json.loads(payload)["SerialReceived"]
+        except (ValueError, KeyError, TypeError):
+            return
+        if s == "06": # Acknowledge
+            return
+        try:
+            raws = meter.reassembler.feed_hex(s)
+        except kmp.KmpError as e:
+            log.info("%s: %s '%s'", meter.topic, e, s)
+            return
+        now = time.monotonic()
+        for raw in raws:
+            meter.stats.frames_received += 1
+            try:
+                b = kmp.decode(raw)
+            except kmp.KmpCrcError:
+                meter.stats.crc_errors += 1
+                continue
+            except kmp.KmpError as e:
+                meter.stats.frame_errors += 1
+                log.info("%s: %s '%s'", meter.topic, e, raw.hex())
+                continue
+            meter.stats.missing_escapes += len(b.bad_escapes)
+            # This runs in the read loop of the MQTT client, a bad response must not end it
+            try:
+                self.handleResponse(meter, b, now)
+            except Exception:
+                meter.stats.frame_errors += 1
+                log.exception("%s: Failed to handle response '%s'", meter.topic, b.hex())
+
+    def handleResponse(self, meter, b, now):
+        regs = ()
+        if b.cid == kmp.CID_GET_TYPE:
+            if meter.regmap is None:
+                self.identify(meter, b, now)
+            return
+        if meter.regmap is None:
+            # Not polled yet, e.g. the response to another client or to a previous run
+            log.debug("%s: Ignoring response %s before the meter was identified", meter.topic, b.hex())
+            return
+        if b.cid == kmp.CID_GET_REGISTER:
+            regs = kmp.register_ids(b)
+            values = {}
+            try:
+                for (reg, x, u) in kmp.read_registers(b):
+                    self.meterPoller.observe(meter.topic, reg, x, now)
+                    values[meter.regmap.names.get(reg, str(reg))] = {"register": reg, "value": x, "unit": u}
+            except kmp.KmpError as e:
+                log.info("%s: GetRegister response: %s '%s'", meter.topic, e, b.hex())
+            if values:
+                self.values += len(values)
+                self.client.publish(self.options['valueTopic'].format(meter=meter.topic), json.dumps(values, default=float)) # Decimal values
+                if self.onValues is not None:
+                    self.onValues(meter.topic, values)
+
+        t = self.meterPoller.complete(meter.topic, b.cid, regs)
+        if t is None:
+            return
+        meter.stats.rtt.observe(now - t.started)
+        if self.meterPoller.due(meter.topic, now):
+            self.poll(meter, now)
+
+    def identify(self, meter, b, now):
+        type_id = b[1] << 8 | b[2] if len(b) >= 3 else None
+        if type_id not in self.meterTypes:
+            log.warning("%s: Unknown meter type %s", meter.topic, '%04x' % type_id if type_id is not None else b.hex())
+            return
+        meter.regmap = registermap.MAPS[self.meterTypes[type_id]]
+        log.info("%s: %s found", meter.topic, meter.regmap.name)
+        schedule = poller.poll_schedule(meter.regmap.poll, self.options['pollIntervals'])
+        self.meterPoller.add_meter(meter.topic, schedule, now, poller.adaptive_intervals(self.options['adaptivePolling'], meter.topic))
+        self.poll(meter, now)
+
+    #######################################################################
+    # Metrics
+    #
+    def metricsSnapshot(self, now):
+        snapshot = self.metrics.snapshot()
+        snapshot['values'] = self.values
+        snapshot['identified'] = sum(1 for meter in self.meters.values() if meter.regmap is not None)
+        for topic, link in self.meterPoller.links.items():
+            stats = snapshot['meters'].setdefault(topic, {})
+            stats['due_registers'] = self.meterPoller.scheduler.due_count(topic, now)
+            stats['retries'] = link.retried
+            stats['failures'] = link.failed
+            stats['unmatched'] = link.unmatched
+        return snapshot
+
+    def reportMetrics(self, now):
+        payload = json.dumps(self.metricsSnapshot(now), sort_keys=True)
+        log.info("Metrics: %s", payload)
+        topic = self.options['metricsTopic']
+        if topic:
+            self.client.publish(topic.format(client_id=self.client.client_id), payload, True)
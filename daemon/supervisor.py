@@ -0,0 +1,244 @@
+#           Shards meters over worker processes
+#
+#           The device topics are assigned to workers with a consistent hash
+#           ring, so adding or removing a worker only moves the meters of the
+#           ring segments it takes over or gives up. Each worker runs its own
+#           MQTT session and KamstrupService, and sends decoded values and
+#           metrics back to the supervisor over a pipe.
+#
+#           Supervisor -> worker: ('assign', [topics]), ('stop',)
+#           Worker -> supervisor: ('values', {topic: values}), ('metrics', snapshot)
+#
+import asyncio
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+import time
+
+from daemon.mqtt import Client
+from daemon.ring import HashRing
+from daemon.service import KamstrupService
+
+log = logging.getLogger('kamstrup')
+
+# Counters of the worker metrics which are summed by Supervisor.aggregate
+COUNTERS = ('frames_sent', 'frames_received', 'crc_errors', 'frame_errors', 'missing_escapes', 'retries', 'failures', 'unmatched')
+
+#######################################################################
+# Worker process
+#
+def runWorker(name, conn, host, port, config):
+    logging.basicConfig(level=config.get('logLevel', 'INFO'), format='%(asctime)s %(levelname)s ' + name + ' %(message)s')
+    try:
+        asyncio.run(workerMain(name, conn, host, port, config))
+    except KeyboardInterrupt:
+        pass
+
+async def workerMain(name, conn, host, port, config):
+    client = Client(config.get('clientPrefix', 'kamstrup') + '_' + name, config.get('keepalive', 60),
+                    config.get('username'), config.get('password'))
+    options = dict(config.get('options') or {})
+    options.setdefault('metricsInterval', 0) # Reported by the supervisor
+    service = KamstrupService(client, [], options)
+    values = {}
+    service.onValues = values.__setitem__
+
+    commands = asyncio.Queue()
+    def receive():
+        try:
+            commands.put_nowait(conn.recv())
+        except (EOFError, OSError):
+            loop.remove_reader(conn.fileno())
+            commands.put_nowait(('stop',)) # Supervisor is gone
+    loop = asyncio.get_running_loop()
+    loop.add_reader(conn.fileno(), receive)
+
+    task = asyncio.ensure_future(service.run(host, port))
+    flushInterval = float(config.get('flushInterval', 1.0))
+    reportInterval = float(config.get('reportInterval', 10.0))
+    lastReport = time.monotonic()
+    try:
+        while True:
+            try:
+                command = await asyncio.wait_for(commands.get(), flushInterval)
+            except asyncio.TimeoutError:
+                command = None
+            if command is not None:
+                if command[0] == 'stop':
+                    break
+                if command[0] == 'assign':
+                    (added, removed) = await service.setTopics(set(command[1]))
+                    log.info("Assigned %d meters, %d added, %d removed", len(command[1]), len(added), len(removed))
+            if values:
+                conn.send(('values', dict(values)))
+                values.clear()
+            now = time.monotonic()
+            if now - lastReport >= reportInterval:
+                lastReport = now
+                conn.send(('metrics', service.metricsSnapshot(now)))
+        conn.send(('metrics', service.metricsSnapshot(time.monotonic())))
+    except (BrokenPipeError, EOFError):
+        pass
+    finally:
+        task.cancel()
+        await client.disconnect()
+
+#######################################################################
+# Supervisor
+#
+class Worker:
+    __slots__ = ('name', 'process', 'conn', 'topics')
+
+    def __init__(self, name, process, conn):
+        self.name = name
+        self.process = process
+        self.conn = conn
+        self.topics = set()     # Assigned device topics
+
+class Supervisor:
+    def __init__(self, topics, host, port, config=None, replicas=100):
+        self.topics = list(topics)
+        self.host = host
+        self.port = port
+        self.config = dict(config or {}) # Passed to the workers, see workerMain
+        self.ring = HashRing(replicas=replicas)
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = {}       # name -> Worker
+        self.values = {}        # topic -> last decoded values
+        self.metrics = {}       # worker name -> last metrics snapshot
+        self.moved = 0          # Number of meter reassignments, initial assignments excluded
+        self.restarts = 0
+
+    def startProcess(self, name):
+        (parent, child) = self.context.Pipe()
+        process = self.context.Process(target=runWorker, args=(name, child, self.host, self.port, self.config),
+                                       name='kamstrup-' + name, daemon=True)
+        process.start()
+        child.close()
+        return Worker(name, process, parent)
+
+    # Start n workers and assign the meters
+    def start(self, n):
+        for i in range(n):
+            self.addWorker(rebalance=False)
+        self.rebalance()
+
+    def addWorker(self, name=None, rebalance=True):
+        if name is None:
+            i = 0
+            while 'worker-%d' % i in self.workers:
+                i += 1
+            name = 'worker-%d' % i
+        self.workers[name] = self.startProcess(name)
+        self.ring.add(name)
+        return self.rebalance() if rebalance else 0
+
+    # The worker is stopped before its meters are assigned to the others, so
+    # two processes never poll a meter at the same time
+    def removeWorker(self, name):
+        worker = self.workers[name]
+        self.ring.remove(name)
+        del self.workers[name]
+        self.stopWorker(worker)
+        self.metrics.pop(name, None)
+        self.rebalance()
+        moved = len(worker.topics) # All of its meters move
+        self.moved += moved
+        log.info("Rebalanced %d of %d meters over %d workers", moved, len(self.topics), len(self.workers))
+        return moved
+
+    def stopWorker(self, worker, timeout=5):
+        self.send(worker, ('stop',))
+        worker.process.join(timeout)
+        if worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join()
+        worker.conn.close()
+
+    # Send changed assignments to the workers. Returns the number of meters
+    # which moved from one worker to another.
+    def rebalance(self):
+        assignment = self.ring.assign(self.topics)
+        owned = set()
+        for worker in self.workers.values():
+            owned |= worker.topics
+        moved = 0
+        for name, worker in self.workers.items():
+            topics = assignment.get(name, set())
+            if topics == worker.topics:
+                continue
+            moved += len((topics - worker.topics) & owned)
+            worker.topics = topics
+            self.send(worker, ('assign', sorted(topics)))
+        self.moved += moved
+        if moved:
+            log.info("Rebalanced %d of %d meters over %d workers", moved, len(self.topics), len(self.workers))
+        return moved
+
+    def send(self, worker, message):
+        try:
+            worker.conn.send(message)
+        except (BrokenPipeError, OSError, ValueError):
+            pass # Restarted by poll
+
+    # Handle messages from the workers for up to timeout seconds. Workers
+    # which exited are restarted with the same name, and so the same meters.
+    def poll(self, timeout):
+        conns = dict((worker.conn, worker) for worker in self.workers.values())
+        for conn in wait(list(conns), timeout):
+            worker = conns[conn]
+            if not self.receive(worker):
+                self.restart(worker)
+
+    # Handle a message from a worker, returns False if the worker is gone
+    def receive(self, worker):
+        try:
+            (kind, data) = worker.conn.recv()
+        except (EOFError, OSError):
+            return False
+        if kind == 'values':
+            self.values.update(data)
+        elif kind == 'metrics':
+            self.metrics[worker.name] = data
+        return True
+
+    def restart(self, worker):
+        worker.process.join()
+        log.error("Worker %s exited with code %s, restarting", worker.name, worker.process.exitcode)
+        worker.conn.close()
+        restarted = self.startProcess(worker.name)
+        restarted.topics = worker.topics
+        self.workers[worker.name] = restarted
+        self.restarts += 1
+        self.send(restarted, ('assign', sorted(worker.topics)))
+
+    # Stop all workers, their final metrics are received first
+    def stop(self, timeout=5):
+        for worker in self.workers.values():
+            self.send(worker, ('stop',))
+        for worker in self.workers.values():
+            while worker.conn.poll(timeout) and self.receive(worker):
+                pass
+            self.stopWorker(worker, timeout)
+
+    # Totals over the last metrics of each worker
+    def aggregate(self):
+        totals = dict((counter, 0) for counter in COUNTERS)
+        totals['values'] = 0
+        totals['identified'] = 0
+        workers = {}
+        for name, worker in self.workers.items():
+            snapshot = self.metrics.get(name, {})
+            workers[name] = {'meters': len(worker.topics), 'pid': worker.process.pid,
+                             'values': snapshot.get('values', 0), 'identified': snapshot.get('identified', 0)}
+            totals['values'] += snapshot.get('values', 0)
+            totals['identified'] += snapshot.get('identified', 0)
+            for stats in snapshot.get('meters', {}).values():
+                for counter in COUNTERS:
+                    totals[counter] += stats.get(counter, 0)
+        totals['meters'] = len(self.topics)
+        totals['meters_with_values'] = len(self.values)
+        totals['moved'] = self.moved
+        totals['restarts'] = self.restarts
+        totals['workers'] = workers
+        return totals
@@ -0,0 +1,98 @@
+#           Persisted meter identities
+#
+#           This module does not depend on Domoticz. The identity of the meter
+#           behind each Tasmota topic, its GetType id, software revision,
+#           serial number and meter type, is kept in a JSON file so meters are
+#           not discovered again after a restart. The time of the last Status
+#           queries to the Tasmota device is kept with it, so a restart does
+#           not query all devices again:
+#
+#           {"tasmota/meter_1": {"type_id": 4353, "revision": 1, "serial_no": 70000000,
+#                                "meter_type": "kamstrup_402_heat", "updated": 1700000000,
+#                                "status_refreshed": 1700000000}}
+#
+import json
+import os
+
+class MeterIdentity:
+    __slots__ = ('topic', 'type_id', 'revision', 'serial_no', 'meter_type', 'updated', 'status_refreshed')
+
+    FIELDS = ('type_id', 'revision', 'serial_no', 'meter_type', 'updated', 'status_refreshed')
+    TIMES = ('updated', 'status_refreshed')     # Fields which do not change the identity
+
+    def __init__(self, topic, type_id=None, revision=None, serial_no=None, meter_type=None, updated=0, status_refreshed=None):
+        self.topic = topic
+        self.type_id = type_id          # GetType meter type
+        self.revision = revision        # GetType software revision
+        self.serial_no = serial_no
+        self.meter_type = meter_type    # Register map, see registermap.METER_TYPES
+        self.updated = updated          # Time of the last change
+        self.status_refreshed = status_refreshed # Time of the last Status queries to the Tasmota device
+
+    def __repr__(self):
+        return 'MeterIdentity(%r, %s)' % (self.topic, ', '.join('%s=%r' % (f, getattr(self, f)) for f in self.FIELDS))
+
+    def to_dict(self):
+        return dict((f, getattr(self, f)) for f in self.FIELDS if getattr(self, f) is not None)
+
+class IdentityStore:
+    def __init__(self, path=None):
+        self.path = path                # JSON file, None keeps the identities in memory only
+        self.identities = {}            # topic -> MeterIdentity
+        self.dirty = False
+
+    def __contains__(self, topic):
+        return topic in self.identities
+
+    def __len__(self):
+        return len(self.identities)
+
+    # Load the identities, a missing file is empty. Raises OSError or
+    # ValueError if the file can not be read.
+    def load(self):
+        self.identities = {}
+        self.dirty = False
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("%s: expected a JSON object" % self.path)
+        for topic, fields in data.items():
+            if isinstance(fields, dict):
+                self.identities[topic] = MeterIdentity(topic, **dict((f, fields.get(f)) for f in MeterIdentity.FIELDS if f in fields))
+
+    # Write the identities if they changed, through a temporary file so a
+    # crash never leaves a partial file. Raises OSError.
+    def save(self):
+        if not self.dirty or self.path is None:
+            return
+        data = dict((topic, identity.to_dict()) for topic, identity in sorted(self.identities.items()))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def get(self, topic):
+        return self.identities.get(topic)
+
+    # Set fields of the identity of topic, which is created if needed.
+    # Returns the identity.
+    def update(self, topic, now, **fields):
+        identity = self.identities.get(topic)
+        if identity is None:
+            identity = self.identities[topic] = MeterIdentity(topic)
+        for f, value in fields.items():
+            if f not in MeterIdentity.FIELDS:
+                raise TypeError("Unknown identity field '%s'" % f)
+            if getattr(identity, f) != value:
+                setattr(identity, f, value)
+                if f not in MeterIdentity.TIMES:
+                    identity.updated = now
+                self.dirty = True
+        return identity
+
+    def remove(self, topic):
+        if self.identities.pop(topic, None) is not None:
+            self.dirty = True
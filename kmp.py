@@ -0,0 +1,393 @@
+#           Kamstrup Meter Protocol (KMP) codec
+#           Code copied from / inspired by:
+#             https://github.com/nabovarme/MeterLogger/blob/master/user/kamstrup/kmp.c
+#             https://github.com/bsdphk/PyKamstrup/blob/master/kamstrup.py
+#
+#           This module does not depend on Domoticz, it only works on bytes-like
+#           objects (bytes, bytearray, memoryview) and never copies its input.
+#
+from binascii import crc_hqx
+from decimal import Decimal
+
+#######################################################################
+# Kamstrup uses the "true" CCITT CRC-16, polynomial 0x1021, initial value 0
+#
+CRC_POLY = 0x1021
+
+def _make_crc_tables(n):
+    tables = [[0] * 256 for _ in range(n)]
+    t0 = tables[0]
+    for byte in range(256):
+        reg = byte << 8
+        for _ in range(8):
+            reg <<= 1
+            if reg & 0x10000:
+                reg ^= 0x10000 | CRC_POLY
+        t0[byte] = reg
+    # tables[k][b] is the CRC of byte b followed by k zero bytes
+    for k in range(1, n):
+        prev = tables[k - 1]
+        cur = tables[k]
+        for byte in range(256):
+            v = prev[byte]
+            cur[byte] = ((v << 8) & 0xffff) ^ t0[v >> 8]
+    return tables
+
+CRC_TABLES = _make_crc_tables(8)
+CRC_TABLE = CRC_TABLES[0]
+
+# Table driven CRC, one byte per step
+def crc16_table(data, crc=0):
+    table = CRC_TABLE
+    for byte in memoryview(data).cast('B'):
+        crc = ((crc << 8) & 0xffff) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+# Slice-by-4: consumes four bytes per step
+def crc16_slice4(data, crc=0):
+    t0, t1, t2, t3 = CRC_TABLES[:4]
+    mv = memoryview(data).cast('B')
+    n = len(mv) & ~3
+    for i in range(0, n, 4):
+        crc = t3[(crc >> 8) ^ mv[i]] ^ t2[(crc & 0xff) ^ mv[i + 1]] ^ t1[mv[i + 2]] ^ t0[mv[i + 3]]
+    return crc16_table(mv[n:], crc)
+
+# Slice-by-8: consumes eight bytes per step
+def crc16_slice8(data, crc=0):
+    t0, t1, t2, t3, t4, t5, t6, t7 = CRC_TABLES
+    mv = memoryview(data).cast('B')
+    n = len(mv) & ~7
+    for i in range(0, n, 8):
+        crc = t7[(crc >> 8) ^ mv[i]] ^ t6[(crc & 0xff) ^ mv[i + 1]] ^ t5[mv[i + 2]] ^ t4[mv[i + 3]] ^ \
+              t3[mv[i + 4]] ^ t2[mv[i + 5]] ^ t1[mv[i + 6]] ^ t0[mv[i + 7]]
+    return crc16_table(mv[n:], crc)
+
+# Fastest available implementation. binascii.crc_hqx is the same CRC
+# (CRC-CCITT/XMODEM) implemented in C and accepts any contiguous buffer.
+def crc16(data, crc=0):
+    return crc_hqx(data, crc)
+
+# Same result as the original bit-serial implementation, which shifts the
+# message through the register without augmentation. This is the CRC of
+# all but the last two bytes, xored with the last two bytes.
+# crc_1021(msg + crc16(msg)) == 0, and crc_1021(msg + b'\0\0') == crc16(msg).
+def crc_1021(data):
+    mv = memoryview(data).cast('B')
+    if len(mv) < 2:
+        return mv[0] if mv else 0
+    return crc_hqx(mv[:-2], 0) ^ (mv[-2] << 8 | mv[-1])
+
+# Bit-serial reference implementation, kept for verification
+def crc_1021_bitwise(message):
+    poly = CRC_POLY
+    reg = 0x0000
+    for byte in message:
+        mask = 0x80
+        while(mask > 0):
+            reg<<=1
+            if byte & mask:
+                reg |= 1
+            mask>>=1
+            if reg & 0x10000:
+                reg &= 0xffff
+                reg ^= poly
+    return reg
+
+#######################################################################
+# Framing
+#
+START_REQUEST = 0x80
+START_RESPONSE = 0x40
+STOP = 0x0d
+ESCAPE = 0x1b
+ACK = 0x06
+
+# Byte values which must be escaped before transmission
+ESCAPES = frozenset((0x06, 0x0d, 0x1b, 0x40, 0x80))
+
+class KmpError(ValueError):
+    pass
+
+class KmpCrcError(KmpError):
+    def __init__(self, message, raw, frame):
+        KmpError.__init__(self, message)
+        self.raw = raw          # Stuffed frame, without start and stop
+        self.frame = frame      # Destuffed frame, including address and CRC
+
+# A received frame. All views share the buffer the frame was destuffed into.
+class KmpFrame:
+    __slots__ = ('buf', 'data', 'address', 'bad_escapes')
+
+    def __init__(self, buf, bad_escapes=()):
+        self.buf = buf                  # address | cid + data | crc
+        self.data = buf[1:-2]           # cid + data
+        self.address = buf[0]
+        self.bad_escapes = bad_escapes  # Escaped values which did not need escaping
+
+    @property
+    def cid(self):
+        return self.data[0]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def hex(self):
+        return self.data.hex()
+
+# Find the frame in raw, the last start byte before the first stop byte.
+# Returns (start, end), the stuffed frame is raw[start:end].
+def find_frame(raw, start=0, end=None, pfx=START_RESPONSE):
+    if end is None:
+        end = len(raw)
+    stop = raw.find(STOP, start, end)
+    if stop < 0:
+        raise KmpError("No end of frame")
+    first = raw.rfind(pfx, start, stop)
+    if first < 0:
+        raise KmpError("No start of frame")
+    return (first + 1, stop)
+
+# Destuff raw[start:end] in a single pass into a preallocated buffer.
+# Returns a memoryview of the destuffed bytes and the escaped values which
+# did not need escaping.
+def unstuff(raw, start=0, end=None):
+    if end is None:
+        end = len(raw)
+    src = memoryview(raw)
+    out = bytearray(end - start)
+    dst = memoryview(out)
+    bad_escapes = ()
+    j = 0
+    i = start
+    while True:
+        e = raw.find(ESCAPE, i, end)
+        if e < 0:
+            n = end - i
+            dst[j:j + n] = src[i:end]
+            j += n
+            break
+        n = e - i
+        dst[j:j + n] = src[i:e]
+        j += n
+        if e + 1 >= end:
+            raise KmpError("Escape at end of frame")
+        v = raw[e + 1] ^ 0xff
+        if v not in ESCAPES:
+            bad_escapes += (v,)
+        out[j] = v
+        j += 1
+        i = e + 2
+    return (dst[:j], bad_escapes)
+
+# Decode a stuffed frame found in raw (bytes or bytearray). Responses start
+# with START_RESPONSE, pass pfx=START_REQUEST to decode a request.
+def decode(raw, start=0, end=None, pfx=START_RESPONSE):
+    (start, end) = find_frame(raw, start, end, pfx)
+    (buf, bad_escapes) = unstuff(raw, start, end)
+    if len(buf) < 4:
+        raise KmpError("Frame too short")
+    if crc16(buf):
+        raise KmpCrcError("CRC error", memoryview(raw)[start:end], buf)
+    return KmpFrame(buf, bad_escapes)
+
+# Decode a frame from a hex string, e.g. Tasmota's SerialReceived
+def decode_hex(s):
+    try:
+        raw = bytes.fromhex(s)
+    except (ValueError, TypeError) as e:
+        raise KmpError("Invalid hex string: " + str(e))
+    return decode(raw)
+
+# Stuff and frame a message, the CRC is appended
+def encode(pfx, msg):
+    b = bytearray(msg)
+    c = crc16(b)
+    b.append(c >> 8)
+    b.append(c & 0xff)
+
+    c = bytearray()
+    c.append(pfx)
+    for i in b:
+        if i in ESCAPES:
+            c.append(ESCAPE)
+            c.append(i ^ 0xff)
+        else:
+            c.append(i)
+    c.append(STOP)
+    return c
+
+#######################################################################
+# Commands
+#
+CID_GET_TYPE = 0x01
+CID_GET_SERIAL_NO = 0x02
+CID_SET_CLOCK = 0x09
+CID_GET_REGISTER = 0x10
+
+ADDRESS = 0x3f
+
+# Number of registers which can be requested by a single GetRegister
+MAX_REGISTERS_PER_REQUEST = 8
+
+def get_register_request(regs):
+    msg = bytearray((ADDRESS, CID_GET_REGISTER, len(regs)))
+    for reg in regs:
+        msg.append(reg >> 8)
+        msg.append(reg & 0xff)
+    return msg
+
+# Split a register list into GetRegister sized batches
+def batch_registers(regs, size=MAX_REGISTERS_PER_REQUEST):
+    size = max(1, min(size, MAX_REGISTERS_PER_REQUEST))
+    regs = list(regs)
+    return [regs[i:i + size] for i in range(0, len(regs), size)]
+
+#######################################################################
+# Units
+#
+UNITS = {
+    0: '', 1: 'Wh', 2: 'kWh', 3: 'MWh', 4: 'GWh', 5: 'j', 6: 'kj', 7: 'Mj',
+    8: 'Gj', 9: 'Cal', 10: 'kCal', 11: 'Mcal', 12: 'Gcal', 13: 'varh',
+    14: 'kvarh', 15: 'Mvarh', 16: 'Gvarh', 17: 'VAh', 18: 'kVAh',
+    19: 'MVAh', 20: 'GVAh', 21: 'kW', 22: 'kW', 23: 'MW', 24: 'GW',
+    25: 'kvar', 26: 'kvar', 27: 'Mvar', 28: 'Gvar', 29: 'VA', 30: 'kVA',
+    31: 'MVA', 32: 'GVA', 33: 'V', 34: 'A', 35: 'kV',36: 'kA', 37: 'C',
+    38: 'K', 39: 'l', 40: 'm3', 41: 'l/h', 42: 'm3/h', 43: 'm3xC',
+    44: 'ton', 45: 'ton/h', 46: 'h', 47: 'hh:mm:ss', 48: 'yy:mm:dd',
+    49: 'yyyy:mm:dd', 50: 'mm:dd', 51: '', 52: 'bar', 53: 'RTC',
+    54: 'ASCII', 55: 'm3 x 10', 56: 'ton x 10', 57: 'GJ x 10',
+    58: 'minutes', 59: 'Bitfield', 60: 's', 61: 'ms', 62: 'days',
+    63: 'RTC-Q', 64: 'Datetime'
+}
+
+#######################################################################
+# Register values
+#
+
+# Powers of ten for the 6 bit exponent of register values
+POW10 = tuple(10 ** e for e in range(64))
+NEG_POW10 = tuple(Decimal(1).scaleb(-e) for e in range(64))
+
+# Decode the register value starting at b[i] as fixed point:
+#   register (2 bytes) | unit | length | sign and exponent | mantissa
+# Returns (reg, m, e, unit, i), the value is m * 10**e and i is the index
+# after the value.
+def read_register_fixed(b, i=1):
+    if isinstance(b, KmpFrame):
+        b = b.data
+    if i + 5 > len(b):
+        raise KmpError("Truncated register at %d" % i)
+    reg = b[i]<<8 | b[i + 1]
+    u = UNITS.get(b[i + 2])
+    end = i + 5 + b[i + 3]
+    if end > len(b):
+        raise KmpError("Truncated register %d" % reg)
+
+    m = int.from_bytes(b[i + 5:end], 'big')
+    siex = b[i + 4]
+    if siex & 0x80:
+        m = -m
+    e = siex & 0x3f
+    if siex & 0x40:
+        e = -e
+    return (reg, m, e, u, end)
+
+# Exact value of m * 10**e, an int if e >= 0, else a Decimal
+def fixed_value(m, e):
+    if e >= 0:
+        return m * POW10[e]
+    return m * NEG_POW10[-e]
+
+# Decode the register value starting at b[i].
+# Returns (reg, x, unit, i) where i is the index after the value.
+def read_register(b, i=1):
+    (reg, m, e, u, end) = read_register_fixed(b, i)
+    return (reg, fixed_value(m, e), u, end)
+
+# Decode all register values of a GetRegister response, yields (reg, m, e, unit)
+def read_registers_fixed(b):
+    if isinstance(b, KmpFrame):
+        b = b.data
+    i = 1
+    while i < len(b):
+        (reg, m, e, u, i) = read_register_fixed(b, i)
+        yield (reg, m, e, u)
+
+# Decode all register values of a GetRegister response, yields (reg, x, unit)
+def read_registers(b):
+    for (reg, m, e, u) in read_registers_fixed(b):
+        yield (reg, fixed_value(m, e), u)
+
+# Register ids of a GetRegister response, without decoding the values
+def register_ids(b):
+    regs = []
+    i = 1
+    n = len(b)
+    while i + 5 <= n:
+        regs.append(b[i]<<8 | b[i + 1])
+        i += 5 + b[i + 3]
+    return regs
+
+#######################################################################
+# Reassembly of frames split across several messages
+#
+# Feed hex fragments (e.g. Tasmota SerialReceived payloads) as they arrive,
+# complete stuffed frames, start and stop included, are returned as soon as
+# their stop byte has been received. Bytes outside of frames are discarded.
+#
+class FrameReassembler:
+    __slots__ = ('buf', 'nibble', 'max_size')
+
+    def __init__(self, max_size=1024):
+        self.buf = bytearray()
+        self.nibble = ''        # Trailing hex digit of an odd length fragment
+        self.max_size = max_size
+
+    def reset(self):
+        del self.buf[:]
+        self.nibble = ''
+
+    def pending(self):
+        return len(self.buf)
+
+    def feed_hex(self, s):
+        if self.nibble:
+            s = self.nibble + s
+            self.nibble = ''
+        if len(s) & 1:
+            self.nibble = s[-1]
+            s = s[:-1]
+        try:
+            data = bytes.fromhex(s)
+        except ValueError as e:
+            self.reset()
+            raise KmpError("Invalid hex string: " + str(e))
+        return self.feed(data)
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        frames = []
+        i = 0
+        while True:
+            start = buf.find(START_RESPONSE, i)
+            if start < 0:
+                i = len(buf)
+                break
+            stop = buf.find(STOP, start)
+            if stop < 0:
+                i = start
+                break
+            start = buf.rfind(START_RESPONSE, start, stop)
+            frames.append(bytes(buf[start:stop + 1]))
+            i = stop + 1
+        del buf[:i]
+        if len(buf) > self.max_size:
+            del buf[:]
+        return frames
@@ -0,0 +1,126 @@
+#           Counters and histograms
+#
+#           This module does not depend on Domoticz. Meters are identified by
+#           their base topic, durations are in seconds.
+#
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+
+#######################################################################
+# Histogram with fixed 1-2-5 buckets from 1us to 500s
+#
+BOUNDS = [m * 10.0 ** e for e in range(-6, 3) for m in (1, 2, 5)]
+
+class Histogram:
+    __slots__ = ('buckets', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, v):
+        self.buckets[bisect_left(BOUNDS, v)] += 1
+        self.count += 1
+        self.sum += v
+        if self.min is None or v < self.min:
+            self.min = v
+        if self.max is None or v > self.max:
+            self.max = v
+
+    # Upper bound of the bucket containing quantile q, capped by the maximum
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                return min(BOUNDS[i], self.max) if i < len(BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'avg': round(self.sum / self.count, 6),
+            'min': round(self.min, 6),
+            'p50': round(self.quantile(0.5), 6),
+            'p95': round(self.quantile(0.95), 6),
+            'max': round(self.max, 6),
+        }
+
+#######################################################################
+# Per meter link counters
+#
+class MeterMetrics:
+    __slots__ = ('frames_sent', 'frames_received', 'crc_errors', 'frame_errors', 'missing_escapes', 'rtt', 'queue_depth')
+
+    def __init__(self):
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.crc_errors = 0
+        self.frame_errors = 0       # Frames which could not be decoded for other reasons
+        self.missing_escapes = 0
+        self.rtt = Histogram()      # Request to matching response, retries included
+        self.queue_depth = Histogram() # Due registers when a request is sent
+
+    def snapshot(self):
+        return {
+            'frames_sent': self.frames_sent,
+            'frames_received': self.frames_received,
+            'crc_errors': self.crc_errors,
+            'frame_errors': self.frame_errors,
+            'missing_escapes': self.missing_escapes,
+            'rtt': self.rtt.snapshot(),
+            'queue_depth': self.queue_depth.snapshot(),
+        }
+
+class Metrics:
+    def __init__(self):
+        self.started = perf_counter()
+        self.meters = {}        # base topic -> MeterMetrics
+        self.callbacks = {}     # callback name -> Histogram of wall time
+
+    def meter(self, key):
+        m = self.meters.get(key)
+        if m is None:
+            m = MeterMetrics()
+            self.meters[key] = m
+        return m
+
+    def callback(self, name):
+        h = self.callbacks.get(name)
+        if h is None:
+            h = Histogram()
+            self.callbacks[name] = h
+        return h
+
+    def snapshot(self):
+        return {
+            'uptime': round(perf_counter() - self.started, 3),
+            'meters': dict((key, m.snapshot()) for key, m in self.meters.items()),
+            'callbacks': dict((name, h.snapshot()) for name, h in self.callbacks.items()),
+        }
+
+# Records the wall time of a method in self.metrics.callback(name)
+def timed(name):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            started = perf_counter()
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                self.metrics.callback(name).observe(perf_counter() - started)
+        return wrapper
+    return decorator
+
+# Meter key of a meter's topic, e.g. 'tasmota/meter/tele/RESULT' -> 'tasmota/meter'
+def meter_key(topic):
+    return topic.rsplit('/', 2)[0]
@@ -35,14 +35,74 @@
 </plugin>
 """
 import Domoticz
-import math
+from backoff import Backoff
+import identity
+import kmp
+import metrics
+import poller
+import recording
+import registermap
+import subscriptions
+import timeseries
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
 from itertools import count, filterfalse
 import json
+import os
 import re
 import time
-import traceback
+from metrics import timed
 
+#######################################################################
+# Logging facade. The debug level is set once in onStart, debug messages are
+# only formatted when debugging is enabled. Messages are formatted with %
+# when arguments are given, the message and arguments may be callables which
+# are only called when the message is logged.
+#
+class Logger:
+    debugEnabled = False
+    verboseEnabled = False
+
+    def configure(self, mode):
+        self.debugEnabled = mode in ("Debug", "Verbose", "Verbose+")
+        self.verboseEnabled = mode in ("Verbose", "Verbose+")
+
+    def debug(self, msg, *args):
+        if self.debugEnabled:
+            Domoticz.Debug(self.format(msg, args))
+
+    def log(self, msg, *args):
+        Domoticz.Log(self.format(msg, args))
+
+    def error(self, msg, *args):
+        Domoticz.Error(self.format(msg, args))
+
+    @staticmethod
+    def format(msg, args):
+        if callable(msg):
+            msg = msg()
+        if args:
+            msg = msg % tuple(arg() if callable(arg) else arg for arg in args)
+        return msg
+
+# Formats a bytes-like object as hex when converted to str
+class Hex:
+    __slots__ = ('b',)
+
+    def __init__(self, b):
+        self.b = b
+
+    def __str__(self):
+        return ' '.join('%02x' % x for x in self.b)
+
+log = Logger()
+
+# MQTT session over a Domoticz connection. Check() must be called every
+# heartbeat: it reconnects with capped exponential backoff and jitter, also
+# before the first attempt after a lost connection so clients of a restarted
+# broker do not return in lockstep, and sends a PING when nothing was sent
+# or nothing was received for half the keepalive. Polling keeps sending, so
+# only received messages tell that the broker is alive.
 class MqttClient:
     Address = ""
     Port = ""
@@ -51,101 +111,183 @@ class MqttClient:
     mqttConnectedCb = None
     mqttDisconnectedCb = None
     mqttPublishCb = None
-
-    def __init__(self, destination, port, mqttConnectedCb, mqttDisconnectedCb, mqttPublishCb, mqttSubackCb):
-        Domoticz.Debug("MqttClient::__init__")
+    clientID = ""
+    keepalive = 60          # Seconds, 0 disables PINGs
+    cleanSession = True
+    sessionPresent = False  # The broker kept the subscriptions of the previous session
+    connectTimeout = 30     # Seconds to wait for CONNACK
+    nextAttempt = 0         # Time of the next connection attempt while disconnected
+    attemptStarted = 0
+    lastSent = 0
+    lastReceived = 0
+    lastPing = 0            # Time of the last PING, outstanding while later than lastReceived
+    recorder = None         # recording.Recorder of the messages sent and received
+
+    def __init__(self, destination, port, mqttConnectedCb, mqttDisconnectedCb, mqttPublishCb, mqttSubackCb,
+                 clientID='', keepalive=60, cleanSession=True, backoff=None):
+        log.debug("MqttClient::__init__")
         self.Address = destination
         self.Port = port
         self.mqttConnectedCb = mqttConnectedCb
         self.mqttDisconnectedCb = mqttDisconnectedCb
         self.mqttPublishCb = mqttPublishCb
         self.mqttSubackCb = mqttSubackCb
+        self.clientID = clientID
+        self.keepalive = keepalive
+        self.cleanSession = cleanSession
+        self.backoff = backoff or Backoff()
         self.Open()
 
     def __str__(self):
-        Domoticz.Debug("MqttClient::__str__")
+        log.debug("MqttClient::__str__")
         if (self.mqttConn != None):
             return str(self.mqttConn)
         else:
             return "None"
 
     def Open(self):
-        Domoticz.Debug("MqttClient::Open")
+        log.debug("MqttClient::Open")
         if (self.mqttConn != None):
             self.Close()
         self.isConnected = False
+        self.attemptStarted = time.time()
         self.mqttConn = Domoticz.Connection(Name=self.Address, Transport="TCP/IP", Protocol="MQTT", Address=self.Address, Port=self.Port)
         self.mqttConn.Connect()
 
     def Connect(self):
-        Domoticz.Debug("MqttClient::Connect")
+        log.debug("MqttClient::Connect")
         if (self.mqttConn == None):
             self.Open()
         else:
-            ID = 'Domoticz_'+Parameters['Key']+'_'+str(Parameters['HardwareID'])+'_'+str(int(time.time()))
-            Domoticz.Log("MQTT CONNECT ID: '" + ID + "'")
-            self.mqttConn.Send({'Verb': 'CONNECT', 'ID': ID})
+            Domoticz.Log("MQTT CONNECT ID: '" + self.clientID + "'")
+            self.Send({'Verb': 'CONNECT', 'ID': self.clientID, 'CleanSession': 1 if self.cleanSession else 0, 'KeepAlive': self.keepalive})
+
+    def Send(self, message):
+        self.lastSent = time.time()
+        if self.recorder is not None:
+            self.Record(self.lastSent, recording.SENT, message)
+        self.mqttConn.Send(message)
+
+    # Recording must not break the connection, it is stopped on errors, e.g. a full disk
+    def Record(self, t, direction, message):
+        try:
+            self.recorder.record(t, direction, message)
+        except (OSError, ValueError) as e:
+            Domoticz.Error("MqttClient: Recording stopped: " + str(e))
+            self.StopRecording()
+
+    def FlushRecording(self):
+        if self.recorder is not None:
+            try:
+                self.recorder.flush()
+            except OSError as e:
+                Domoticz.Error("MqttClient: Recording stopped: " + str(e))
+                self.StopRecording()
+
+    def StopRecording(self):
+        if self.recorder is not None:
+            try:
+                self.recorder.close()
+            except OSError:
+                pass
+            self.recorder = None
+
+    # Reconnect when the connection is lost or the broker stopped responding, keep the session alive otherwise
+    def Check(self, now):
+        if self.mqttConn is None:
+            if now >= self.nextAttempt:
+                log.debug("Reconnecting")
+                self.Open()
+        elif not self.mqttConn.Connecting() and not self.mqttConn.Connected():
+            self.Lost("Connection to " + self.Address + ":" + self.Port + " lost", closed=True)
+        elif not self.isConnected:
+            if now - self.attemptStarted > self.connectTimeout:
+                self.Lost("No CONNACK from " + self.Address + ":" + self.Port)
+        elif self.keepalive:
+            if now - self.lastReceived > 1.5 * self.keepalive:
+                self.Lost("No response from " + self.Address + ":" + self.Port + " for " + str(int(now - self.lastReceived)) + "s")
+            elif self.lastPing <= self.lastReceived and \
+                    (now - self.lastSent >= self.keepalive / 2 or now - self.lastReceived >= self.keepalive / 2):
+                self.Ping()
+
+    # Drop the connection and schedule the next attempt. DISCONNECT is only
+    # sent if the connection is still open.
+    def Lost(self, reason, closed=False):
+        wasConnected = self.isConnected
+        if closed:
+            self.isConnected = False
+        self.Close()
+        self.nextAttempt = time.time() + self.backoff.next()
+        Domoticz.Log("MqttClient: " + reason + ", reconnecting in " + str(round(self.nextAttempt - time.time(), 1)) + "s")
+        if wasConnected and self.mqttDisconnectedCb != None:
+            self.mqttDisconnectedCb()
 
     def Ping(self):
-        Domoticz.Debug("MqttClient::Ping")
-        if (self.mqttConn == None or not self.isConnected):
-            self.Open()
-        else:
-            self.mqttConn.Send({'Verb': 'PING'})
+        log.debug("MqttClient::Ping")
+        if self.isConnected:
+            self.Send({'Verb': 'PING'})
+            self.lastPing = self.lastSent
 
     def Publish(self, topic, payload, retain = 0):
         if isinstance(payload, bytearray):
-            Domoticz.Debug("MqttClient::Publish " + topic + " (" + ''.join('{:02x}'.format(x) for x in payload) + ")")
+            log.debug("MqttClient::Publish %s (%s)", topic, payload.hex)
         else:
-            Domoticz.Debug("MqttClient::Publish " + topic + " (" + payload + ")")
-        if (self.mqttConn == None or not self.isConnected):
-            self.Open()
-        else:
-            self.mqttConn.Send({'Verb': 'PUBLISH', 'Topic': topic, 'Payload': payload, 'Retain': retain})
+            log.debug("MqttClient::Publish %s (%s)", topic, payload)
+        if self.isConnected:
+            self.Send({'Verb': 'PUBLISH', 'Topic': topic, 'Payload': payload, 'Retain': retain})
 
-    def Subscribe(self, topics):
-        Domoticz.Debug("MqttClient::Subscribe")
+    def Subscribe(self, topics, qos=0):
+        log.debug("MqttClient::Subscribe")
         subscriptionlist = []
         for topic in topics:
-            subscriptionlist.append({'Topic':topic, 'QoS':0})
-        if (self.mqttConn == None or not self.isConnected):
-            self.Open()
-        else:
-            self.mqttConn.Send({'Verb': 'SUBSCRIBE', 'Topics': subscriptionlist})
+            subscriptionlist.append({'Topic':topic, 'QoS':qos})
+        if self.isConnected:
+            self.Send({'Verb': 'SUBSCRIBE', 'Topics': subscriptionlist})
+
+    def Unsubscribe(self, topics):
+        log.debug("MqttClient::Unsubscribe")
+        if self.isConnected:
+            self.Send({'Verb': 'UNSUBSCRIBE', 'Topics': list(topics)})
 
     def Close(self):
         Domoticz.Log("MqttClient::Close")
-        #TODO: Disconnect from server
+        if self.mqttConn != None:
+            if self.isConnected:
+                self.Send({'Verb': 'DISCONNECT'})
+            if self.mqttConn.Connecting() or self.mqttConn.Connected():
+                self.mqttConn.Disconnect()
         self.mqttConn = None
         self.isConnected = False
 
     def onConnect(self, Connection, Status, Description):
-        Domoticz.Debug("MqttClient::onConnect")
+        log.debug("MqttClient::onConnect")
         if (Status == 0):
             Domoticz.Log("Successful connect to: "+Connection.Address+":"+Connection.Port)
             self.Connect()
-        else:
-            Domoticz.Log("Failed to connect to: "+Connection.Address+":"+Connection.Port+", Description: "+Description)
+        elif Connection is self.mqttConn:
+            self.Lost("Failed to connect to: "+Connection.Address+":"+Connection.Port+", Description: "+Description)
 
     def onDisconnect(self, Connection):
         Domoticz.Log("MqttClient::onDisonnect Disconnected from: "+Connection.Address+":"+Connection.Port)
-        self.Close()
-        # TODO: Reconnect?
-        if self.mqttDisconnectedCb != None:
-            self.mqttDisconnectedCb()
+        if Connection is self.mqttConn:
+            self.Lost("Disconnected", closed=True)
 
     def onMessage(self, Connection, Data):
         topic = ''
         if 'Topic' in Data:
             topic = Data['Topic']
-        payloadStr = ''
-        if 'Payload' in Data:
-            payloadStr = Data['Payload'].decode('utf8','replace')
-            payloadStr = str(payloadStr.encode('unicode_escape'))
-        #Domoticz.Debug("MqttClient::onMessage called for connection: '"+Connection.Name+"' type:'"+Data['Verb']+"' topic:'"+topic+"' payload:'" + payloadStr + "'")
+        #log.debug("MqttClient::onMessage called for connection: '%s' type:'%s' topic:'%s'", Connection.Name, Data['Verb'], topic)
+        self.lastReceived = time.time()
+        if self.recorder is not None:
+            self.Record(self.lastReceived, recording.RECEIVED, Data)
 
         if Data['Verb'] == "CONNACK":
+            if Data.get('Status', 0) != 0:
+                self.Lost("Connection refused: " + str(Data.get('Description', Data.get('Status'))))
+                return
             self.isConnected = True
+            self.backoff.reset()
+            self.sessionPresent = not self.cleanSession and bool(Data.get('SessionPresent', False))
             if self.mqttConnectedCb != None:
                 self.mqttConnectedCb()
 
@@ -157,6 +299,36 @@ class MqttClient:
             if self.mqttPublishCb != None:
                 self.mqttPublishCb(topic, Data['Payload'])
 
+# Parsed Options['config'] of a device
+class DeviceConfig:
+    __slots__ = ('meter_type', 'availability_topic', 'payload_available', 'payload_not_available',
+                 'state_topic', 'result_topic', 'tasmota_tele_topic', 'cmnd_topic', 'configdict')
+
+    def __init__(self, configdict):
+        self.meter_type = configdict.get('meter_type')
+        self.availability_topic = configdict.get('availability_topic')
+        self.payload_available = configdict.get('payload_available')
+        self.payload_not_available = configdict.get('payload_not_available')
+        self.state_topic = configdict.get('state_topic')
+        self.result_topic = configdict.get('result_topic')
+        self.tasmota_tele_topic = configdict.get('tasmota_tele_topic')
+        self.cmnd_topic = configdict.get('cmnd_topic')
+        self.configdict = configdict
+
+    # Returns list of (topic, role), e.g. ('tasmota/x/tele/RESULT', 'result_topic')
+    def topics(self):
+        return [(topic, role) for role, topic in self.configdict.items() if role.endswith('_topic') and isinstance(topic, str)]
+
+    # Returns list of topics to subscribe to, all Tasmota stat topics instead of the state_topic
+    def subscriptions(self):
+        topics = [topic for topic in (self.availability_topic, self.state_topic, self.result_topic) if isinstance(topic, str)]
+        if isinstance(self.tasmota_tele_topic, str):
+            levels = ['stat' if level == 'tele' else level for level in self.tasmota_tele_topic.split('/')]
+            if levels[-1] == 'STATE':
+                levels[-1] = '#'
+            topics.append('/'.join(levels))
+        return topics
+
 class BasePlugin:
     # MQTT settings
     mqttClient = None
@@ -165,10 +337,55 @@ class BasePlugin:
     debugging = "Normal"
     cachedDeviceNames = {}
     lastDeviceResponse = {}
-    readQueue = {}
+    reassemblers = {}       # topic -> kmp.FrameReassembler, partially received frames
+    pendingUpdates = {}     # unit -> {attribute: value}, written by flushUpdates
+    pendingTriggers = set() # units with pending updates which must not suppress triggers
+    lastUpdate = {}         # unit -> time of last device.Update
+    registerValues = {}     # (unit, reg) -> last value passed to the device
+    deadbands = {}          # reg -> (absolute, relative)
+    meterPoller = poller.MeterPoller() # Poll schedule and outstanding KMP request per unit
+    meterTypes = {}         # GetType id -> meter type, see registermap.py
+    heartbeatInterval = 1   # Request timeouts are checked every heartbeat
+    connectionCheckInterval = 10
+    lastConnectionCheck = 0
+    topicIndex = {}         # topic -> [(unit, role)], e.g. role 'result_topic'
+    unitTopics = {}         # unit -> [(topic, role)]
+    configCache = {}        # unit -> DeviceConfig, None if the device has no valid config
+    subscriptions = subscriptions.SubscriptionManager() # Topics per unit, synced every heartbeat
+    identities = identity.IdentityStore() # Meter per device topic, persisted in the plugin folder
+    discoveries = {}        # device topic -> (time of next GetType, retry delay)
+    devicetopicSet = set()  # Parameters["Mode2"] as a set, messages of unknown topics are checked against it
+    seriesConfig = {}       # reg -> (capacity, aggregate, spill capacity)
+    series = {}             # (unit, reg) -> timeseries.TimeSeries, readings between device updates
+    metrics = metrics.Metrics()
+    lastMetricsReport = 0
 
     options = {"updateRSSI":False,             # Store Tasmota RSSI
-               "updateVCC":False}              # Store Tasmota VCC as battery level
+               "updateVCC":False,              # Store Tasmota VCC as battery level
+               "registersPerRequest":kmp.MAX_REGISTERS_PER_REQUEST, # Registers read by a single GetRegister
+               "pollIntervals":{},             # Poll interval in seconds per register, e.g. {"80": 30}
+               "adaptivePolling":{},           # Min and max poll interval per register, e.g. {"80": {"min": 5, "max": 300}}, or per device topic
+               "adaptiveThreshold":0.05,       # Relative change between two readings which polls a register at its minimum interval
+               "requestTimeout":2.0,           # Seconds to wait for a KMP response
+               "requestRetries":2,             # Number of times a KMP request is resent
+               "updateInterval":10,            # Minimum seconds between updates of a device
+               "deadbands":{},                 # Minimum change per register, e.g. {"80": {"abs": 0.1, "rel": 0.02}}
+               "meterTypes":{},                # Meter type per GetType id, e.g. {"0x4401": "kamstrup_602_heat"}, only the MC402 map is verified
+               "subscriptionWildcards":0,      # Subscribe to a '+' wildcard topic for at least this many similar topics, 0 disables it
+               "discoveryInterval":600,        # Maximum seconds between GetType requests to an unknown meter
+               "statusRefreshInterval":3600,   # Minimum seconds between Status queries to a Tasmota device
+               "clientId":"",                  # MQTT client ID, "" for Domoticz_<Key>_<HardwareID>
+               "cleanSession":True,            # False keeps the subscriptions at the broker while disconnected
+               "subscribeQoS":0,               # QoS of the subscriptions, 1 with cleanSession false to receive messages sent while disconnected
+               "keepalive":60,                 # MQTT keepalive in seconds
+               "reconnectDelay":1,             # Seconds before the first reconnect attempt, doubled per attempt, with jitter
+               "reconnectMaxDelay":300,        # Maximum seconds between reconnect attempts
+               "timeseries":{},                # Keep readings per register and pass their min, max, avg or last value per update interval to the device,
+                                               # e.g. {"80": {"capacity": 360, "aggregate": "avg", "spill": 8640}}, spill readings are kept in a file
+               "capture":"",                   # Record the MQTT messages sent and received to this file, relative to the plugin folder, "" disables it
+               "captureMaxBytes":100000000,    # Size at which the capture file is renamed to <capture>.1 and a new one started, 0 disables it
+               "metricsInterval":300,          # Seconds between metrics reports, 0 disables them
+               "metricsTopic":""}              # Retained metrics topic, "" for domoticz/<Key>_<HardwareID>/metrics, null disables it
 
     def copyDevices(self):
         for k, Device in Devices.items():
@@ -180,7 +397,59 @@ class BasePlugin:
             name = Devices[unit].Name
         return format(unit, '03d') + "/" + name
 
+    # Returns the parsed config of a device, parsed once and cached until invalidated
+    def getConfig(self, unit):
+        try:
+            return self.configCache[unit]
+        except KeyError:
+            pass
+        config = None
+        if unit in Devices:
+            try:
+                configdict = json.loads(Devices[unit].Options['config'])
+                if isinstance(configdict, dict):
+                    config = DeviceConfig(configdict)
+            except (ValueError, KeyError, TypeError) as e:
+                pass
+            self.configCache[unit] = config
+        return config
+
+    # Must be called when a device's Options may have changed
+    def invalidateConfig(self, unit):
+        self.configCache.pop(unit, None)
+
+    # Add or refresh the routing entries of a device
+    def indexDevice(self, unit):
+        self.unindexDevice(unit)
+        config = self.getConfig(unit)
+        if config is None:
+            return
+        routes = config.topics()
+        for topic, role in routes:
+            self.topicIndex.setdefault(topic, []).append((unit, role))
+        self.unitTopics[unit] = routes
+        self.subscriptions.set(unit, config.subscriptions())
+
+    def unindexDevice(self, unit):
+        self.subscriptions.discard(unit)
+        for topic, role in self.unitTopics.pop(unit, ()):
+            routes = self.topicIndex.get(topic)
+            if routes is None:
+                continue
+            routes.remove((unit, role))
+            if not routes:
+                del self.topicIndex[topic]
+
+    def buildTopicIndex(self):
+        self.topicIndex.clear()
+        self.unitTopics.clear()
+        self.configCache.clear()
+        for unit in Devices:
+            self.indexDevice(unit)
+
     def getUnit(self, device):
+        if getattr(device, 'Unit', None) in Devices and Devices[device.Unit] is device:
+            return device.Unit
         unit = -1
         for k, dev in Devices.items():
             if dev == device:
@@ -191,6 +460,7 @@ class BasePlugin:
 
         # Parse options
         self.debugging = Parameters["Mode6"]
+        log.configure(self.debugging)
         DumpConfigToLog()
         if self.debugging == "Verbose+":
             Domoticz.Debugging(2+4+8+16+64)
@@ -201,6 +471,7 @@ class BasePlugin:
         self.mqttserveraddress = Parameters["Address"].replace(" ", "")
         self.mqttserverport = Parameters["Port"].replace(" ", "")
         self.devicetopics = Parameters["Mode2"].split(',')
+        self.devicetopicSet = set(self.devicetopics)
 
         options = ""
         try:
@@ -211,21 +482,75 @@ class BasePlugin:
         if type(options) == str or type(options) == int:
             Domoticz.Log("Warning: could not load plugin options '" + Parameters["Mode3"] + "' as JSON object")
         elif type(options) == dict:
-            self.options.add(options)
+            self.options.update(options)
         Domoticz.Log("Plugin options: " + str(self.options))
 
+        self.deadbands = {}
+        try:
+            for reg, band in self.options['deadbands'].items():
+                self.deadbands[int(reg)] = (Decimal(str(band.get('abs', 0))), Decimal(str(band.get('rel', 0))))
+        except (ValueError, TypeError, AttributeError, InvalidOperation) as e:
+            Domoticz.Error("Invalid deadbands option: " + str(e))
+
+        self.seriesConfig = {}
+        try:
+            for reg, spec in self.options['timeseries'].items():
+                aggregate = spec.get('aggregate', 'avg')
+                if aggregate not in timeseries.AGGREGATES:
+                    raise ValueError("unknown aggregate '" + str(aggregate) + "'")
+                self.seriesConfig[int(reg)] = (max(1, int(spec.get('capacity', 360))), aggregate, max(0, int(spec.get('spill', 0))))
+        except (ValueError, TypeError, AttributeError) as e:
+            Domoticz.Error("Invalid timeseries option: " + str(e))
+
+        try:
+            self.meterTypes = registermap.type_ids(self.options['meterTypes'])
+        except (ValueError, TypeError, AttributeError) as e:
+            Domoticz.Error("Invalid meterTypes option: " + str(e))
+            self.meterTypes = registermap.type_ids()
+
+        self.meterPoller = poller.MeterPoller(int(self.options['registersPerRequest']), float(self.options['requestTimeout']), int(self.options['requestRetries']),
+                                              float(self.options['adaptiveThreshold']))
+
+        self.identities = identity.IdentityStore(os.path.join(Parameters['HomeFolder'], 'meters_' + str(Parameters['HardwareID']) + '.json'))
+        try:
+            self.identities.load()
+            Domoticz.Log("Loaded " + str(len(self.identities)) + " meter identities from " + self.identities.path)
+        except (OSError, ValueError, TypeError) as e:
+            Domoticz.Error("Could not load meter identities: " + str(e))
+
+        # Responses of the configured meters, device topics are added by indexDevice
+        self.subscriptions = subscriptions.SubscriptionManager(int(self.options['subscriptionWildcards'] or 0))
+        self.subscriptions.set('meters', [devicetopic + '/tele/RESULT' for devicetopic in self.devicetopics])
+
         # Enable heartbeat
-        Domoticz.Heartbeat(10)
+        Domoticz.Heartbeat(self.heartbeatInterval)
 
         # Connect to MQTT server
         self.prefixpos = 0
         self.topicpos = 0
-        self.mqttClient = MqttClient(self.mqttserveraddress, self.mqttserverport, self.onMQTTConnected, self.onMQTTDisconnected, self.onMQTTPublish, self.onMQTTSubscribed)
+        clientID = self.options['clientId'] or 'Domoticz_'+Parameters['Key']+'_'+str(Parameters['HardwareID'])
+        backoff = Backoff(float(self.options['reconnectDelay']), float(self.options['reconnectMaxDelay']))
+        self.mqttClient = MqttClient(self.mqttserveraddress, self.mqttserverport, self.onMQTTConnected, self.onMQTTDisconnected, self.onMQTTPublish, self.onMQTTSubscribed,
+                                     clientID, int(self.options['keepalive']), bool(self.options['cleanSession']), backoff)
+        if self.options['capture']:
+            path = os.path.join(Parameters['HomeFolder'], self.options['capture'])
+            try:
+                self.mqttClient.recorder = recording.Recorder(path, int(self.options['captureMaxBytes'] or 0))
+                Domoticz.Log("Recording MQTT messages to " + path)
+            except (OSError, ValueError) as e:
+                Domoticz.Error("Could not open capture file: " + str(e))
 
         #for devicetopic in self.devicetopics:
         #    self.updateDeviceSettings('Meter', devicetopic)
 
         self.copyDevices()
+        self.buildTopicIndex()
+
+    def onStop(self):
+        self.flushUpdates(time.time(), True)
+        self.closeSeries()
+        self.mqttClient.Close()
+        self.mqttClient.StopRecording()
 
     def onConnect(self, Connection, Status, Description):
         self.mqttClient.onConnect(Connection, Status, Description)
@@ -237,12 +562,16 @@ class BasePlugin:
         self.mqttClient.onMessage(Connection, Data)
 
     def onMQTTConnected(self):
-        Domoticz.Debug("onMQTTConnected")
-        self.mqttClient.Subscribe(self.getTopics())
+        log.debug("onMQTTConnected")
+        if not self.mqttClient.sessionPresent:
+            # New session, nothing is subscribed
+            self.subscriptions.reset()
+        self.syncSubscriptions()
 
     def onMQTTDisconnected(self):
-        Domoticz.Debug("onMQTTDisconnected")
+        log.debug("onMQTTDisconnected")
 
+    @timed('onMQTTPublish')
     def onMQTTPublish(self, topic, rawmessage):
         message = ""
         try:
@@ -253,23 +582,24 @@ class BasePlugin:
             except UnicodeDecodeError:
                 pass
         topiclist = topic.split('/')
-        if self.debugging == "Verbose" or self.debugging == "Verbose+":
+        if log.verboseEnabled:
             DumpMQTTMessageToLog(topic, rawmessage, 'onMQTTPublish: ')
 
         if 1 > 0:
-            matchingDevices = self.getDevices(topic=topic)
-            if not matchingDevices:
+            routes = self.topicIndex.get(topic)
+            if not routes:
                 self.addKMPDevice(topic, message)
             else:
-                for device in matchingDevices:
-                    # Try to update availability
-                    self.updateAvailability(device, topic, message)
-
-                    # Try to update tasmota status
-                    self.updateTasmotaStatus(device, topic, message)
-
-                    # Try to update register values
-                    self.updateKMPDevice(device, topic, message)
+                for unit, role in routes:
+                    device = Devices.get(unit)
+                    if device is None:
+                        continue
+                    if role == 'availability_topic':
+                        self.updateAvailability(device, message)
+                    elif role == 'tasmota_tele_topic':
+                        self.updateTasmotaStatus(device, message)
+                    elif role == 'result_topic':
+                        self.updateKMPDevice(device, message)
 
             # Special handling of Tasmota STATE message
         #    topic2, matches = re.subn(r"\/STATUS\d+$", '/STATE', topic)
@@ -281,21 +611,31 @@ class BasePlugin:
                         # Try to update tasmota settings
         #                self.updateTasmotaSettings(device, topic, message)
 
+    # The time of the last Status queries is persisted with the meter
+    # identity, so after a restart only devices which were not queried for
+    # statusRefreshInterval are queried
     def onMQTTSubscribed(self):
         # (Re)subscribed, refresh device info
-        Domoticz.Debug("onMQTTSubscribed");
-        matchingDevices = self.getDevices(hasconfigkey='tasmota_tele_topic')
+        log.debug("onMQTTSubscribed")
+        now = time.time()
         topics = set()
-        for device in matchingDevices:
+        for unit in Devices:
+            config = self.getConfig(unit)
+            if config is None or config.tasmota_tele_topic is None:
+                continue
             # Refresh Tasmota specific data
-            try:
-                configdict = json.loads(device.Options['config'])
-                cmnd_topic = configdict['cmnd_topic']
-                if cmnd_topic not in topics: self.refreshConfiguration(cmnd_topic)
-                topics.add(cmnd_topic)
-            except (ValueError, KeyError, TypeError) as e:
-                #Domoticz.Error("onMQTTSubscribed: Error: " + str(e))
-                Domoticz.Error(traceback.format_exc())
+            cmnd_topic = config.cmnd_topic
+            if cmnd_topic is None:
+                Domoticz.Error("onMQTTSubscribed: Error: " + self.deviceStr(unit) + " has no cmnd_topic")
+                continue
+            devicetopic = cmnd_topic.rsplit('/', 1)[0]
+            known = self.identities.get(devicetopic)
+            refreshed = known.status_refreshed if known is not None and known.status_refreshed is not None else 0
+            if cmnd_topic not in topics and now - refreshed >= float(self.options['statusRefreshInterval']):
+                self.identities.update(devicetopic, now, status_refreshed=now)
+                self.refreshConfiguration(cmnd_topic)
+            topics.add(cmnd_topic)
+        self.saveIdentities()
 
     def onCommand(self, Unit, Command, Level, sColor):
         Domoticz.Log("onCommand " + self.deviceStr(Unit) + ": Command: '" + str(Command) + "', Level: " + str(Level) + ", Color:" + str(sColor));
@@ -303,65 +643,189 @@ class BasePlugin:
     def onDeviceAdded(self, Unit):
         Domoticz.Log("onDeviceAdded " + self.deviceStr(Unit))
         self.copyDevices()
-        #TODO: Update subscribed topics
+        self.indexDevice(Unit)
 
     def onDeviceModified(self, Unit):
         Domoticz.Log("onDeviceModified " + self.deviceStr(Unit))
+        self.invalidateConfig(Unit)
 
         if Unit in Devices and Devices[Unit].Name != self.cachedDeviceNames[Unit]:
             Domoticz.Log("Device name changed, new name: " + Devices[Unit].Name + ", old name: " + self.cachedDeviceNames[Unit])
             Device = Devices[Unit]
 
             try:
-                configdict = json.loads(Device.Options['config'])
-                if "tasmota_tele_topic" in configdict and Device.SwitchType != 9: # Do not set friendly name for button, they don't have their own friendly name
+                config = self.getConfig(Unit)
+                if config is not None and config.tasmota_tele_topic is not None and Device.SwitchType != 9: # Do not set friendly name for button, they don't have their own friendly name
                     #Tasmota device!
                     device_nbr = ''
                     m = re.match(r".*_(\d)$", str(Device.Options['devicename']))
                     if m:
                         device_nbr = m.group(1)
-                    cmnd_topic = configdict['cmnd_topic']
+                    cmnd_topic = config.configdict['cmnd_topic']
                     self.mqttClient.Publish(cmnd_topic+'/FriendlyName'+str(device_nbr), Device.Name)
             except (ValueError, KeyError, TypeError) as e:
-                Domoticz.Debug("onDeviceModified: Error: " + str(e))
+                log.debug("onDeviceModified: Error: %s", e)
                 pass
 
         self.copyDevices()
+        self.indexDevice(Unit)
 
     def onDeviceRemoved(self, Unit):
         Domoticz.Log("onDeviceRemoved " + self.deviceStr(Unit))
         self.copyDevices()
-        #TODO: Update subscribed topics
-
+        self.unindexDevice(Unit)
+        self.invalidateConfig(Unit)
+        self.meterPoller.remove_meter(Unit)
+        self.closeSeries(Unit)
+        self.pendingUpdates.pop(Unit, None)
+        self.pendingTriggers.discard(Unit)
+
+    @timed('onHeartbeat')
     def onHeartbeat(self):
-        Domoticz.Debug("Heartbeating...")
+        now = time.time()
+        self.mqttClient.Check(now)
+        if now - self.lastConnectionCheck >= self.connectionCheckInterval:
+            self.lastConnectionCheck = now
+            self.checkConnection(now)
 
-        # Reconnect if connection has dropped
-        if self.mqttClient.mqttConn is None or (not self.mqttClient.mqttConn.Connecting() and not self.mqttClient.mqttConn.Connected() or not self.mqttClient.isConnected):
-            Domoticz.Debug("Reconnecting")
-            self.mqttClient.Open()
-        else:
-            self.mqttClient.Ping()
+        if self.mqttClient.isConnected:
+            self.syncSubscriptions()
+            self.checkRequests(now)
+
+        self.flushUpdates(now)
+        self.mqttClient.FlushRecording()
 
+        interval = self.options['metricsInterval']
+        if interval and now - self.lastMetricsReport >= interval:
+            self.lastMetricsReport = now
+            self.reportMetrics()
+
+    def checkConnection(self, now):
+        log.debug("Heartbeating...")
+
+        # Reconnecting is left to MqttClient.Check
+        if self.mqttClient.isConnected:
             for devicetopic in self.devicetopics:
                 cmnd_topic = devicetopic+'/cmnd'
-                matchingDevices = self.getDevices(topic=cmnd_topic)
-                if not matchingDevices:
-                    Domoticz.Log("Meter with topic '" + devicetopic + "' is unknown, trying to identify meter")
-                    self.getType(cmnd_topic)
-
-            for k, device in Devices.items():
-                if not k in self.readQueue or not self.readQueue[k] or not k in self.lastDeviceResponse or time.time()-self.lastDeviceResponse[k] > 60:
-                    configdict = json.loads(device.Options['config'])
-                    if configdict['meter_type'] == 'kamstrup_402_heat':
-                        self.readQueue[k] = list(self.kamstrup_402_var.keys())
-                        #self.setClock(device, 180808, 112500)
-                        nbr = self.readQueue[k].pop()
-                        self.getRegister(device, nbr)
+                if cmnd_topic not in self.topicIndex:
+                    self.discoverMeter(devicetopic, now)
+
+            for k in Devices:
+                if k not in self.meterPoller:
+                    config = self.getConfig(k)
+                    if config is not None and config.meter_type in registermap.MAPS:
+                        self.meterPoller.add_meter(k, self.getPollSchedule(config.meter_type), now, self.getAdaptiveIntervals(config))
+                        self.checkIdentity(k, config, now)
+                        #self.setClock(Devices[k], 180808, 112500)
+
+    # Create the device of a meter without a device from its persisted
+    # identity, or send GetType with an increasing delay between attempts
+    def discoverMeter(self, devicetopic, now):
+        known = self.identities.get(devicetopic)
+        if known is not None and known.meter_type in registermap.MAPS:
+            regmap = registermap.MAPS[known.meter_type]
+            Domoticz.Log("Meter with topic '" + devicetopic + "' is a known " + regmap.name + ", creating device")
+            self.updateDeviceSettings('Meter', devicetopic, regmap.type_name, regmap.meter_type, regmap.switch_type)
+            return
+        (due, delay) = self.discoveries.get(devicetopic, (0, self.connectionCheckInterval))
+        if now < due:
+            return
+        Domoticz.Log("Meter with topic '" + devicetopic + "' is unknown, trying to identify meter")
+        self.getType(devicetopic + '/cmnd')
+        self.discoveries[devicetopic] = (now + delay, min(2 * delay, max(float(self.options['discoveryInterval']), self.connectionCheckInterval)))
+
+    # Record the identity of meters with a device, e.g. created before
+    # identities were persisted. A missing serial number is requested on the
+    # meter link, so it does not collide with a GetRegister request.
+    def checkIdentity(self, unit, config, now):
+        if config.cmnd_topic is None:
+            return
+        devicetopic = config.cmnd_topic.rsplit('/', 1)[0]
+        known = self.identities.update(devicetopic, now, meter_type=config.meter_type)
+        self.saveIdentities()
+        if known.serial_no is None:
+            t = self.meterPoller.command(unit, kmp.CID_GET_SERIAL_NO, now)
+            if t is not None:
+                self.sendRequest(unit, t.msg)
+
+    def saveIdentities(self):
+        try:
+            self.identities.save()
+        except OSError as e:
+            Domoticz.Error("Could not save meter identities: " + str(e))
+
+    # Retry timed out requests and poll meters with due registers
+    def checkRequests(self, now):
+        for (unit, status, t) in self.meterPoller.expire(now):
+            if unit not in Devices:
+                self.meterPoller.remove_meter(unit)
+            elif status == poller.MeterLink.RETRY:
+                log.debug("%s: Request timed out, retry %d", self.deviceStr(unit), t.attempts - 1)
+                self.sendRequest(unit, t.msg)
+            else:
+                Domoticz.Log(self.deviceStr(unit) + ": No response to request " + ("for registers " + str(list(t.regs)) if t.regs else "%02x" % t.cid) + " after " + str(t.attempts) + " attempts")
+
+        for k in self.meterPoller.ready(now):
+            self.pollMeter(k, now)
+
+    # Returns the poll schedule of a meter type, reg -> (interval, priority)
+    def getPollSchedule(self, meter_type):
+        schedule = registermap.MAPS[meter_type].poll
+        try:
+            return poller.poll_schedule(schedule, self.options['pollIntervals'])
+        except (ValueError, TypeError, AttributeError) as e:
+            Domoticz.Error("getPollSchedule: Error: invalid pollIntervals: " + str(e))
+        return dict(schedule)
+
+    # Returns reg -> (min, max) interval of the adaptively polled registers of a meter
+    def getAdaptiveIntervals(self, config):
+        topic = config.cmnd_topic.rsplit('/', 1)[0] if config.cmnd_topic else None
+        try:
+            return poller.adaptive_intervals(self.options['adaptivePolling'], topic)
+        except (ValueError, TypeError, AttributeError, KeyError) as e:
+            Domoticz.Error("getAdaptiveIntervals: Error: invalid adaptivePolling: " + str(e))
+        return {}
+
+    # Request the next batch of due registers of a meter
+    def pollMeter(self, unit, now):
+        if unit not in Devices:
+            self.meterPoller.remove_meter(unit)
+            return
+        request = self.meterPoller.request(unit, now)
+        if request is None:
+            return
+        (t, missed, due) = request
+        for reg, lateness in missed:
+            Domoticz.Log(self.deviceStr(unit) + ": Missed poll deadline of register " + str(reg) + " by " + str(int(lateness)) + "s")
+        self.metrics.meter(metrics.meter_key(self.getConfig(unit).cmnd_topic + '/serialsend4')).queue_depth.observe(due)
+        self.sendRequest(unit, t.msg)
+
+    # Log the metrics as a single JSON line and publish them on the retained metrics topic
+    def reportMetrics(self):
+        now = time.time()
+        snapshot = self.metrics.snapshot()
+        for unit, link in self.meterPoller.links.items():
+            config = self.getConfig(unit)
+            if config is None or config.cmnd_topic is None:
+                continue
+            meter = snapshot['meters'].setdefault(metrics.meter_key(config.cmnd_topic + '/serialsend4'), {})
+            meter['due_registers'] = self.meterPoller.scheduler.due_count(unit, now)
+            meter['outstanding'] = link.busy()
+            meter['retries'] = link.retried
+            meter['failures'] = link.failed
+            meter['unmatched'] = link.unmatched
+        payload = json.dumps(snapshot, sort_keys=True)
+        Domoticz.Log("Metrics: " + payload)
+
+        topic = self.options['metricsTopic']
+        if topic == "":
+            topic = "domoticz/" + Parameters['Key'] + "_" + str(Parameters['HardwareID']) + "/metrics"
+        if topic and self.mqttClient.isConnected:
+            self.mqttClient.Publish(topic, payload, 1)
 
     # Pull configuration and status from tasmota device
     def refreshConfiguration(self, Topic):
-        Domoticz.Debug("refreshConfiguration for device with topic: '" + Topic + "'");
+        log.debug("refreshConfiguration for device with topic: '%s'", Topic)
         # Refresh relay / dimmer configuration
         self.mqttClient.Publish(Topic+"/Status",'11')
         # Refresh sensor configuration
@@ -369,42 +833,20 @@ class BasePlugin:
         # Refresh IP configuration
         self.mqttClient.Publish(Topic+"/Status",'5')
 
-    # Returns list of topics to subscribe to
-    def getTopics(self):
-        topics = set()
-        for devicetopic in self.devicetopics:
-            topics.add(devicetopic + '/tele/RESULT')
-
-        for key,Device in Devices.items():
-            #Domoticz.Debug("getTopics: '" + str(Device.Options) +"'")
-            try:
-                configdict = json.loads(Device.Options['config'])
-                #Domoticz.Debug("getTopics: '" + str(configdict) +"'")
-                for key, value in configdict.items():
-                    #Domoticz.Debug("getTopics: key:'" + str(key) +"' value: '" + str(value) + "'")
-                    try:
-                        #if key.endswith('_topic'):
-                        if key == 'availability_topic' or key == 'state_topic' or key == 'result_topic':
-                            topics.add(value)
-                    except (TypeError) as e:
-                        Domoticz.Error("getTopics: Error: " + str(e))
-                        pass
-                if "tasmota_tele_topic" in configdict:
-                    #Subscribe to all Tasmota state topics
-                    state_topic = re.sub(r"^tele\/", "stat/", configdict['tasmota_tele_topic']) # Replace tele with stat
-                    state_topic = re.sub(r"\/tele\/", "/stat/", state_topic) # Replace tele with stat
-                    state_topic = re.sub(r"\/STATE", "/#", state_topic) # Replace '/STATE' with /#
-                    topics.add(state_topic)
-            except (ValueError, KeyError, TypeError) as e:
-                Domoticz.Error("getTopics: Error: " + str(e))
-                pass
-        Domoticz.Debug("getTopics: '" + str(topics) +"'")
-        Domoticz.Log("getTopics: '" + str(topics) +"'")
-        return list(topics)
+    # Send the subscription changes since the last call, batched in one SUBSCRIBE and UNSUBSCRIBE
+    @timed('syncSubscriptions')
+    def syncSubscriptions(self):
+        (subscribe, unsubscribe) = self.subscriptions.sync()
+        if unsubscribe:
+            Domoticz.Log("Unsubscribing: " + str(unsubscribe))
+            self.mqttClient.Unsubscribe(unsubscribe)
+        if subscribe:
+            Domoticz.Log("Subscribing: " + str(subscribe))
+            self.mqttClient.Subscribe(subscribe, int(self.options['subscribeQoS']))
 
     # Returns list of matching devices
     def getDevices(self, key='', configkey='', hasconfigkey='', value='', config='', topic='', type='', channel=''):
-        Domoticz.Debug("getDevices key: '" + key + "' configkey: '" + configkey + "' hasconfigkey: '" + hasconfigkey + "' value: '" + value + "' config: '" + config + "' topic: '" + topic + "'")
+        log.debug("getDevices key: '%s' configkey: '%s' hasconfigkey: '%s' value: '%s' config: '%s' topic: '%s'", key, configkey, hasconfigkey, value, config, topic)
         matchingDevices = set()
         if key != '':
             for k, Device in Devices.items():
@@ -415,20 +857,14 @@ class BasePlugin:
                     pass
         if configkey != '':
             for k, Device in Devices.items():
-                try:
-                    configdict = json.loads(Device.Options['config'])
-                    if configdict[configkey] == value:
-                        matchingDevices.add(Device)
-                except (ValueError, KeyError) as e:
-                    pass
+                config = self.getConfig(k)
+                if config is not None and config.configdict.get(configkey) == value:
+                    matchingDevices.add(Device)
         elif hasconfigkey != '':
             for k, Device in Devices.items():
-                try:
-                    configdict = json.loads(Device.Options['config'])
-                    if hasconfigkey in configdict:
-                        matchingDevices.add(Device)
-                except (ValueError, KeyError) as e:
-                    pass
+                config = self.getConfig(k)
+                if config is not None and hasconfigkey in config.configdict:
+                    matchingDevices.add(Device)
         elif config != '':
             for k, Device in Devices.items():
                 try:
@@ -437,15 +873,10 @@ class BasePlugin:
                 except KeyError:
                     pass
         elif topic != '':
-            for k, Device in Devices.items():
-                try:
-                    configdict = json.loads(Device.Options['config'])
-                    for key, value in configdict.items():
-                        if value == topic:
-                            matchingDevices.add(Device)
-                except (ValueError, KeyError) as e:
-                    pass
-        Domoticz.Debug("getDevices found " + str(len(matchingDevices)) + " devices")
+            for k, role in self.topicIndex.get(topic, ()):
+                if k in Devices:
+                    matchingDevices.add(Devices[k])
+        log.debug("getDevices found %d devices", len(matchingDevices))
         return list(matchingDevices)
 
     def makeDevice(self, devicename, TypeName, switchTypeDomoticz, config):
@@ -456,31 +887,35 @@ class BasePlugin:
         Options = {'config':json.dumps(config),'devicename':devicename}
         DeviceName = 'Meter'
         Domoticz.Device(Name=DeviceName, Unit=iUnit, TypeName=TypeName, Switchtype=switchTypeDomoticz, Options=Options, Used=True).Create()
+        self.indexDevice(iUnit)
 
-    def updateDeviceSettings(self, devicename, basetopic, TypeName, MeterType):
+    def updateDeviceSettings(self, devicename, basetopic, TypeName, MeterType, SwitchType=0):
         config = {"meter_type": MeterType, "availability_topic": basetopic+"/tele/LWT", "payload_available": "Online", "payload_not_available": "Offline", "state_topic": basetopic+"/stat/RESULT", "result_topic": basetopic+"/tele/RESULT", "tasmota_tele_topic": basetopic+"/tele/STATE", "cmnd_topic": basetopic+"/cmnd"}
         #Domoticz.Debug("updateDeviceSettings devicename: '" + devicename + "' devicetype: '" + devicetype + "' config: '" + str(config) + "'")
 
         Type = 0
         Subtype = 0
-        switchTypeDomoticz = 0 # OnOff
+        switchTypeDomoticz = SwitchType
         
-        matchingDevices = self.getDevices(key='devicename', value=devicename)
+        # The device of this meter, or a device with the same name which is
+        # not used by any of the configured meters
+        matchingDevices = self.getDevices(topic=config['cmnd_topic'])
+        if len(matchingDevices) == 0:
+            cmnd_topics = set(devicetopic+'/cmnd' for devicetopic in self.devicetopics)
+            matchingDevices = [device for device in self.getDevices(key='devicename', value=devicename)
+                               if self.getConfig(self.getUnit(device)) is None or self.getConfig(self.getUnit(device)).cmnd_topic not in cmnd_topics]
         if len(matchingDevices) == 0:
             Domoticz.Log("updateDeviceSettings: Did not find device with key='devicename', value = '" +  devicename + "'")
             # Unknown device
             Domoticz.Log("updateDeviceSettings: TypeName: '" + TypeName + "' Type: " + str(Type))
             self.makeDevice(devicename, TypeName, switchTypeDomoticz, config)
-            # Update subscription list
-            self.mqttClient.Subscribe(self.getTopics())
         else:
             # TODO: What do if len(matchingDevices) > 1?
             device = matchingDevices[0]
             oldconfigdict = {}
-            try:
-                oldconfigdict = json.loads(device.Options['config'])
-            except (ValueError, KeyError, TypeError) as e:
-                pass
+            oldconfig = self.getConfig(self.getUnit(device))
+            if oldconfig is not None:
+                oldconfigdict = oldconfig.configdict
             if oldconfigdict != config:
                 Domoticz.Log("updateDeviceSettings: " + self.deviceStr(self.getUnit(device)) + ": Device settings not matching, updating Options['config']")
                 Domoticz.Log("updateDeviceSettings: device.Options['config']: " + str(oldconfigdict) + " -> " + str(config))
@@ -490,377 +925,372 @@ class BasePlugin:
                 Options['config'] = json.dumps(config)
                 device.Update(nValue=nValue, sValue=sValue, Options=Options, SuppressTriggers=True)
                 self.copyDevices()
+                self.invalidateConfig(self.getUnit(device))
+                self.indexDevice(self.getUnit(device))
+                self.meterPoller.remove_meter(self.getUnit(device))
 
-    def updateAvailability(self, device, topic, message):
+    # Called for messages on the device's availability_topic
+    def updateAvailability(self, device, message):
         TimedOut=0
         updatedevice = False
 
-        try:
-            devicetopics=[]
-            configdict = json.loads(device.Options['config'])
-            for key, value in configdict.items():
-                if value == topic:
-                    devicetopics.append(key)
-            if "availability_topic" in devicetopics:
-                Domoticz.Debug("Got availability_topic")
-                payload = message
-                if payload == configdict["payload_available"]:
-                    updatedevice = True
-                    TimedOut = 0
-                if payload == configdict["payload_not_available"]:
-                    updatedevice = True
-                    TimedOut = 1
-                Domoticz.Debug("TimedOut: '" + str(TimedOut) + "'")
-        except (ValueError, KeyError) as e:
-            pass
-
-        if updatedevice:
-            nValue = device.nValue
-            sValue = device.sValue
-            Domoticz.Log(self.deviceStr(self.getUnit(device)) + ": Setting TimedOut: '" + str(TimedOut) + "'")
-            device.Update(nValue=nValue, sValue=sValue, TimedOut=TimedOut, SuppressTriggers=True)
-            self.copyDevices()
-
-    def updateTasmotaStatus(self, device, topic, message):
-        #Domoticz.Debug("updateTasmotaStatus topic: '" + topic + "' message: '" + str(message) + "'")
-        nValue = device.nValue
-        sValue = device.sValue
+        config = self.getConfig(self.getUnit(device))
+        if config is not None:
+            log.debug("Got availability_topic")
+            payload = message
+            if payload == config.payload_available:
+                updatedevice = True
+                TimedOut = 0
+            if payload == config.payload_not_available:
+                updatedevice = True
+                TimedOut = 1
+            log.debug("TimedOut: '%s'", TimedOut)
+
+        unit = self.getUnit(device)
+        if updatedevice and self.deviceValue(device, unit, 'TimedOut') != TimedOut:
+            log.debug("%s: Setting TimedOut: '%s'", lambda: self.deviceStr(unit), TimedOut)
+            self.queueUpdate(unit, TimedOut=TimedOut)
+
+    # Called for messages on the device's tasmota_tele_topic
+    def updateTasmotaStatus(self, device, message):
+        #Domoticz.Debug("updateTasmotaStatus message: '" + str(message) + "'")
+        unit = self.getUnit(device)
         updatedevice = False
         Vcc = 0
         RSSI = 0
 
         try:
-            devicetopics=[]
-            configdict = json.loads(device.Options['config'])
-            for key, value in configdict.items():
-                if value == topic:
-                    devicetopics.append(key)
-            if "tasmota_tele_topic" in devicetopics:
-                Domoticz.Debug("Got tasmota_tele_topic")
-                if "Vcc" in message and self.options['updateVCC']:
-                    Vcc = int(message["Vcc"]*10)
-                    Domoticz.Debug("Set battery level to: " + str(Vcc) + " was:" + str(device.BatteryLevel))
-                    updatedevice = True
-                if "Wifi" in message and "RSSI" in message["Wifi"] and self.options['updateRSSI']:
-                    RSSI = int(message["Wifi"]["RSSI"])
-                    Domoticz.Debug("Set SignalLevel to: " + str(RSSI) + " was:" + str(device.SignalLevel))
-                    updatedevice = True
-            if updatedevice and (device.SignalLevel != RSSI or device.BatteryLevel != Vcc):
-                Domoticz.Log(self.deviceStr(self.getUnit(device)) + ": Setting SignalLevel: '" + str(RSSI) + "', BatteryLevel: '" + str(Vcc) + "'")
-                device.Update(nValue=nValue, sValue=sValue, SignalLevel=RSSI, BatteryLevel=Vcc, SuppressTriggers=True)
-                self.copyDevices()
-        except (ValueError, KeyError) as e:
+            log.debug("Got tasmota_tele_topic")
+            if "Vcc" in message and self.options['updateVCC']:
+                Vcc = int(message["Vcc"]*10)
+                log.debug("Set battery level to: %s was:%s", Vcc, device.BatteryLevel)
+                updatedevice = True
+            if "Wifi" in message and "RSSI" in message["Wifi"] and self.options['updateRSSI']:
+                RSSI = int(message["Wifi"]["RSSI"])
+                log.debug("Set SignalLevel to: %s was:%s", RSSI, device.SignalLevel)
+                updatedevice = True
+            if updatedevice and (self.deviceValue(device, unit, 'SignalLevel') != RSSI or self.deviceValue(device, unit, 'BatteryLevel') != Vcc):
+                log.debug("%s: Setting SignalLevel: '%s', BatteryLevel: '%s'", lambda: self.deviceStr(unit), RSSI, Vcc)
+                self.queueUpdate(unit, SignalLevel=RSSI, BatteryLevel=Vcc)
+        except (ValueError, KeyError, TypeError) as e:
             pass
 
     def updateTasmotaSettings(self, device, topic, message):
-        Domoticz.Debug("updateTasmotaSettings " + self.deviceStr(self.getUnit(device)) + " topic: '" + topic + "' message: '" + str(message) + "'")
-        nValue = device.nValue
-        sValue = device.sValue
+        log.debug("updateTasmotaSettings %s topic: '%s' message: '%s'", lambda: self.deviceStr(self.getUnit(device)), topic, message)
+        unit = self.getUnit(device)
         updatedevice = False
         IPAddress = ""
         Description = ""
 
         try:
-            devicetopics=[]
-            configdict = json.loads(device.Options['config'])
+            configdict = self.getConfig(self.getUnit(device)).configdict
             if topic.endswith('STATUS5'):
                 if "StatusNET" in message and "IPAddress" in message["StatusNET"]:
                     IPAddress = message["StatusNET"]["IPAddress"]
                     Description = "IP: " + IPAddress + ", Topic: " + configdict['cmnd_topic']
                     updatedevice = True
-            if updatedevice and (device.Description != Description):
-                Domoticz.Log("updateTasmotaSettings updating description from: '" + device.Description + "' to: '" + Description + "'")
-                device.Update(nValue=nValue, sValue=sValue, Description=Description, SuppressTriggers=True)
-                self.copyDevices()
-        except (ValueError, KeyError) as e:
+            if updatedevice and (self.deviceValue(device, unit, 'Description') != Description):
+                log.debug("updateTasmotaSettings updating description from: '%s' to: '%s'", device.Description, Description)
+                self.queueUpdate(unit, Description=Description)
+        except (ValueError, KeyError, AttributeError) as e:
             pass
 
     def addKMPDevice(self, topic, message):
         basetopic = re.sub(r"\/tele\/RESULT", "", topic) # Remove '/tele/RESULT'
-        if basetopic in self.devicetopics:
+        if basetopic in self.devicetopicSet:
             if "SerialReceived" in message:
                 s = message["SerialReceived"]
                 if s == "06": # Acknowledge
-                    pass
-                else: # Parse KMP message
-                    b = self.recv(s)
-                    if b == None:
-                        pass
-                    elif b[0] == 0x01:   # GetType
+                    return
+                # Parse KMP message
+                for b in self.receiveFrames(topic, s):
+                    if b[0] == 0x01:   # GetType
                         Domoticz.Log("addKMPDevice: GetType response:")
-                        Domoticz.Log("b: " + ''.join('{:02x} '.format(x) for x in b))
+                        Domoticz.Log("b: " + str(Hex(b)))
                         meterType = b[1]<<8 | b[2]
-                        if meterType == 0x1101: # MC 402 – Heat
-                            self.updateDeviceSettings('Meter', basetopic, 'kWh', 'kamstrup_402_heat')
+                        if meterType in self.meterTypes:
+                            regmap = registermap.MAPS[self.meterTypes[meterType]]
+                            Domoticz.Log("addKMPDevice: " + regmap.name + " found on '" + basetopic + "'")
+                            if not regmap.verified:
+                                Domoticz.Log("Warning: the register map of the " + regmap.name + " is unverified, check the values against the meter")
+                            revision = b[3]<<8 | b[4] if len(b) >= 5 else None
+                            self.identities.update(basetopic, time.time(), type_id=meterType, revision=revision, meter_type=regmap.meter_type)
+                            self.saveIdentities()
+                            self.discoveries.pop(basetopic, None)
+                            self.updateDeviceSettings('Meter', basetopic, regmap.type_name, regmap.meter_type, regmap.switch_type)
                         else:
                             Domoticz.Log("Unknown Meter Type: "+'{:04x} '.format(meterType))
 
-    def updateKMPDevice(self, device, topic, message):
-        devicetopics=[]
-        configdict = json.loads(device.Options['config'])
-        for key, value in configdict.items():
-            if value == topic:
-                devicetopics.append(key)
-        if "result_topic" in devicetopics:
-            Domoticz.Debug("Got result_topic")
-            if "SerialReceived" in message:
-                self.lastDeviceResponse[self.getUnit(device)] = time.time()
-                s = message["SerialReceived"]
-                if s == "06": # Acknowledge
-                    Domoticz.Log("Got acknowledge: '" + s + "'")
-                else: # Parse KMP message
-                    b = self.recv(s)
-                    if b == None:
-                        pass
-                    elif b[0] == 0x01:   # GetType
-                        Domoticz.Log("GetType response:")
-                        Domoticz.Log("b: " + ''.join('{:02x} '.format(x) for x in b))
-                    elif b[0] == 0x02: # GetSerialNo
-                        Domoticz.Log("GetSerialNo response:")
-                        Domoticz.Log("b: " + ''.join('{:02x} '.format(x) for x in b))
-                    elif b[0] == 0x09: # SetClock
-                        Domoticz.Log("SetClock response:")
-                        Domoticz.Log("b: " + ''.join('{:02x} '.format(x) for x in b))
-                    elif b[0] == 0x10: # GetRegister
-                        (reg, x, u) = self.readvar(b);
-                        if True:
-                            # Debug print
-                            s = ""
-                            for i in b[:3]:
-                                s += " %02x" % i
-                            s += " |"
-                            for i in b[3:6]:
-                                s += " %02x" % i
-                            s += " |"
-                            for i in b[6:]:
-                                s += " %02x" % i
-
-                            regname = 'UNKNOWN'
-                            if reg in self.kamstrup_402_var: regname = self.kamstrup_402_var[reg]
-                            Domoticz.Debug(s + ' : ' + str(reg) + '(' + regname + ')' + '='+ str(x) + ' ' + self.units[b[3]])
-
-                        self.updateKMPRegister(device, reg, x, u)
-                    else:
-                        Domoticz.Log("Unknown response:")
-                        Domoticz.Log("b: " + ''.join('{:02x} '.format(x) for x in b))
-                if (self.getUnit(device) in self.readQueue and self.readQueue[self.getUnit(device)]):
-                    # Request next register
-                    reg = self.readQueue[self.getUnit(device)].pop()
-                    self.getRegister(device, reg)
-
-    def updateKMPRegister(self, device, reg, x, u):
-        nValue = device.nValue
-        sValue = device.sValue
-        updatedevice = False
-        if reg == 60: # TODO get from table..
-            sValues = [x.strip() for x in sValue.split(';')]
-            sValues[1] = str(x*1000*1000)
-            updatedevice = True
-            sValue=str(sValues[0] + '; ' + sValues[1])
-        if reg == 80: # TODO get from table..
-            sValues = [x.strip() for x in sValue.split(';')]
-            sValues[0] = str(x*1000)
-            updatedevice = True
-            sValue=str(sValues[0] + '; ' + sValues[1])
-        if updatedevice and (nValue != device.nValue or sValue != device.sValue):
-            Domoticz.Log(self.deviceStr(self.getUnit(device)) + " 'Setting nValue: " + str(device.nValue) + "->" + str(nValue) + ", sValue: '" + str(device.sValue) + "'->'" + str(sValue) + "'")
-            device.Update(nValue=nValue, sValue=sValue)
-            self.copyDevices()
-
-    units = {
-        0: '', 1: 'Wh', 2: 'kWh', 3: 'MWh', 4: 'GWh', 5: 'j', 6: 'kj', 7: 'Mj',
-        8: 'Gj', 9: 'Cal', 10: 'kCal', 11: 'Mcal', 12: 'Gcal', 13: 'varh',
-        14: 'kvarh', 15: 'Mvarh', 16: 'Gvarh', 17: 'VAh', 18: 'kVAh',
-        19: 'MVAh', 20: 'GVAh', 21: 'kW', 22: 'kW', 23: 'MW', 24: 'GW',
-        25: 'kvar', 26: 'kvar', 27: 'Mvar', 28: 'Gvar', 29: 'VA', 30: 'kVA',
-        31: 'MVA', 32: 'GVA', 33: 'V', 34: 'A', 35: 'kV',36: 'kA', 37: 'C',
-        38: 'K', 39: 'l', 40: 'm3', 41: 'l/h', 42: 'm3/h', 43: 'm3xC',
-        44: 'ton', 45: 'ton/h', 46: 'h', 47: 'hh:mm:ss', 48: 'yy:mm:dd',
-        49: 'yyyy:mm:dd', 50: 'mm:dd', 51: '', 52: 'bar', 53: 'RTC',
-        54: 'ASCII', 55: 'm3 x 10', 56: 'ton x 10', 57: 'GJ x 10',
-        58: 'minutes', 59: 'Bitfield', 60: 's', 61: 'ms', 62: 'days',
-        63: 'RTC-Q', 64: 'Datetime'
-    }
-    
-    kamstrup_402_var = {                # Decimal Number in Command
-        0x003C: "Heat Energy (E1)",         #60
-        0x0050: "Power",                   #80
-        #0x0056: "Temp1",                   #86
-        #0x0057: "Temp2",                   #87
-        #0x0059: "Tempdiff",                #89
-        #0x004A: "Flow",                    #74
-        #0x0044: "Volume",                  #68
-        #0x008D: "MinFlow_M",               #141
-        #0x008B: "MaxFlow_M",               #139
-        #0x008C: "MinFlowDate_M",           #140
-        #0x008A: "MaxFlowDate_M",           #138
-        #0x0091: "MinPower_M",              #145
-        #0x008F: "MaxPower_M",              #143
-        #0x0095: "AvgTemp1_M",              #149
-        #0x0096: "AvgTemp2_M",              #150
-        #0x0090: "MinPowerDate_M",          #144
-        #0x008E: "MaxPowerDate_M",          #142
-        #0x007E: "MinFlow_Y",               #126
-        #0x007C: "MaxFlow_Y",               #124
-        #0x007D: "MinFlowDate_Y",           #125
-        #0x007B: "MaxFlowDate_Y",           #123
-        #0x0082: "MinPower_Y",              #130
-        #0x0080: "MaxPower_Y",              #128
-        #0x0092: "AvgTemp1_Y",              #146
-        #0x0093: "AvgTemp2_Y",              #147
-        #0x0081: "MinPowerDate_Y",          #129
-        #0x007F: "MaxPowerDate_Y",          #127
-        #0x0061: "Temp1xm3",                #97
-        #0x006E: "Temp2xm3",                #110
-        #0x0071: "Infoevent",               #113
-        0x03EA: "Clock",                   #1002
-        0x03EB: "Date",                    #1003
-        #0x03EC: "HourCounter",             #1004
-    }
+    # Called for messages on the device's result_topic
+    def updateKMPDevice(self, device, message):
+        log.debug("Got result_topic")
+        if "SerialReceived" in message:
+            unit = self.getUnit(device)
+            now = time.time()
+            self.lastDeviceResponse[unit] = now
+            s = message["SerialReceived"]
+            if s == "06": # Acknowledge
+                log.debug("Got acknowledge: '%s'", s)
+                return
+            # Parse KMP messages, frames with errors are retried when the request times out
+            for b in self.receiveFrames(self.getConfig(unit).result_topic, s):
+                self.handleKMPResponse(device, unit, b, now)
+
+    # Handle a decoded response from a known meter
+    def handleKMPResponse(self, device, unit, b, now):
+        regs = ()
+        if b[0] == 0x01:   # GetType
+            Domoticz.Log("GetType response:")
+            Domoticz.Log("b: " + str(Hex(b)))
+        elif b[0] == 0x02: # GetSerialNo
+            if len(b) >= 5:
+                serial_no = int.from_bytes(b[1:5], 'big')
+                Domoticz.Log(self.deviceStr(unit) + ": Serial number " + str(serial_no))
+                self.identities.update(self.getConfig(unit).cmnd_topic.rsplit('/', 1)[0], now, serial_no=serial_no)
+                self.saveIdentities()
+            else:
+                Domoticz.Log("GetSerialNo response:")
+                Domoticz.Log("b: " + str(Hex(b)))
+        elif b[0] == 0x09: # SetClock
+            Domoticz.Log("SetClock response:")
+            Domoticz.Log("b: " + str(Hex(b)))
+        elif b[0] == 0x10: # GetRegister
+            regs = kmp.register_ids(b)
+            regmap = registermap.MAPS.get(self.getConfig(unit).meter_type)
+            try:
+                for (reg, m, e, u) in kmp.read_registers_fixed(b):
+                    log.debug("%d(%s)=%s %s", reg, lambda: regmap.names.get(reg, 'UNKNOWN') if regmap else 'UNKNOWN', lambda: kmp.fixed_value(m, e), u)
+                    interval = self.meterPoller.observe(unit, reg, kmp.fixed_value(m, e), now)
+                    if interval is not None:
+                        log.debug("%s: Poll register %d every %gs", lambda: self.deviceStr(unit), reg, interval)
+                    if regmap is not None:
+                        if reg in self.seriesConfig:
+                            (m, e) = self.downsample(unit, reg, m, e, now)
+                        self.updateKMPRegister(device, regmap, reg, m, e, u)
+            except kmp.KmpError as e:
+                Domoticz.Log("GetRegister response: Error: " + str(e))
+                Domoticz.Log("b: " + b.hex())
+        else:
+            Domoticz.Log("Unknown response:")
+            Domoticz.Log("b: " + str(Hex(b)))
+
+        t = self.meterPoller.complete(unit, b[0], regs)
+        if t is None:
+            log.debug("%s: Response does not match outstanding request", lambda: self.deviceStr(unit))
+            return
+        self.metrics.meter(metrics.meter_key(self.getConfig(unit).result_topic)).rtt.observe(now - t.started)
+        if self.meterPoller.due(unit, now):
+            # Request next batch of registers
+            self.pollMeter(unit, now)
 
     #######################################################################
-    # Kamstrup uses the "true" CCITT CRC-16
+    # Readings of the registers in the timeseries option are kept in a ring
+    # buffer, the device gets their aggregate since its last update
+    #
+    def getSeries(self, unit, reg):
+        series = self.series.get((unit, reg))
+        if series is None:
+            (capacity, aggregate, spill) = self.seriesConfig[reg]
+            spillBuffer = None
+            if spill:
+                path = os.path.join(Parameters['HomeFolder'], 'series_' + str(Parameters['HardwareID']) + '_' + str(unit) + '_' + str(reg) + '.kts')
+                try:
+                    spillBuffer = timeseries.MappedRingBuffer(path, spill)
+                except (OSError, ValueError) as e:
+                    Domoticz.Error(self.deviceStr(unit) + ": Could not open " + path + ": " + str(e))
+            series = self.series[(unit, reg)] = timeseries.TimeSeries(capacity, spillBuffer)
+        return series
+
+    # Record a reading m * 10**e, returns the aggregate of the readings since
+    # the last device update, at most an update interval, as (m, e). Averages
+    # get two more digits.
+    def downsample(self, unit, reg, m, e, now):
+        series = self.getSeries(unit, reg)
+        series.append(now, float(kmp.fixed_value(m, e)))
+        aggregate = self.seriesConfig[reg][1]
+        if aggregate == 'last':
+            return (m, e)
+        start = max(self.lastUpdate.get(unit, 0), now - float(self.options['updateInterval']))
+        x = series.aggregate(start, now + 1, aggregate)
+        return timeseries.to_fixed(x, e - 2 if aggregate == 'avg' else e)
+
+    def closeSeries(self, unit=None):
+        for key in [key for key in self.series if unit is None or key[0] == unit]:
+            spill = self.series.pop(key).spill
+            if spill is not None:
+                spill.close()
+
+    # The register value is m * 10**e, it is kept exact so counters do not
+    # drift and cause device updates by float rounding alone
+    def updateKMPRegister(self, device, regmap, reg, m, e, u):
+        scaled = regmap.scale(reg, m, e, u)
+        if scaled is None:
+            return
+        unit = self.getUnit(device)
+        x = kmp.fixed_value(m, e)
+        if not self.outsideDeadband(unit, reg, x):
+            return
+        (field, value) = scaled
+        nValue = self.deviceValue(device, unit, 'nValue')
+        sValue = self.deviceValue(device, unit, 'sValue')
+        sValues = [v.strip() for v in sValue.split(';')]
+        sValues += ['0'] * (len(regmap.fields) - len(sValues))
+        sValues[field] = registermap.format_value(value)
+        sValue = '; '.join(sValues)
+        self.registerValues[(unit, reg)] = x
+        if sValue != self.deviceValue(device, unit, 'sValue'):
+            log.debug("%s 'Setting nValue: %s->%s, sValue: '%s'->'%s'", lambda: self.deviceStr(unit), device.nValue, nValue, device.sValue, sValue)
+            self.queueUpdate(unit, True, nValue=nValue, sValue=sValue)
+
+    # Returns True if a register value changed more than its deadband since it was last passed to the device
+    def outsideDeadband(self, unit, reg, x):
+        last = self.registerValues.get((unit, reg))
+        if last is None:
+            return True
+        (absolute, relative) = self.deadbands.get(reg, (0, 0))
+        change = abs(x - last)
+        return change > 0 and change >= max(absolute, relative * abs(last))
+
+    #######################################################################
+    # Device updates are queued and written at most once per updateInterval
+    #
+    def queueUpdate(self, unit, triggers=False, **values):
+        pending = self.pendingUpdates.get(unit)
+        if pending is None:
+            pending = {}
+            self.pendingUpdates[unit] = pending
+        pending.update(values)
+        if triggers:
+            self.pendingTriggers.add(unit)
+
+    # Returns a device attribute, including queued updates
+    def deviceValue(self, device, unit, attribute):
+        pending = self.pendingUpdates.get(unit)
+        if pending is not None and attribute in pending:
+            return pending[attribute]
+        return getattr(device, attribute)
+
+    def flushUpdates(self, now, force=False):
+        interval = float(self.options['updateInterval'])
+        for unit in list(self.pendingUpdates):
+            if not force and now - self.lastUpdate.get(unit, 0) < interval:
+                continue
+            values = self.pendingUpdates.pop(unit)
+            triggers = unit in self.pendingTriggers
+            self.pendingTriggers.discard(unit)
+            device = Devices.get(unit)
+            if device is None:
+                continue
+            changed = dict((k, v) for k, v in values.items() if getattr(device, k) != v)
+            if not changed:
+                continue
+            Domoticz.Log(self.deviceStr(unit) + ": Updating " + ", ".join(k + ": '" + str(getattr(device, k)) + "'->'" + str(v) + "'" for k, v in changed.items()))
+            changed.setdefault('nValue', device.nValue)
+            changed.setdefault('sValue', device.sValue)
+            device.Update(SuppressTriggers=not triggers, **changed)
+            self.lastUpdate[unit] = now
+            self.cachedDeviceNames[unit] = device.Name
+
+    units = kmp.UNITS
+
+    #######################################################################
+    # Kamstrup uses the "true" CCITT CRC-16, see kmp.py
     #
     def crc_1021(self, message):
-        poly = 0x1021
-        reg = 0x0000
-        for byte in message:
-            mask = 0x80
-            while(mask > 0):
-                reg<<=1
-                if byte & mask:
-                    reg |= 1
-                mask>>=1
-                if reg & 0x10000:
-                    reg &= 0xffff
-                    reg ^= poly
-        return reg
+        return kmp.crc_1021(message)
 
     #######################################################################
     # Byte values which must be escaped before transmission
     #
-
-    escapes = {
-        0x06: True,
-        0x0d: True,
-        0x1b: True,
-        0x40: True,
-        0x80: True,
-    }
+    escapes = kmp.ESCAPES
 
     def send(self, pfx, msg, topic):
-        b = bytearray(msg)
-
-        b.append(0)
-        b.append(0)
-        c = self.crc_1021(b)
-        b[-2] = c >> 8
-        b[-1] = c & 0xff
-
-        c = bytearray()
-        c.append(pfx)
-        for i in b:
-            if i in self.escapes:
-                c.append(0x1b)
-                c.append(i ^ 0xff)
-            else:
-                c.append(i)
-        c.append(0x0d)
-        self.mqttClient.Publish(topic, c)
-
-    def recv(self, s):
-        b = bytearray()
-
-        # Parse hex string
-        for i in range(0, len(s), 2):
-            d = int(s[i:i+2], 16)
-            #if d == None:
-                #return None
-            #    Domoticz.Log("recv: Error")
-            if d == 0x40: # Start of message
-                b = bytearray()
-            b.append(d)
-            if d == 0x0d: # End of message
-                break
-        Domoticz.Debug("b: " + ''.join('{:02x} '.format(x) for x in b))
-        
-        # Discard start and stop
-        b = b[1:-1]
-        
-        # Destuffing
-        c = bytearray()
-        i = 0;
-        while i < len(b):
-            if b[i] == 0x1b:
-                v = b[i + 1] ^ 0xff
-                if v not in self.escapes:
-                    Domoticz.Log(
-                        "Missing Escape %02x" % v)
-                c.append(v)
-                i += 2
-            else:
-                c.append(b[i])
-                i += 1
-        
-        # CRC check
-        if self.crc_1021(c):
+        self.metrics.meter(metrics.meter_key(topic)).frames_sent += 1
+        self.mqttClient.Publish(topic, kmp.encode(pfx, msg))
+
+    # Returns the frames completed by a SerialReceived fragment received on topic
+    def receiveFrames(self, topic, s):
+        reassembler = self.reassemblers.get(topic)
+        if reassembler is None:
+            reassembler = kmp.FrameReassembler()
+            self.reassemblers[topic] = reassembler
+        try:
+            raws = reassembler.feed_hex(s)
+        except kmp.KmpError as e:
+            Domoticz.Log("recv: Error: " + str(e) + " '" + s + "'")
+            return []
+        frames = []
+        stats = self.metrics.meter(metrics.meter_key(topic))
+        for raw in raws:
+            b = self.recvFrame(raw, stats)
+            if b is not None:
+                frames.append(b)
+        return frames
+
+    def recv(self, s, topic='unknown/tele/RESULT'):
+        try:
+            raw = bytes.fromhex(s)
+        except ValueError as e:
+            Domoticz.Log("recv: Error: " + str(e) + " '" + s + "'")
+            return None
+        return self.recvFrame(raw, self.metrics.meter(metrics.meter_key(topic)))
+
+    # Decode a frame, stats is the MeterMetrics of the meter which sent it
+    def recvFrame(self, raw, stats):
+        stats.frames_received += 1
+        try:
+            b = kmp.decode(raw)
+        except kmp.KmpCrcError as e:
+            stats.crc_errors += 1
             Domoticz.Log("CRC error:")
-            Domoticz.Log("b: " + ''.join('{:02x} '.format(x) for x in b))
-            Domoticz.Log("c: " + ''.join('{:02x} '.format(x) for x in c))
+            Domoticz.Log("b: " + e.raw.hex())
+            Domoticz.Log("c: " + e.frame.hex())
+            return None
+        except kmp.KmpError as e:
+            stats.frame_errors += 1
+            Domoticz.Log("recv: Error: " + str(e) + " '" + raw.hex() + "'")
             return None
-        
-        # Discard address and CRC
-        c = c[1:-2]
-        
-        Domoticz.Debug("c: " + ''.join('{:02x} '.format(x) for x in c))
-        Domoticz.Debug("recv: Done " + str(c))
-        return c
 
-    def readvar(self, b):
-        reg = b[1]<<8 | b[2]
+        stats.missing_escapes += len(b.bad_escapes)
+        for v in b.bad_escapes:
+            Domoticz.Log(
+                "Missing Escape %02x" % v)
 
-        if b[3] in self.units:
-            u = self.units[b[3]]
-        else:
-            u = None
-
-        # Decode the mantissa
-        x = 0
-        for i in range(0,b[4]): # TODO: Check length of message
-            x <<= 8
-            x |= b[i + 6]
-
-        # Decode the exponent
-        i = b[5] & 0x3f
-        if b[5] & 0x40:
-            i = -i
-        i = math.pow(10,i)
-        if b[5] & 0x80:
-            i = -i
-        x *= i
+        log.debug("c: %s", b.hex)
+        return b
 
+    # Decode the first register value of a GetRegister response
+    def readvar(self, b):
+        (reg, x, u, i) = kmp.read_register(b)
         return (reg, x, u)
 
+    # Decode all register values of a GetRegister response
+    def readvars(self, b):
+        return kmp.read_registers(b)
+
     def getType(self, cmnd_topic):
         self.send(0x80, (0x3f, 0x01), cmnd_topic + '/serialsend4')
 
     def getSerialNo(self, device):
-        configdict = json.loads(device.Options['config'])
-        cmnd_topic = configdict['cmnd_topic']
+        cmnd_topic = self.getConfig(self.getUnit(device)).cmnd_topic
         self.send(0x80, (0x3f, 0x02), cmnd_topic + '/serialsend4')
 
     def setClock(self, device, date, time):
-        configdict = json.loads(device.Options['config'])
-        cmnd_topic = configdict['cmnd_topic']
+        cmnd_topic = self.getConfig(self.getUnit(device)).cmnd_topic
         self.send(0x80, (0x3f, 0x09, \
                   (date >> 24) & 0xff, (date >> 16) & 0xff, (date >> 8) & 0xff, date & 0xff, \
                   (time >> 24) & 0xff, (time >> 16) & 0xff, (time >> 8) & 0xff, time & 0xff), \
                   cmnd_topic + '/serialsend4')
 
     def getRegister(self, device, reg):
-        configdict = json.loads(device.Options['config'])
-        cmnd_topic = configdict['cmnd_topic']
-        self.send(0x80, (0x3f, 0x10, 0x01, reg >> 8, reg & 0xff), cmnd_topic + '/serialsend4')
+        self.getRegisters(device, (reg,))
+
+    def getRegisters(self, device, regs):
+        self.sendRequest(self.getUnit(device), kmp.get_register_request(regs))
+
+    def sendRequest(self, unit, msg):
+        cmnd_topic = self.getConfig(unit).cmnd_topic
+        self.send(0x80, msg, cmnd_topic + '/serialsend4')
 
         global _plugin
 _plugin = BasePlugin()
@@ -869,6 +1299,10 @@ def onStart():
     global _plugin
     _plugin.onStart()
 
+def onStop():
+    global _plugin
+    _plugin.onStop()
+
 def onConnect(Connection, Status, Description):
     global _plugin
     _plugin.onConnect(Connection, Status, Description)
@@ -0,0 +1,340 @@
+#           Meter polling
+#
+#           This module does not depend on Domoticz. Meters are identified by an
+#           opaque key (the Domoticz unit in the plugin), times are in seconds.
+#
+import heapq
+
+import kmp
+
+#######################################################################
+# Poll schedules
+#
+# Returns a copy of schedule with the intervals of the pollIntervals option,
+# e.g. {"80": 30}, registers which are not in schedule are polled last.
+# Raises ValueError, TypeError or AttributeError if intervals is invalid.
+def poll_schedule(schedule, intervals):
+    schedule = dict(schedule)
+    for reg, interval in intervals.items():
+        reg = int(reg)
+        priority = schedule[reg][1] if reg in schedule else len(schedule)
+        schedule[reg] = (float(interval), priority)
+    return schedule
+
+# Returns reg -> (min, max) interval of a meter from the adaptivePolling
+# option, e.g. {"80": {"min": 5, "max": 300}, "tasmota/meter_1": {"80": {...}}}.
+# Register keys apply to all meters, the settings under the meter's topic
+# override them. Raises ValueError, TypeError, AttributeError or KeyError if
+# settings is invalid.
+def adaptive_intervals(settings, topic=None):
+    intervals = {}
+    for reg, limits in settings.items():
+        if reg.isdigit():
+            intervals[int(reg)] = _interval_limits(reg, limits)
+    for reg, limits in settings.get(topic, {}).items() if topic is not None else ():
+        intervals[int(reg)] = _interval_limits(reg, limits)
+    return intervals
+
+def _interval_limits(reg, limits):
+    (low, high) = (float(limits['min']), float(limits['max']))
+    if not 0 < low <= high:
+        raise ValueError("register %s: expected 0 < min <= max" % reg)
+    return (low, high)
+
+# Adaptive poll interval of a register. A reading which changed by at least
+# threshold relative to the previous one resets the interval to its minimum,
+# every stable reading doubles it up to its maximum.
+class AdaptiveInterval:
+    __slots__ = ('low', 'high', 'interval', 'last')
+
+    def __init__(self, low, high, interval):
+        self.low = low
+        self.high = high
+        self.interval = float(min(high, max(low, interval)))
+        self.last = None                    # Previous reading
+
+    # Returns the new interval if it changed, else None
+    def observe(self, x, threshold):
+        last = self.last
+        self.last = x
+        if last is None:
+            return None
+        if abs(x - last) > threshold * abs(last):
+            interval = self.low
+        else:
+            interval = min(self.high, self.interval * 2)
+        if interval == self.interval:
+            return None
+        self.interval = interval
+        return interval
+
+#######################################################################
+# Per register polling schedule
+#
+# Each meter has a heap of (deadline, priority, reg), and the scheduler keeps
+# a heap of (deadline, meter) ordered by the earliest deadline of each meter.
+# Entries in the meter heap are removed lazily, a stale entry is one whose
+# deadline differs from the meter's current earliest deadline.
+#
+class MeterSchedule:
+    __slots__ = ('registers', 'heap', 'missed')
+
+    def __init__(self, registers, now):
+        self.registers = dict(registers)    # reg -> (interval, priority)
+        self.heap = [(now, priority, reg) for reg, (interval, priority) in self.registers.items()]
+        heapq.heapify(self.heap)
+        self.missed = {}                    # reg -> number of missed deadlines
+
+    def deadline(self):
+        return self.heap[0][0] if self.heap else None
+
+class PollScheduler:
+    def __init__(self):
+        self.meters = {}        # meter -> MeterSchedule
+        self.heap = []          # (deadline, meter)
+
+    def __contains__(self, meter):
+        return meter in self.meters
+
+    # registers: reg -> (interval, priority), lower priority value is polled first.
+    # All registers are due immediately.
+    def add_meter(self, meter, registers, now):
+        schedule = MeterSchedule(registers, now)
+        self.meters[meter] = schedule
+        self._arm(meter, schedule)
+
+    def remove_meter(self, meter):
+        self.meters.pop(meter, None)
+
+    # Change the interval of a register, the next deadline is moved accordingly
+    def set_interval(self, meter, reg, interval, now):
+        schedule = self.meters[meter]
+        (old, priority) = schedule.registers[reg]
+        schedule.registers[reg] = (interval, priority)
+        for i, (deadline, p, r) in enumerate(schedule.heap):
+            if r == reg:
+                schedule.heap[i] = (max(now, deadline - old + interval), p, r)
+                heapq.heapify(schedule.heap)
+                break
+        self._arm(meter, schedule)
+
+    def deadline(self, meter):
+        schedule = self.meters.get(meter)
+        return schedule.deadline() if schedule else None
+
+    # Number of registers of a meter which are due
+    def due_count(self, meter, now):
+        schedule = self.meters.get(meter)
+        if schedule is None:
+            return 0
+        return sum(1 for deadline, priority, reg in schedule.heap if deadline <= now)
+
+    # Returns the meters which have registers due, earliest deadline first.
+    # Meters stay due until their registers are taken.
+    def due_meters(self, now):
+        meters = []
+        seen = set()
+        while self.heap and self.heap[0][0] <= now:
+            (deadline, meter) = heapq.heappop(self.heap)
+            schedule = self.meters.get(meter)
+            if meter in seen or schedule is None or schedule.deadline() != deadline:
+                continue # Stale
+            seen.add(meter)
+            meters.append((deadline, meter))
+        for entry in meters:
+            heapq.heappush(self.heap, entry)
+        return [meter for deadline, meter in meters]
+
+    # Take up to limit due registers of a meter, highest priority first, and
+    # schedule their next poll.
+    # Returns (regs, missed) where missed is a list of (reg, lateness) for
+    # registers which were due more than one interval ago.
+    def take(self, meter, now, limit):
+        schedule = self.meters[meter]
+        due = []
+        while schedule.heap and schedule.heap[0][0] <= now:
+            due.append(heapq.heappop(schedule.heap))
+        due.sort(key=lambda entry: (entry[1], entry[0]))
+        for entry in due[limit:]:
+            heapq.heappush(schedule.heap, entry)
+
+        regs = []
+        missed = []
+        for (deadline, priority, reg) in due[:limit]:
+            interval = schedule.registers[reg][0]
+            lateness = now - deadline
+            periods = int(lateness // interval) if interval > 0 else 0
+            if periods > 0:
+                schedule.missed[reg] = schedule.missed.get(reg, 0) + periods
+                missed.append((reg, lateness))
+            heapq.heappush(schedule.heap, (deadline + (periods + 1) * interval, priority, reg))
+            regs.append(reg)
+        self._arm(meter, schedule)
+        return (regs, missed)
+
+    def _arm(self, meter, schedule):
+        deadline = schedule.deadline()
+        if deadline is not None:
+            heapq.heappush(self.heap, (deadline, meter))
+
+#######################################################################
+# Request / response correlation
+#
+# A meter link has at most one outstanding request. A response matches it if
+# the command id is the same and, for GetRegister, every register in the
+# response was requested. Requests which are not answered within the
+# timeout are sent again, up to retries times, and then abandoned.
+#
+class Transaction:
+    __slots__ = ('cid', 'regs', 'msg', 'started', 'sent', 'attempts')
+
+    def __init__(self, cid, regs, msg, now):
+        self.cid = cid
+        self.regs = tuple(regs)
+        self.msg = msg
+        self.started = now      # Time of the first attempt
+        self.sent = now         # Time of the last attempt
+        self.attempts = 1
+
+class MeterLink:
+    # Results of check()
+    RETRY = 'retry'
+    FAILED = 'failed'
+
+    def __init__(self, timeout, retries):
+        self.timeout = timeout
+        self.retries = retries
+        self.transaction = None
+        self.retried = 0        # Number of resent requests
+        self.failed = 0         # Number of abandoned requests
+        self.unmatched = 0      # Number of responses which did not match
+
+    def busy(self):
+        return self.transaction is not None
+
+    def begin(self, cid, regs, msg, now):
+        self.transaction = Transaction(cid, regs, msg, now)
+        return self.transaction
+
+    # Match a response, returns the completed transaction or None
+    def match(self, cid, regs=()):
+        t = self.transaction
+        if t is None or t.cid != cid or not set(regs) <= set(t.regs):
+            self.unmatched += 1
+            return None
+        self.transaction = None
+        return t
+
+    # Check the outstanding request for a timeout.
+    # Returns (RETRY, transaction) if the request must be sent again,
+    # (FAILED, transaction) if it was abandoned, or None.
+    def check(self, now):
+        t = self.transaction
+        if t is None or now - t.sent < self.timeout:
+            return None
+        if t.attempts > self.retries:
+            self.transaction = None
+            self.failed += 1
+            return (self.FAILED, t)
+        t.attempts += 1
+        t.sent = now
+        self.retried += 1
+        return (self.RETRY, t)
+
+    def abort(self):
+        self.transaction = None
+
+#######################################################################
+# Polling of a set of meters over KMP
+#
+# Combines the schedule and a link per meter. Sending requests is left to the
+# caller: request() and expire() return the transactions to send.
+#
+class MeterPoller:
+    def __init__(self, registers_per_request=kmp.MAX_REGISTERS_PER_REQUEST, timeout=2.0, retries=2, threshold=0.05):
+        self.registers_per_request = registers_per_request
+        self.timeout = timeout
+        self.retries = retries
+        self.threshold = threshold  # Relative change of an adaptive register which is volatile
+        self.scheduler = PollScheduler()
+        self.links = {}         # meter -> MeterLink
+        self.adaptive = {}      # meter -> {reg: AdaptiveInterval}
+
+    def __contains__(self, meter):
+        return meter in self.scheduler
+
+    # adaptive: reg -> (min, max) interval of registers which are polled
+    # adaptively, registers which are not in registers are added to them.
+    def add_meter(self, meter, registers, now, adaptive=None):
+        registers = dict(registers)
+        intervals = {}
+        for reg, (low, high) in (adaptive or {}).items():
+            (interval, priority) = registers.get(reg, (high, len(registers)))
+            intervals[reg] = AdaptiveInterval(low, high, interval)
+            registers[reg] = (intervals[reg].interval, priority)
+        self.scheduler.add_meter(meter, registers, now)
+        self.links[meter] = MeterLink(self.timeout, self.retries)
+        if intervals:
+            self.adaptive[meter] = intervals
+
+    def remove_meter(self, meter):
+        self.scheduler.remove_meter(meter)
+        self.links.pop(meter, None)
+        self.adaptive.pop(meter, None)
+
+    # Adapt the poll interval of a register to a new reading x. Returns the
+    # new interval if it changed, else None.
+    def observe(self, meter, reg, x, now):
+        adaptive = self.adaptive.get(meter)
+        if adaptive is None or reg not in adaptive:
+            return None
+        interval = adaptive[reg].observe(float(x), self.threshold)
+        if interval is not None and meter in self.scheduler:
+            self.scheduler.set_interval(meter, reg, interval, now)
+        return interval
+
+    # Returns a list of (meter, status, transaction) for requests which timed
+    # out, status is MeterLink.RETRY or MeterLink.FAILED
+    def expire(self, now):
+        expired = []
+        for meter, link in self.links.items():
+            result = link.check(now)
+            if result is not None:
+                expired.append((meter, result[0], result[1]))
+        return expired
+
+    # Returns the meters with due registers and no outstanding request
+    def ready(self, now):
+        return [meter for meter in self.scheduler.due_meters(now) if not self.links[meter].busy()]
+
+    # True if the meter has due registers
+    def due(self, meter, now):
+        deadline = self.scheduler.deadline(meter)
+        return deadline is not None and deadline <= now
+
+    # Start a GetRegister request for the next batch of due registers.
+    # Returns (transaction, missed, due) or None if no registers are due,
+    # missed is as returned by PollScheduler.take and due is the number of
+    # registers which were due.
+    def request(self, meter, now):
+        due = self.scheduler.due_count(meter, now)
+        (regs, missed) = self.scheduler.take(meter, now, self.registers_per_request)
+        if not regs:
+            return None
+        t = self.links[meter].begin(kmp.CID_GET_REGISTER, regs, kmp.get_register_request(regs), now)
+        return (t, missed, due)
+
+    # Start a request without registers, e.g. GetSerialNo, if the meter has
+    # no outstanding request. Returns the transaction or None.
+    def command(self, meter, cid, now):
+        link = self.links.get(meter)
+        if link is None or link.busy():
+            return None
+        return link.begin(cid, (), (kmp.ADDRESS, cid), now)
+
+    # Match a response, returns the completed transaction or None
+    def complete(self, meter, cid, regs=()):
+        link = self.links.get(meter)
+        if link is None:
+            return None
+        return link.match(cid, regs)
@@ -0,0 +1,187 @@
+#           Binary capture of MQTT messages
+#
+#           This module does not depend on Domoticz. A Recorder appends the
+#           messages received and sent by MqttClient to a file, a Recording
+#           reads them back through a memory map, see capture/replay.py.
+#
+#           file:   b'KMQR' | version (uint8) | 3 reserved bytes | records
+#           record: length (uint32, of the rest of the record) | time (double)
+#                   | direction (uint8) | verb (uint8) | flags (uint8)
+#                   | topic length (uint16) | topic | payload
+#
+#           All numbers are little endian. PUBLISH payloads are stored as
+#           they are, the fields of other messages as JSON. A record which
+#           was cut short by a crash ends the recording. Writes are buffered,
+#           the plugin flushes them every heartbeat.
+#
+import json
+import mmap
+import os
+import struct
+
+MAGIC = b'KMQR'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sB3x')
+RECORD_HEADER = struct.Struct('<IdBBBH')    # The length excludes its own 4 bytes
+
+RECEIVED = 0
+SENT = 1
+
+VERBS = ('CONNECT', 'CONNACK', 'PUBLISH', 'PUBACK', 'SUBSCRIBE', 'SUBACK', 'UNSUBSCRIBE', 'UNSUBACK',
+         'PING', 'PINGRESP', 'DISCONNECT')
+VERB_CODES = dict((verb, code) for code, verb in enumerate(VERBS))
+OTHER_VERB = 0xff           # Verb in the JSON fields
+
+# flags
+QOS_MASK = 0x03
+RETAIN = 0x04
+TEXT = 0x08                 # The payload was a str, not bytes
+
+# Returns (verb code, flags, topic, payload) of a message dict
+def encode_message(message):
+    verb = message.get('Verb')
+    code = VERB_CODES.get(verb, OTHER_VERB)
+    if verb == 'PUBLISH':
+        payload = message.get('Payload', b'')
+        flags = (int(message.get('QoS', 0)) & QOS_MASK) | (RETAIN if message.get('Retain') else 0)
+        if isinstance(payload, str):
+            (payload, flags) = (payload.encode('utf8'), flags | TEXT)
+        return (code, flags, message.get('Topic', ''), payload)
+    fields = dict((k, v) for k, v in message.items() if k != 'Verb' or code == OTHER_VERB)
+    return (code, TEXT, '', json.dumps(fields, default=str, separators=(',', ':')).encode('utf8'))
+
+def decode_message(code, flags, topic, payload):
+    if code == VERB_CODES['PUBLISH']:
+        return {'Verb': 'PUBLISH', 'Topic': topic, 'Payload': payload.decode('utf8', 'replace') if flags & TEXT else payload,
+                'QoS': flags & QOS_MASK, 'Retain': bool(flags & RETAIN)}
+    message = json.loads(payload.decode('utf8'))
+    if code != OTHER_VERB:
+        message['Verb'] = VERBS[code]
+    return message
+
+class Recorder:
+    __slots__ = ('path', 'file', 'max_bytes', 'size', 'records')
+
+    # Appends to path, a file reaching max_bytes is renamed to path + '.1',
+    # replacing the previous one. Raises OSError, or ValueError if path is
+    # not a recording.
+    def __init__(self, path, max_bytes=0):
+        self.path = path
+        self.max_bytes = max_bytes      # 0 never rotates
+        self.records = 0
+        self.file = None
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, 'ab', buffering=65536)
+        self.size = self.file.tell()
+        if self.size == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+            self.size = FILE_HEADER.size
+        else:
+            # Drop a record which was cut short, it would hide the ones after it
+            try:
+                with Recording(self.path) as existing:
+                    end = existing.end()
+            except (OSError, ValueError):
+                self.close()
+                raise
+            if end < self.size:
+                self.file.truncate(end)
+                self.size = end
+
+    def record(self, t, direction, message):
+        (code, flags, topic, payload) = encode_message(message)
+        topic = topic.encode('utf8')
+        length = RECORD_HEADER.size - 4 + len(topic) + len(payload)
+        self.file.write(RECORD_HEADER.pack(length, t, direction, code, flags, len(topic)))
+        self.file.write(topic)
+        self.file.write(payload)
+        self.size += 4 + length
+        self.records += 1
+        if self.max_bytes and self.size >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        os.replace(self.path, self.path + '.1')
+        self.open()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def check_header(header, path):
+    if len(header) < FILE_HEADER.size:
+        raise ValueError("%s: not a recording" % path)
+    (magic, version) = FILE_HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("%s: not a recording" % path)
+    if version != VERSION:
+        raise ValueError("%s: unsupported recording version %d" % (path, version))
+
+# Returns True if the file at path starts with the recording header
+def is_recording(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class Recording:
+    # Raises OSError, or ValueError if path is not a recording
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            size = os.fstat(self.file.fileno()).st_size
+            check_header(self.file.read(FILE_HEADER.size), path)
+            self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Yields (time, direction, verb code, flags, topic, payload) of each
+    # record, topic and payload as bytes
+    def raw_records(self):
+        data = memoryview(self.map)
+        (size, header, unpack) = (len(data), RECORD_HEADER.size, RECORD_HEADER.unpack_from)
+        i = FILE_HEADER.size
+        try:
+            while i + header <= size:
+                (length, t, direction, code, flags, n) = unpack(data, i)
+                end = i + 4 + length
+                if end > size or length < header - 4 + n:
+                    break       # Cut short
+                start = i + header
+                yield (t, direction, code, flags, bytes(data[start:start + n]), bytes(data[start + n:end]))
+                i = end
+        finally:
+            data.release()
+
+    # Offset after the last complete record
+    def end(self):
+        (size, header, unpack) = (len(self.map), RECORD_HEADER.size, RECORD_HEADER.unpack_from)
+        i = FILE_HEADER.size
+        while i + header <= size:
+            (length, t, direction, code, flags, n) = unpack(self.map, i)
+            if i + 4 + length > size or length < header - 4 + n:
+                break
+            i += 4 + length
+        return i
+
+    # Yields (time, direction, message dict)
+    def __iter__(self):
+        for (t, direction, code, flags, topic, payload) in self.raw_records():
+            yield (t, direction, decode_message(code, flags, topic.decode('utf8', 'replace'), payload))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
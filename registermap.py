@@ -0,0 +1,172 @@
+#           Register maps per meter type
+#
+#           This module does not depend on Domoticz. A register map lists the
+#           registers of a meter type with their name, physical quantity,
+#           target field of the Domoticz device and poll interval. Maps are
+#           compiled once into RegisterMap, decoding a value is then a lookup
+#           of (register, unit) and an exact power of ten scaling.
+#
+#           Only the GetType id of the MC402 is known, the other models must
+#           be mapped with the meterTypes option, e.g. {"0x4401": "kamstrup_602_heat"}.
+#           Only the MC402 map has been checked against a real meter. The maps
+#           of the MC403, MC602 and MC603 reuse the MC402 registers unchecked
+#           and the Multical 21 map is a guess. They are marked unverified and
+#           the plugin logs a warning when one of them is used.
+#
+
+from decimal import Decimal
+
+import kmp
+
+#######################################################################
+# Factors from KMP units (see kmp.UNITS) to the unit of the Domoticz field,
+# as (power of ten, divisor) so values stay exact
+#
+QUANTITIES = {
+    'energy': {'Wh': (0, 1), 'kWh': (3, 1), 'MWh': (6, 1), 'GWh': (9, 1),         # Wh
+               'j': (0, 3600), 'kj': (3, 3600), 'Mj': (6, 3600), 'Gj': (9, 3600)},
+    'power': {'kW': (3, 1), 'MW': (6, 1), 'GW': (9, 1)},                          # W
+    'volume': {'l': (0, 1), 'm3': (3, 1)},                                        # l
+    'flow': {'l/h': (0, 1), 'm3/h': (3, 1)},                                      # l/h
+    'temperature': {'C': (0, 1), 'K': (0, 1)},                                    # C, K for differences
+}
+
+# Resolution of values which are not a whole power of ten multiple, like j -> Wh
+QUANTUM = Decimal('0.001')
+
+#######################################################################
+# Meter types
+#
+# Registers are (register, name, quantity, target field, poll), the target
+# field is one of the fields of the device sValue or None, poll is
+# (interval in seconds, priority) or None if the register is not polled.
+# Maps which have not been checked against a real meter or the Kamstrup
+# documentation have 'verified': False.
+#
+HEAT_DEVICE = {'TypeName': 'kWh', 'Switchtype': 0, 'fields': ('usage', 'counter')} # sValue 'W;Wh'
+WATER_DEVICE = {'TypeName': 'Counter', 'Switchtype': 2, 'fields': ('counter',)}     # sValue 'l'
+
+HEAT_REGISTERS = (
+    (0x003C, "Heat Energy (E1)", 'energy', 'counter', (300, 1)),     #60
+    (0x0050, "Power", 'power', 'usage', (10, 0)),                   #80
+    (0x0056, "Temp1", 'temperature', None, None),                   #86
+    (0x0057, "Temp2", 'temperature', None, None),                   #87
+    (0x0059, "Tempdiff", 'temperature', None, None),                #89
+    (0x004A, "Flow", 'flow', None, None),                           #74
+    (0x0044, "Volume", 'volume', None, None),                       #68
+    (0x008D, "MinFlow_M", 'flow', None, None),                      #141
+    (0x008B, "MaxFlow_M", 'flow', None, None),                      #139
+    (0x008C, "MinFlowDate_M", None, None, None),                    #140
+    (0x008A, "MaxFlowDate_M", None, None, None),                    #138
+    (0x0091, "MinPower_M", 'power', None, None),                    #145
+    (0x008F, "MaxPower_M", 'power', None, None),                    #143
+    (0x0095, "AvgTemp1_M", 'temperature', None, None),              #149
+    (0x0096, "AvgTemp2_M", 'temperature', None, None),              #150
+    (0x0090, "MinPowerDate_M", None, None, None),                   #144
+    (0x008E, "MaxPowerDate_M", None, None, None),                   #142
+    (0x007E, "MinFlow_Y", 'flow', None, None),                      #126
+    (0x007C, "MaxFlow_Y", 'flow', None, None),                      #124
+    (0x007D, "MinFlowDate_Y", None, None, None),                    #125
+    (0x007B, "MaxFlowDate_Y", None, None, None),                    #123
+    (0x0082, "MinPower_Y", 'power', None, None),                    #130
+    (0x0080, "MaxPower_Y", 'power', None, None),                    #128
+    (0x0092, "AvgTemp1_Y", 'temperature', None, None),              #146
+    (0x0093, "AvgTemp2_Y", 'temperature', None, None),              #147
+    (0x0081, "MinPowerDate_Y", None, None, None),                   #129
+    (0x007F, "MaxPowerDate_Y", None, None, None),                   #127
+    (0x0061, "Temp1xm3", None, None, None),                         #97
+    (0x006E, "Temp2xm3", None, None, None),                         #110
+    (0x0071, "Infoevent", None, None, None),                        #113
+    (0x03EA, "Clock", None, None, (3600, 2)),                       #1002
+    (0x03EB, "Date", None, None, (3600, 2)),                        #1003
+    (0x03EC, "HourCounter", None, None, None),                      #1004
+)
+
+METER_TYPES = {
+    'kamstrup_402_heat': {'name': 'MC402', 'type_ids': (0x1101,), 'device': HEAT_DEVICE, 'registers': HEAT_REGISTERS},
+    'kamstrup_403_heat': {'name': 'MC403', 'type_ids': (), 'verified': False, 'device': HEAT_DEVICE, 'registers': HEAT_REGISTERS},
+    'kamstrup_602_heat': {'name': 'MC602', 'type_ids': (), 'verified': False, 'device': HEAT_DEVICE, 'registers': HEAT_REGISTERS},
+    'kamstrup_603_heat': {'name': 'MC603', 'type_ids': (), 'verified': False, 'device': HEAT_DEVICE, 'registers': HEAT_REGISTERS},
+    'kamstrup_21_water': {'name': 'Multical 21', 'type_ids': (), 'verified': False, 'device': WATER_DEVICE, 'registers': (
+        (0x0044, "Volume", 'volume', 'counter', (60, 0)),           #68
+        (0x004A, "Flow", 'flow', None, None),                       #74
+        (0x03EA, "Clock", None, None, (3600, 1)),                   #1002
+        (0x03EB, "Date", None, None, (3600, 1)),                    #1003
+    )},
+}
+
+#######################################################################
+# Compiled register maps
+#
+class RegisterMap:
+    __slots__ = ('meter_type', 'name', 'type_ids', 'verified', 'type_name', 'switch_type', 'fields', 'names', 'poll', 'targets')
+
+    def __init__(self, meter_type, spec):
+        self.meter_type = meter_type
+        self.name = spec['name']
+        self.type_ids = tuple(spec['type_ids'])
+        self.verified = spec.get('verified', True)
+        device = spec['device']
+        self.type_name = device['TypeName']
+        self.switch_type = device['Switchtype']
+        self.fields = tuple(device['fields'])
+        self.names = {}         # reg -> name
+        self.poll = {}          # reg -> (interval, priority)
+        self.targets = {}       # (reg, unit) -> (index of the sValue field, power of ten, divisor)
+        for (reg, name, quantity, target, poll) in spec['registers']:
+            self.names[reg] = name
+            if poll is not None:
+                self.poll[reg] = poll
+            if target is not None:
+                if target not in self.fields:
+                    raise ValueError("%s: register %d targets unknown field '%s'" % (meter_type, reg, target))
+                index = self.fields.index(target)
+                for unit, (p, div) in QUANTITIES[quantity].items():
+                    self.targets[(reg, unit)] = (index, p, div)
+
+    # Scales the register value m * 10**e, see kmp.read_register_fixed.
+    # Returns (index of the sValue field, value in the unit of the field) or
+    # None if the register has no target or the unit is unexpected. The value
+    # is an int if it is whole, else a Decimal.
+    def scale(self, reg, m, e, unit):
+        target = self.targets.get((reg, unit))
+        if target is None:
+            return None
+        (index, p, div) = target
+        e += p
+        if div == 1:
+            if e >= 0:
+                # The exponent of the register is at most 63, the shift p of the unit can take it beyond the table
+                return (index, m * (kmp.POW10[e] if e < len(kmp.POW10) else 10 ** e))
+            return (index, Decimal(m).scaleb(e))
+        x = Decimal(m).scaleb(e) / div
+        if x == x.to_integral_value():
+            return (index, int(x))
+        return (index, x.quantize(QUANTUM))
+
+# Formats a scaled value for a device sValue, without exponent or trailing zeros
+def format_value(x):
+    if isinstance(x, int):
+        return str(x)
+    x = x.normalize()
+    if x == x.to_integral_value():
+        return str(int(x))
+    return format(x, 'f')
+
+def compile_maps(meter_types=METER_TYPES):
+    return dict((meter_type, RegisterMap(meter_type, spec)) for meter_type, spec in meter_types.items())
+
+MAPS = compile_maps()
+
+# Returns GetType id -> meter type. ids maps additional ids, as strings like
+# "0x4401", to meter types. Raises ValueError for unknown meter types.
+def type_ids(ids=None):
+    result = {}
+    for meter_type, regmap in MAPS.items():
+        for type_id in regmap.type_ids:
+            result[type_id] = meter_type
+    for type_id, meter_type in (ids or {}).items():
+        if meter_type not in MAPS:
+            raise ValueError("Unknown meter type '%s'" % meter_type)
+        result[int(type_id, 0) if isinstance(type_id, str) else int(type_id)] = meter_type
+    return result
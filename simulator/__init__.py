@@ -0,0 +1,14 @@
+#           Offline simulator for the Kamstrup plugin
+#
+#           Runs plugin.py outside of Domoticz against a fake Domoticz module,
+#           an in-process MQTT broker and simulated Tasmota devices connected
+#           to Kamstrup meters. Time is simulated, a day of polling runs in
+#           seconds.
+#
+#           Usage:
+#             python -m simulator --meters 10 --duration 3600
+#
+from simulator.clock import VirtualClock
+from simulator.broker import Broker
+from simulator.meter import MC402, TasmotaBridge
+from simulator.harness import Harness
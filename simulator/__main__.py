@@ -0,0 +1,46 @@
+#           python -m simulator [options]
+#
+#           Runs the plugin against simulated meters and prints statistics
+#           and the final device values as JSON.
+#
+import argparse
+import json
+import sys
+import time
+
+from simulator.harness import Harness
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m simulator', description='Run the Kamstrup plugin against simulated meters')
+    parser.add_argument('--meters', type=int, default=1, help='number of simulated meters')
+    parser.add_argument('--duration', type=float, default=600, help='simulated seconds to run')
+    parser.add_argument('--latency', type=float, default=0.01, help='broker latency in seconds')
+    parser.add_argument('--tasmota-latency', type=float, default=0.1, help='Tasmota serial latency in seconds')
+    parser.add_argument('--baud', type=int, default=1200, help='IR link speed')
+    parser.add_argument('--fragment', type=float, default=0.0, help='probability that a response is split across messages')
+    parser.add_argument('--max-fragments', type=int, default=3, help='maximum number of fragments per response')
+    parser.add_argument('--bit-errors', type=float, default=0.0, help='bit error rate of the IR link')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability that a response is lost')
+    parser.add_argument('--options', default='', help='plugin options as JSON')
+    parser.add_argument('--debug', default='Normal', choices=['Normal', 'Debug', 'Verbose', 'Verbose+'])
+    parser.add_argument('--echo', action='store_true', help='print the plugin log')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    harness = Harness(meters=args.meters, options=json.loads(args.options) if args.options else None, debug=args.debug,
+                      latency=args.latency, tasmota_latency=args.tasmota_latency, baud=args.baud,
+                      fragment_probability=args.fragment, max_fragments=args.max_fragments,
+                      bit_error_rate=args.bit_errors, drop_probability=args.drop, seed=args.seed, echo=args.echo)
+    t = time.perf_counter()
+    harness.start()
+    events = harness.run(args.duration)
+    harness.stop()
+    stats = harness.stats()
+    stats['events'] = events
+    stats['wall_seconds'] = round(time.perf_counter() - t, 3)
+    stats['values'] = dict((unit, device.sValue) for unit, device in harness.plugin.Devices.items())
+    json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
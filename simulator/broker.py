@@ -0,0 +1,48 @@
+#           In-process MQTT broker
+#
+#           Clients are objects with a deliver(topic, payload, retain) method.
+#           Messages are delivered through the clock after latency seconds.
+#
+from subscriptions import topic_matches
+
+class Broker:
+    def __init__(self, clock, latency=0.0):
+        self.clock = clock
+        self.latency = latency
+        self.subscriptions = {}     # client -> set of topic filters
+        self.retained = {}          # topic -> payload
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, client, topics):
+        subscriptions = self.subscriptions.setdefault(client, set())
+        for pattern in topics:
+            subscriptions.add(pattern)
+            for topic, payload in self.retained.items():
+                if topic_matches(pattern, topic):
+                    self._deliver(client, topic, payload, True)
+
+    def unsubscribe(self, client, topics):
+        subscriptions = self.subscriptions.get(client, set())
+        for pattern in topics:
+            subscriptions.discard(pattern)
+
+    def disconnect(self, client):
+        self.subscriptions.pop(client, None)
+
+    def publish(self, topic, payload, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf8')
+        payload = bytes(payload)
+        self.published += 1
+        if retain:
+            self.retained[topic] = payload
+        for client, patterns in list(self.subscriptions.items()):
+            for pattern in patterns:
+                if topic_matches(pattern, topic):
+                    self._deliver(client, topic, payload, False)
+                    break
+
+    def _deliver(self, client, topic, payload, retain):
+        self.delivered += 1
+        self.clock.call_later(self.latency, client.deliver, topic, payload, retain)
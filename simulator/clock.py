@@ -0,0 +1,32 @@
+#           Simulated time and event loop
+#
+import heapq
+import itertools
+
+class VirtualClock:
+    def __init__(self, start=1500000000.0):
+        self.start = start
+        self.now = start
+        self.events = []                # (time, seq, fn, args)
+        self.seq = itertools.count()
+
+    # Same signature as time.time, the plugin's time module is replaced by the clock
+    def time(self):
+        return self.now
+
+    def call_at(self, t, fn, *args):
+        heapq.heappush(self.events, (max(t, self.now), next(self.seq), fn, args))
+
+    def call_later(self, delay, fn, *args):
+        self.call_at(self.now + delay, fn, *args)
+
+    # Run events until the clock reaches t, returns the number of events run
+    def run_until(self, t):
+        n = 0
+        events = self.events
+        while events and events[0][0] <= t:
+            (self.now, seq, fn, args) = heapq.heappop(events)
+            fn(*args)
+            n += 1
+        self.now = max(self.now, t)
+        return n
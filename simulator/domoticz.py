@@ -0,0 +1,148 @@
+#           Stand-in for the Domoticz module provided to Python plugins
+#
+#           Covers the parts used by plugin.py: logging, Heartbeat, Debugging,
+#           Device and an MQTT Connection connected to the simulator broker.
+#           Installed as sys.modules['Domoticz'] by the harness.
+#
+import sys
+
+Parameters = {}
+Devices = {}
+
+# Set by the harness
+harness = None
+
+heartbeatInterval = 10
+debugMask = 0
+messages = {'Log': 0, 'Debug': 0, 'Error': 0, 'Status': 0}
+echo = False
+
+def _log(level, message):
+    messages[level] += 1
+    if harness is not None:
+        harness.onLog(level, message)
+    if echo:
+        sys.stdout.write(level + ': ' + str(message) + '\n')
+
+def Log(message):
+    _log('Log', message)
+
+def Status(message):
+    _log('Status', message)
+
+def Error(message):
+    _log('Error', message)
+
+def Debug(message):
+    if debugMask:
+        _log('Debug', message)
+
+def Debugging(mask):
+    global debugMask
+    debugMask = mask
+
+def Heartbeat(interval):
+    global heartbeatInterval
+    heartbeatInterval = interval
+
+def reset():
+    global heartbeatInterval, debugMask
+    Parameters.clear()
+    Devices.clear()
+    heartbeatInterval = 10
+    debugMask = 0
+    for level in messages:
+        messages[level] = 0
+
+#######################################################################
+# Devices
+#
+class Device:
+    def __init__(self, Name='', Unit=0, TypeName='', Type=0, Subtype=0, Switchtype=0, Image=0, Options=None, Used=0, Description='', **kwargs):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = dict(Options) if Options else {}
+        self.Used = int(Used)
+        self.Description = Description
+        self.ID = Unit
+        self.DeviceID = ''
+        self.nValue = 0
+        self.sValue = '0;0' if TypeName == 'kWh' else ''
+        self.SignalLevel = 12
+        self.BatteryLevel = 255
+        self.TimedOut = 0
+        self.LastLevel = 0
+        self.Color = ''
+        self.LastUpdate = ''
+        self.updates = 0            # Number of Update calls, each one is a database write
+        self.triggers = 0           # Number of Update calls which did not suppress triggers
+
+    def __str__(self):
+        return "Unit: %d, Name: '%s', nValue: %d, sValue: '%s'" % (self.Unit, self.Name, self.nValue, self.sValue)
+
+    def Create(self):
+        Devices[self.Unit] = self
+
+    def Update(self, nValue, sValue, Image=None, SignalLevel=None, BatteryLevel=None, Options=None, TimedOut=None,
+               Name=None, TypeName=None, Type=None, Subtype=None, Switchtype=None, Used=None, Description=None,
+               Color=None, SuppressTriggers=False):
+        self.nValue = nValue
+        self.sValue = sValue
+        for attribute, value in (('Image', Image), ('SignalLevel', SignalLevel), ('BatteryLevel', BatteryLevel),
+                                 ('TimedOut', TimedOut), ('Name', Name), ('Description', Description),
+                                 ('Color', Color), ('Used', Used)):
+            if value is not None:
+                setattr(self, attribute, value)
+        if Options is not None:
+            self.Options = dict(Options)
+        self.updates += 1
+        if not SuppressTriggers:
+            self.triggers += 1
+        if harness is not None:
+            harness.onDeviceUpdate(self)
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+    def Refresh(self):
+        pass
+
+#######################################################################
+# Connections, only Protocol="MQTT" is supported
+#
+class Connection:
+    def __init__(self, Name='', Transport='TCP/IP', Protocol='MQTT', Address='', Port='', Baud=0):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self.connected = False
+        self.connecting = False
+        self.sent = 0
+
+    def __str__(self):
+        return "Name: '%s', Transport: '%s', Protocol: '%s', Address: '%s', Port: '%s'" % (
+            self.Name, self.Transport, self.Protocol, self.Address, self.Port)
+
+    def Connect(self):
+        self.connecting = True
+        harness.connect(self)
+
+    def Connecting(self):
+        return self.connecting
+
+    def Connected(self):
+        return self.connected
+
+    def Send(self, Message, Delay=0):
+        self.sent += 1
+        harness.send(self, Message, Delay)
+
+    def Disconnect(self):
+        harness.disconnect(self)
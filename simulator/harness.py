@@ -0,0 +1,179 @@
+#           Runs plugin.py against the simulated Domoticz, broker and meters
+#
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from simulator import domoticz
+from simulator.broker import Broker
+from simulator.clock import VirtualClock
+from simulator.meter import MC402, TasmotaBridge
+
+# Connects the plugin's Domoticz.Connection to the broker, MQTT verbs are
+# translated the way the Domoticz MQTT protocol does
+class PluginClient:
+    def __init__(self, harness, connection):
+        self.harness = harness
+        self.connection = connection
+
+    def deliver(self, topic, payload, retain):
+        self.harness.onMessage(self.connection, {'Verb': 'PUBLISH', 'Topic': topic, 'Payload': payload, 'QoS': 0, 'Retain': retain})
+
+class Harness:
+    def __init__(self, meters=1, options=None, debug='Normal', latency=0.01, tasmota_latency=0.1, baud=1200,
+                 fragment_probability=0.0, max_fragments=3, bit_error_rate=0.0, drop_probability=0.0,
+                 seed=0, start=1500000000.0, echo=False):
+        self.clock = VirtualClock(start)
+        self.broker = Broker(self.clock, latency)
+        self.rng = random.Random(seed)
+        self.topics = ['tasmota/meter_%03d' % i for i in range(meters)]
+        self.bridges = []
+        for i, topic in enumerate(self.topics):
+            meter = MC402(70000000 + i, self.clock, self.rng)
+            self.bridges.append(TasmotaBridge(topic, meter, self.broker, self.clock, self.rng, tasmota_latency, baud,
+                                              fragment_probability, max_fragments, bit_error_rate, drop_probability))
+        # Plugin folder, removed by stop() or at the latest when the harness is garbage collected
+        self.tempdir = tempfile.TemporaryDirectory(prefix='kamstrup_sim_')
+        self.homeFolder = self.tempdir.name
+        self.parameters = {
+            'Key': 'KamstrupSonoffMQTT', 'HardwareID': 1, 'HomeFolder': self.homeFolder + os.sep,
+            'Address': '127.0.0.1', 'Port': '1883', 'Username': '', 'Password': '',
+            'Mode2': ','.join(self.topics), 'Mode3': json.dumps(options) if options else '', 'Mode6': debug,
+        }
+        self.echo = echo
+        self.clients = {}           # connection -> PluginClient
+        self.callbacks = {}         # callback name -> [calls, wall time in seconds]
+        self.log = {'Log': [], 'Error': []}
+        self.deviceUpdates = 0
+        self.plugin = None
+
+    #######################################################################
+    # Setup
+    #
+    # plugin.py is imported fresh, with the fake Domoticz module installed
+    def load(self):
+        domoticz.reset()
+        domoticz.harness = self
+        domoticz.echo = self.echo
+        domoticz.Parameters.update(self.parameters)
+        sys.modules['Domoticz'] = domoticz
+        sys.modules.pop('plugin', None)
+        self.plugin = importlib.import_module('plugin')
+        self.plugin.Parameters = domoticz.Parameters
+        self.plugin.Devices = domoticz.Devices
+        self.plugin.time = self.clock
+        return self.plugin
+
+    def start(self):
+        if self.plugin is None:
+            self.load()
+        for bridge in self.bridges:
+            bridge.start()
+        self.call('onStart')
+        self.clock.call_later(domoticz.heartbeatInterval, self.heartbeat)
+
+    def heartbeat(self):
+        self.call('onHeartbeat')
+        self.clock.call_later(domoticz.heartbeatInterval, self.heartbeat)
+
+    # Run the simulation for seconds of simulated time
+    def run(self, seconds):
+        return self.clock.run_until(self.clock.time() + seconds)
+
+    def stop(self):
+        self.call('onStop')
+        self.tempdir.cleanup()
+
+    # Call a plugin callback, the wall time is recorded per callback
+    def call(self, name, *args):
+        fn = getattr(self.plugin, name, None)
+        if fn is None:
+            return
+        t = time.perf_counter()
+        try:
+            fn(*args)
+        finally:
+            stats = self.callbacks.setdefault(name, [0, 0.0])
+            stats[0] += 1
+            stats[1] += time.perf_counter() - t
+
+    #######################################################################
+    # Called by the fake Domoticz module
+    #
+    def connect(self, connection):
+        self.clock.call_later(self.broker.latency, self.onConnected, connection)
+
+    def onConnected(self, connection):
+        connection.connecting = False
+        connection.connected = True
+        self.call('onConnect', connection, 0, '')
+
+    def disconnect(self, connection):
+        client = self.clients.pop(connection, None)
+        if client is not None:
+            self.broker.disconnect(client)
+        if connection.connected:
+            connection.connected = False
+            self.clock.call_later(0, self.call, 'onDisconnect', connection)
+
+    def send(self, connection, message, delay=0):
+        if not connection.connected:
+            return
+        verb = message.get('Verb')
+        client = self.clients.get(connection)
+        if verb == 'CONNECT':
+            client = PluginClient(self, connection)
+            self.clients[connection] = client
+            self.reply(connection, {'Verb': 'CONNACK', 'Status': 0, 'Description': 'Connection Accepted'})
+        elif client is None:
+            return
+        elif verb == 'SUBSCRIBE':
+            self.broker.subscribe(client, [t['Topic'] for t in message['Topics']])
+            self.reply(connection, {'Verb': 'SUBACK', 'Topics': [{'Topic': t['Topic'], 'QoS': 0} for t in message['Topics']]})
+        elif verb == 'UNSUBSCRIBE':
+            topics = [t['Topic'] if isinstance(t, dict) else t for t in message['Topics']]
+            self.broker.unsubscribe(client, topics)
+            self.reply(connection, {'Verb': 'UNSUBACK'})
+        elif verb == 'PUBLISH':
+            self.clock.call_later(delay + self.broker.latency, self.broker.publish, message['Topic'], message['Payload'], bool(message.get('Retain')))
+        elif verb == 'PING':
+            self.reply(connection, {'Verb': 'PINGRESP'})
+        elif verb == 'DISCONNECT':
+            self.disconnect(connection)
+
+    def reply(self, connection, data):
+        self.clock.call_later(self.broker.latency, self.onMessage, connection, data)
+
+    def onMessage(self, connection, data):
+        if connection.connected:
+            self.call('onMessage', connection, data)
+
+    def onLog(self, level, message):
+        if level in self.log:
+            self.log[level].append(message)
+
+    def onDeviceUpdate(self, device):
+        self.deviceUpdates += 1
+
+    #######################################################################
+    # Results
+    #
+    def stats(self):
+        bridges = {}
+        for bridge in self.bridges:
+            for k, v in bridge.stats.items():
+                bridges[k] = bridges.get(k, 0) + v
+        return {
+            'simulated_seconds': self.clock.time() - self.clock.start,
+            'devices': len(domoticz.Devices),
+            'device_updates': self.deviceUpdates,
+            'broker_published': self.broker.published,
+            'broker_delivered': self.broker.delivered,
+            'meters': bridges,
+            'log_messages': dict(domoticz.messages),
+            'callbacks': dict((name, {'calls': n, 'seconds': round(t, 6)}) for name, (n, t) in self.callbacks.items()),
+        }
@@ -0,0 +1,176 @@
+#           Simulated Kamstrup meter behind a Tasmota device
+#
+#           TasmotaBridge subscribes to <topic>/cmnd/#, passes serialsend4
+#           frames to the meter and publishes the response as SerialReceived
+#           on <topic>/tele/RESULT, like Tasmota with an IR eye does.
+#
+import json
+import math
+import time as _time
+
+import kmp
+
+#######################################################################
+# Meter
+#
+# Register values are (unit code, exponent, function returning the value)
+#
+class MC402:
+    meter_type = 0x1101
+    sw_revision = 0x0001
+
+    def __init__(self, serial_no, clock, rng):
+        self.serial_no = serial_no
+        self.clock = clock
+        self.rng = rng
+        self.energy = rng.uniform(10.0, 500.0)      # MWh
+        self.power = rng.uniform(0.0, 20.0)         # kW
+        self.updated = clock.time()
+        self.registers = {
+            0x003C: (3, -3, lambda: self.energy),   # Heat Energy (E1), MWh
+            0x0044: (40, -2, lambda: self.energy * 20), # Volume, m3
+            0x004A: (41, 0, lambda: self.power * 43), # Flow, l/h
+            0x0050: (22, -1, lambda: self.power),   # Power, kW
+            0x0056: (37, -2, lambda: 70.0 + self.power / 2), # Temp1, C
+            0x0057: (37, -2, lambda: 40.0 - self.power / 4), # Temp2, C
+            0x0059: (37, -2, lambda: 30.0 + self.power * 3 / 4), # Tempdiff, C
+            0x03EA: (47, 0, lambda: int(self._localtime('%H%M%S'))), # Clock
+            0x03EB: (48, 0, lambda: int(self._localtime('%y%m%d'))), # Date
+        }
+        self.requests = 0
+
+    def _localtime(self, fmt):
+        return _time.strftime(fmt, _time.gmtime(self.clock.time()))
+
+    # Integrate energy and let the power drift
+    def advance(self):
+        now = self.clock.time()
+        dt = now - self.updated
+        if dt <= 0:
+            return
+        self.updated = now
+        self.energy += self.power * dt / 3600 / 1000
+        self.power = max(0.0, self.power + self.rng.gauss(0, 0.05 * math.sqrt(dt)))
+
+    # Returns the response message (address included) or None
+    def handle(self, msg):
+        self.requests += 1
+        self.advance()
+        (address, cid) = (msg[0], msg[1])
+        if cid == kmp.CID_GET_TYPE:
+            return bytes((address, cid, self.meter_type >> 8, self.meter_type & 0xff, self.sw_revision >> 8, self.sw_revision & 0xff))
+        if cid == kmp.CID_GET_SERIAL_NO:
+            return bytes((address, cid)) + self.serial_no.to_bytes(4, 'big')
+        if cid == kmp.CID_SET_CLOCK:
+            return bytes((address, cid))
+        if cid == kmp.CID_GET_REGISTER:
+            response = bytearray((address, cid))
+            n = msg[2]
+            for i in range(n):
+                reg = msg[3 + 2 * i] << 8 | msg[4 + 2 * i]
+                if reg in self.registers:
+                    response += self.encode_register(reg)
+            return bytes(response)
+        return None
+
+    def encode_register(self, reg):
+        (unit, exponent, value) = self.registers[reg]
+        mantissa = int(round(value() / 10 ** exponent))
+        siex = 0
+        if mantissa < 0:
+            siex |= 0x80
+            mantissa = -mantissa
+        if exponent < 0:
+            siex |= 0x40
+        siex |= abs(exponent) & 0x3f
+        return bytes((reg >> 8, reg & 0xff, unit, 4, siex)) + mantissa.to_bytes(4, 'big')
+
+#######################################################################
+# Tasmota device
+#
+class TasmotaBridge:
+    def __init__(self, topic, meter, broker, clock, rng, latency=0.1, baud=1200,
+                 fragment_probability=0.0, max_fragments=3, bit_error_rate=0.0, drop_probability=0.0):
+        self.topic = topic
+        self.meter = meter
+        self.broker = broker
+        self.clock = clock
+        self.rng = rng
+        self.latency = latency                          # Tasmota processing, seconds
+        self.baud = baud                                # IR link speed
+        self.fragment_probability = fragment_probability
+        self.max_fragments = max_fragments
+        self.bit_error_rate = bit_error_rate            # Per transmitted bit
+        self.drop_probability = drop_probability        # Lost responses
+        self.busy_until = 0
+        self.stats = {'requests': 0, 'responses': 0, 'fragments': 0, 'corrupted': 0, 'dropped': 0, 'invalid': 0}
+
+    def start(self):
+        self.broker.subscribe(self, [self.topic + '/cmnd/#'])
+        self.broker.publish(self.topic + '/tele/LWT', 'Online', retain=True)
+
+    def deliver(self, topic, payload, retain):
+        command = topic[len(self.topic) + len('/cmnd/'):].lower()
+        if command == 'serialsend4':
+            self.serialSend(payload)
+        elif command == 'status':
+            self.status(payload.decode('utf8', 'replace'))
+
+    def status(self, arg):
+        if arg == '5':
+            message = {"StatusNET": {"Hostname": self.topic.replace('/', '-'), "IPAddress": "192.168.0.%d" % (sum(self.topic.encode()) % 250 + 2)}}
+        elif arg == '11':
+            message = {"StatusSTS": {"Wifi": {"RSSI": 80}}}
+        else:
+            return
+        self.broker.publish(self.topic + '/stat/STATUS' + arg, json.dumps(message))
+
+    def serialSend(self, payload):
+        self.stats['requests'] += 1
+        try:
+            request = kmp.decode(bytes(payload), pfx=kmp.START_REQUEST)
+        except kmp.KmpError:
+            self.stats['invalid'] += 1
+            return
+        response = self.meter.handle(bytes(request.buf[:-2]))
+        if response is None:
+            return
+        if self.rng.random() < self.drop_probability:
+            self.stats['dropped'] += 1
+            return
+        raw = kmp.encode(kmp.START_RESPONSE, response)
+        self.corrupt(raw)
+
+        # Request and response share the half duplex IR link
+        now = self.clock.time()
+        start = max(now, self.busy_until)
+        duration = (len(payload) + len(raw)) * 10.0 / self.baud
+        self.busy_until = start + duration
+        done = self.busy_until + self.latency
+
+        for i, fragment in enumerate(self.fragments(raw)):
+            self.stats['fragments'] += 1
+            self.clock.call_at(done + i * 0.05, self.publishReceived, fragment.hex().upper())
+        self.stats['responses'] += 1
+
+    def corrupt(self, raw):
+        if self.bit_error_rate <= 0:
+            return
+        corrupted = False
+        for i in range(1, len(raw) - 1):
+            for bit in range(8):
+                if self.rng.random() < self.bit_error_rate:
+                    raw[i] ^= 1 << bit
+                    corrupted = True
+        if corrupted:
+            self.stats['corrupted'] += 1
+
+    def fragments(self, raw):
+        if len(raw) < 2 or self.rng.random() >= self.fragment_probability:
+            return [raw]
+        n = self.rng.randint(2, max(2, min(self.max_fragments, len(raw))))
+        cuts = sorted(self.rng.sample(range(1, len(raw)), n - 1))
+        return [raw[a:b] for a, b in zip([0] + cuts, cuts + [len(raw)])]
+
+    def publishReceived(self, s):
+        self.broker.publish(self.topic + '/tele/RESULT', json.dumps({"SerialReceived": s}))
@@ -0,0 +1,120 @@
+#           Incremental MQTT subscriptions
+#
+#           This module does not depend on Domoticz. The topics each source
+#           (a device unit, the configured meter topics) needs are kept per
+#           source, changes only mark the subscriptions dirty. sync() then
+#           returns the topics to SUBSCRIBE and UNSUBSCRIBE since the last
+#           sync, so changes are batched and a single new device does not
+#           cause a full resubscribe and a replay of all retained messages.
+#
+#           Topics which are matched by another wanted wildcard topic are not
+#           subscribed, e.g. 'x/stat/RESULT' is covered by 'x/stat/#'. With
+#           wildcards > 0, groups of at least that many topics differing in a
+#           single level are collapsed into one '+' topic, e.g.
+#           'tasmota/+/tele/RESULT'. This receives messages of other devices
+#           on the broker as well, so it is off by default.
+#
+
+# Returns True if the topic filter pattern matches topic, both may contain wildcards
+def topic_matches(pattern, topic):
+    if pattern == topic:
+        return True
+    p = pattern.split('/')
+    t = topic.split('/')
+    for i, level in enumerate(p):
+        if level == '#':
+            return True
+        if i >= len(t):
+            return False
+        if level != '+' and level != t[i]:
+            return False
+    return len(p) == len(t)
+
+# Drops the topics which are matched by another wildcard topic of topics.
+# 'prefix/#' topics are looked up by prefix, only '+' topics are scanned.
+def remove_covered(topics):
+    prefixes = set(topic[:-2] for topic in topics if topic.endswith('/#') and '+' not in topic)
+    singles = [topic for topic in topics if '+' in topic]
+    if not prefixes and not singles:
+        return set(topics)
+    result = set()
+    for topic in topics:
+        levels = topic.split('/')
+        n = len(levels) - 2 if levels[-1] == '#' else len(levels) # Excluding its own prefix
+        if any('/'.join(levels[:i]) in prefixes for i in range(1, n + 1)):
+            continue
+        if any(w != topic and topic_matches(w, topic) for w in singles):
+            continue
+        result.add(topic)
+    return result
+
+# Collapses groups of at least threshold topics which only differ in a
+# single level into one topic with a '+' in that level. Largest groups first.
+def collapse(topics, threshold):
+    if threshold <= 0:
+        return set(topics)
+    groups = {}         # pattern -> topics matched by it
+    for topic in topics:
+        levels = topic.split('/')
+        for i, level in enumerate(levels):
+            if level in ('+', '#'):
+                continue
+            pattern = '/'.join(levels[:i] + ['+'] + levels[i + 1:])
+            groups.setdefault(pattern, set()).add(topic)
+    result = set()
+    remaining = set(topics)
+    for pattern, members in sorted(groups.items(), key=lambda item: (-len(item[1]), item[0])):
+        members &= remaining
+        if len(members) < max(threshold, 2):
+            continue
+        result.add(pattern)
+        remaining -= members
+    return result | remaining
+
+class SubscriptionManager:
+    __slots__ = ('sources', 'subscribed', 'wildcards', 'dirty')
+
+    def __init__(self, wildcards=0):
+        self.sources = {}       # source -> frozenset of wanted topics
+        self.subscribed = set() # Topic filters subscribed at the broker
+        self.wildcards = wildcards
+        self.dirty = False
+
+    # Sets the topics wanted by source, replacing its previous topics
+    def set(self, source, topics):
+        topics = frozenset(topics)
+        if self.sources.get(source) != topics:
+            self.sources[source] = topics
+            self.dirty = True
+
+    def discard(self, source):
+        if self.sources.pop(source, None) is not None:
+            self.dirty = True
+
+    # All topics wanted by the sources
+    def wanted(self):
+        topics = set()
+        for source_topics in self.sources.values():
+            topics |= source_topics
+        return topics
+
+    # The topic filters which should be subscribed
+    def filters(self):
+        return remove_covered(collapse(remove_covered(self.wanted()), self.wildcards))
+
+    # Must be called when a new session was started, nothing is subscribed then
+    def reset(self):
+        self.subscribed.clear()
+        self.dirty = True
+
+    # Returns (topics to subscribe, topics to unsubscribe), sorted, and
+    # assumes they will be sent
+    def sync(self):
+        if not self.dirty:
+            return ([], [])
+        self.dirty = False
+        filters = self.filters()
+        subscribe = sorted(filters - self.subscribed)
+        unsubscribe = sorted(self.subscribed - filters)
+        self.subscribed = filters
+        return (subscribe, unsubscribe)
@@ -0,0 +1,37 @@
+#           Tests of the reconnect backoff in backoff.py
+#
+import random
+
+import pytest
+
+import backoff
+
+def test_delays_within_bounds():
+    delays = backoff.Backoff(initial=1.0, maximum=60.0, factor=2.0, jitter=0.5, rng=random.Random(1))
+    for n in range(100):
+        cap = min(60.0, 2.0 ** n)
+        assert cap * 0.5 <= delays.next() <= cap
+    assert delays.attempts == 100
+
+def test_without_jitter():
+    delays = backoff.Backoff(initial=1.0, maximum=10.0, jitter=0.0)
+    assert [delays.next() for n in range(6)] == [1.0, 2.0, 4.0, 8.0, 10.0, 10.0]
+
+@pytest.mark.parametrize('seed', range(5))
+def test_jitter_spreads_clients(seed):
+    rng = random.Random(seed)
+    delays = [backoff.Backoff(rng=rng).next() for client in range(20)]
+    assert len(set(delays)) == 20
+
+def test_reset():
+    delays = backoff.Backoff(initial=1.0, maximum=300.0, jitter=0.0)
+    for n in range(10):
+        delays.next()
+    delays.reset()
+    assert delays.attempts == 0
+    assert delays.next() == 1.0
+
+def test_many_attempts_do_not_overflow():
+    delays = backoff.Backoff(initial=1.0, maximum=300.0, jitter=0.0)
+    delays.attempts = 10000
+    assert delays.next() == 300.0
@@ -0,0 +1,68 @@
+#           Tests of the persisted meter identities in identity.py
+#
+import json
+
+import pytest
+
+import identity
+
+TOPIC = 'tasmota/meter_000'
+
+def store(tmp_path):
+    return identity.IdentityStore(str(tmp_path / 'meters.json'))
+
+def test_save_and_reload(tmp_path):
+    identities = store(tmp_path)
+    identities.update(TOPIC, 100, type_id=0x1101, revision=1, meter_type='kamstrup_402_heat')
+    identities.update(TOPIC, 200, serial_no=70000000, status_refreshed=200)
+    identities.save()
+    assert not identities.dirty
+    assert not (tmp_path / 'meters.json.tmp').exists()
+    reloaded = store(tmp_path)
+    reloaded.load()
+    meter = reloaded.get(TOPIC)
+    assert (meter.type_id, meter.revision, meter.serial_no, meter.meter_type) == (0x1101, 1, 70000000, 'kamstrup_402_heat')
+    assert (meter.updated, meter.status_refreshed) == (200, 200)
+
+def test_times_do_not_change_the_identity(tmp_path):
+    identities = store(tmp_path)
+    identities.update(TOPIC, 100, serial_no=70000000)
+    identities.save()
+    identities.update(TOPIC, 200, status_refreshed=200)
+    assert identities.get(TOPIC).updated == 100
+    assert identities.dirty
+    identities.save()
+    identities.update(TOPIC, 300, serial_no=70000000)
+    assert not identities.dirty
+
+def test_unknown_field(tmp_path):
+    with pytest.raises(TypeError):
+        store(tmp_path).update(TOPIC, 100, serial=1)
+
+def test_missing_file_is_empty(tmp_path):
+    identities = store(tmp_path)
+    identities.load()
+    assert len(identities) == 0
+
+@pytest.mark.parametrize('content', ['{"tasmota/meter_000": {"serial_no": 7', '[]', ''])
+def test_corrupt_file(tmp_path, content):
+    (tmp_path / 'meters.json').write_text(content)
+    identities = store(tmp_path)
+    with pytest.raises(ValueError):
+        identities.load()
+    assert len(identities) == 0
+
+def test_failed_save_keeps_the_previous_file(tmp_path, monkeypatch):
+    identities = store(tmp_path)
+    identities.update(TOPIC, 100, serial_no=70000000)
+    identities.save()
+    previous = (tmp_path / 'meters.json').read_text()
+    def failing_dump(data, f, **kwargs):
+        f.write('{"tasmota/')
+        raise OSError("No space left on device")
+    monkeypatch.setattr(json, 'dump', failing_dump)
+    identities.update(TOPIC, 200, serial_no=70000001)
+    with pytest.raises(OSError):
+        identities.save()
+    assert (tmp_path / 'meters.json').read_text() == previous
+    assert identities.dirty
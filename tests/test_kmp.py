@@ -0,0 +1,188 @@
+#           Tests of the KMP codec in kmp.py
+#
+#           The frames are MC402 responses as received in SerialReceived.
+#
+from decimal import Decimal
+import random
+
+import pytest
+
+import kmp
+
+POWER = '403F100050160441000000A924830D'
+POWER_ENERGY = '403F100050160441000000A9003C0304430001283E17F70D'
+# Register 87 is 0x0DF8, the 0x0d is escaped as 1B F2
+EIGHT_REGISTERS = '403F10003C0304430001283E00442804420002507D004A290400000002D90050160441000000A9005625044200001EA7005725044200001BF2F80059250442000010AF03EA2F040000005DC0CC890D'
+TYPE = '403F01110100010ADC0D'
+
+def messages():
+    rng = random.Random(1021)
+    yield b''
+    yield b'\x00'
+    yield b'123456789'
+    yield bytes(range(256))
+    for n in range(1, 40):
+        yield bytes(rng.randrange(256) for _ in range(n))
+
+#######################################################################
+# CRC
+#
+def test_crc_check_value():
+    # CRC-16/XMODEM check value
+    assert kmp.crc16(b'123456789') == 0x31c3
+
+@pytest.mark.parametrize('crc', [kmp.crc16, kmp.crc16_table, kmp.crc16_slice4, kmp.crc16_slice8])
+def test_crc_matches_bitwise(crc):
+    for msg in messages():
+        # The bit-serial CRC of the message followed by two zero bytes is the CRC of the message
+        assert crc(msg) == kmp.crc_1021_bitwise(msg + b'\0\0'), msg.hex()
+        assert crc(bytearray(msg)) == crc(memoryview(msg)) == crc(msg)
+
+@pytest.mark.parametrize('crc', [kmp.crc16, kmp.crc16_table, kmp.crc16_slice4, kmp.crc16_slice8])
+def test_crc_incremental(crc):
+    msg = bytes(range(100))
+    for i in (0, 1, 3, 4, 7, 8, 50, 100):
+        assert crc(msg[i:], crc(msg[:i])) == crc(msg)
+
+def test_crc_1021_matches_bitwise():
+    for msg in messages():
+        assert kmp.crc_1021(msg) == kmp.crc_1021_bitwise(msg), msg.hex()
+        c = kmp.crc16(msg)
+        assert kmp.crc_1021(msg + bytes((c >> 8, c & 0xff))) == 0
+
+#######################################################################
+# Framing
+#
+def test_encode_unstuff_round_trip():
+    for msg in messages():
+        frame = kmp.encode(kmp.START_REQUEST, msg)
+        assert frame[0] == kmp.START_REQUEST and frame[-1] == kmp.STOP
+        assert not any(b in kmp.ESCAPES for b in frame[1:-1] if b != kmp.ESCAPE)
+        (buf, bad_escapes) = kmp.unstuff(frame, 1, len(frame) - 1)
+        assert bytes(buf[:-2]) == msg
+        assert kmp.crc16(buf) == 0
+        assert bad_escapes == ()
+
+def test_encode_escapes():
+    frame = kmp.encode(kmp.START_REQUEST, bytes((0x3f, 0x06, 0x0d, 0x1b, 0x40, 0x80)))
+    assert frame[:12] == bytes((0x80, 0x3f, 0x1b, 0xf9, 0x1b, 0xf2, 0x1b, 0xe4, 0x1b, 0xbf, 0x1b, 0x7f))
+    assert frame[-1] == kmp.STOP
+
+def test_unstuff_bad_escape():
+    (buf, bad_escapes) = kmp.unstuff(bytes((0x01, 0x1b, 0xfe, 0x02)))
+    assert bytes(buf) == bytes((0x01, 0x01, 0x02))
+    assert bad_escapes == (0x01,)
+
+def test_unstuff_escape_at_end():
+    with pytest.raises(kmp.KmpError):
+        kmp.unstuff(bytes((0x01, 0x1b)))
+
+def test_get_register_request():
+    msg = kmp.get_register_request([0x3c, 0x50])
+    frame = kmp.decode(kmp.encode(kmp.START_REQUEST, msg), pfx=kmp.START_REQUEST)
+    assert frame.address == kmp.ADDRESS
+    assert bytes(frame.data) == bytes((0x10, 0x02, 0x00, 0x3c, 0x00, 0x50))
+
+#######################################################################
+# Decoding MC402 responses
+#
+def test_decode_type():
+    frame = kmp.decode_hex(TYPE)
+    assert frame.address == 0x3f
+    assert frame.cid == kmp.CID_GET_TYPE
+    assert frame.hex() == '0111010001'
+
+def test_decode_power():
+    frame = kmp.decode_hex(POWER)
+    assert frame.cid == kmp.CID_GET_REGISTER
+    assert list(kmp.read_registers_fixed(frame)) == [(80, 169, -1, 'kW')]
+    assert list(kmp.read_registers(frame)) == [(80, Decimal('16.9'), 'kW')]
+    assert kmp.register_ids(frame) == [80]
+
+def test_decode_power_energy():
+    frame = kmp.decode_hex(POWER_ENERGY)
+    assert list(kmp.read_registers(frame)) == [(80, Decimal('16.9'), 'kW'), (60, Decimal('75.838'), 'MWh')]
+
+def test_decode_escaped():
+    frame = kmp.decode_hex(EIGHT_REGISTERS)
+    assert frame.bad_escapes == ()
+    values = dict((reg, (x, u)) for (reg, x, u) in kmp.read_registers(frame))
+    assert values[87] == (Decimal('35.76'), 'C')     # 0x0DF8 was escaped
+    assert values == {
+        60: (Decimal('75.838'), 'MWh'),
+        68: (Decimal('1516.77'), 'm3'),
+        74: (729, 'l/h'),
+        80: (Decimal('16.9'), 'kW'),
+        86: (Decimal('78.47'), 'C'),
+        87: (Decimal('35.76'), 'C'),
+        89: (Decimal('42.71'), 'C'),
+        1002: (24000, 'hh:mm:ss'),
+    }
+
+def test_decode_bytes_like():
+    raw = bytes.fromhex(EIGHT_REGISTERS)
+    for b in (raw, bytearray(raw), b'\x06' + raw):
+        assert kmp.decode(b).hex() == kmp.decode_hex(EIGHT_REGISTERS).hex()
+
+def test_decode_bad_crc():
+    raw = bytearray.fromhex(POWER_ENERGY)
+    raw[-3] ^= 0x01
+    with pytest.raises(kmp.KmpCrcError) as e:
+        kmp.decode(raw)
+    assert bytes(e.value.raw) == bytes(raw[1:-1])
+
+def test_decode_corrupted_value():
+    raw = bytearray.fromhex(POWER)
+    raw[10] ^= 0x10
+    with pytest.raises(kmp.KmpCrcError):
+        kmp.decode(raw)
+
+@pytest.mark.parametrize('s', ['', '403F1000', '3F100050160441000000A924830D', '403F100D', 'zz'])
+def test_decode_invalid(s):
+    with pytest.raises(kmp.KmpError):
+        kmp.decode_hex(s)
+
+def test_truncated_register():
+    frame = kmp.decode_hex(POWER)
+    with pytest.raises(kmp.KmpError):
+        list(kmp.read_registers_fixed(frame.data[:-1]))
+
+#######################################################################
+# Reassembly of SerialReceived fragments
+#
+def test_reassemble_odd_nibble_across_chunks():
+    reassembler = kmp.FrameReassembler()
+    frames = []
+    for i in range(0, len(EIGHT_REGISTERS), 7):
+        frames += reassembler.feed_hex(EIGHT_REGISTERS[i:i + 7])
+    assert frames == [bytes.fromhex(EIGHT_REGISTERS)]
+    assert reassembler.pending() == 0 and reassembler.nibble == ''
+
+def test_reassemble_two_frames_in_one_chunk():
+    reassembler = kmp.FrameReassembler()
+    frames = reassembler.feed_hex('FF' + TYPE + POWER + '403F10')
+    assert frames == [bytes.fromhex(TYPE), bytes.fromhex(POWER)]
+    assert reassembler.pending() == 3
+    assert reassembler.feed_hex(POWER_ENERGY[6:]) == [bytes.fromhex(POWER_ENERGY)]
+
+def test_reassemble_drops_stale_partial_frame():
+    reassembler = kmp.FrameReassembler()
+    assert reassembler.feed_hex(POWER[:12]) == []
+    # The rest of the frame was lost, a new response starts
+    assert reassembler.feed_hex(POWER_ENERGY) == [bytes.fromhex(POWER_ENERGY)]
+    assert kmp.decode(reassembler.feed_hex(POWER)[0]).data[0] == 0x10
+
+def test_reassemble_max_size():
+    reassembler = kmp.FrameReassembler(max_size=16)
+    assert reassembler.feed_hex('403F' + '00' * 15) == []
+    assert reassembler.pending() == 0
+    assert reassembler.feed_hex('403F' + '00' * 13) == []
+    assert reassembler.pending() == 15
+    assert reassembler.feed_hex('0D' + POWER) == [bytes.fromhex('403F' + '00' * 13 + '0D'), bytes.fromhex(POWER)]
+
+def test_reassemble_invalid_hex_resets():
+    reassembler = kmp.FrameReassembler()
+    reassembler.feed_hex(POWER[:9])
+    with pytest.raises(kmp.KmpError):
+        reassembler.feed_hex('zz')
+    assert reassembler.pending() == 0 and reassembler.nibble == ''
@@ -0,0 +1,146 @@
+#           Tests of the meter polling in poller.py
+#
+import poller
+
+POWER = 0x50
+ENERGY = 0x3C
+CLOCK = 0x3EA
+
+SCHEDULE = {POWER: (10, 0), ENERGY: (300, 1), CLOCK: (3600, 2)}
+
+#######################################################################
+# PollScheduler
+#
+def test_all_registers_due_immediately():
+    scheduler = poller.PollScheduler()
+    scheduler.add_meter(1, SCHEDULE, 0)
+    assert scheduler.due_meters(0) == [1]
+    assert scheduler.due_count(1, 0) == 3
+    assert scheduler.take(1, 0, 2) == ([POWER, ENERGY], [])
+    assert scheduler.take(1, 0, 2) == ([CLOCK], [])
+    assert scheduler.deadline(1) == 10
+    assert scheduler.due_meters(9) == []
+
+def test_due_meters_earliest_first():
+    scheduler = poller.PollScheduler()
+    scheduler.add_meter(1, {POWER: (10, 0)}, 5)
+    scheduler.add_meter(2, {POWER: (10, 0)}, 0)
+    assert scheduler.due_meters(5) == [2, 1]
+    # Meters stay due until their registers are taken
+    assert scheduler.due_meters(5) == [2, 1]
+
+def test_due_meters_skips_stale_entries():
+    scheduler = poller.PollScheduler()
+    scheduler.add_meter(1, {POWER: (10, 0)}, 0)
+    for now in (0, 10, 20):
+        scheduler.take(1, now, 1)
+    # The heap still holds the entries of deadlines 0, 10 and 20
+    assert len(scheduler.heap) > 1
+    assert scheduler.due_meters(29) == []
+    assert scheduler.due_meters(30) == [1]
+    scheduler.remove_meter(1)
+    assert scheduler.due_meters(100) == []
+    assert 1 not in scheduler
+
+def test_set_interval_moves_deadline():
+    scheduler = poller.PollScheduler()
+    scheduler.add_meter(1, SCHEDULE, 0)
+    scheduler.take(1, 0, 3)
+    assert scheduler.deadline(1) == 10
+    # The power register is not the root of the meter heap after this
+    scheduler.set_interval(1, POWER, 1000, 5)
+    assert scheduler.deadline(1) == 300
+    assert scheduler.due_meters(299) == []
+    assert scheduler.take(1, 300, 3) == ([ENERGY], [])
+    # A shorter interval is due at once, not in the past
+    scheduler.set_interval(1, CLOCK, 1, 400)
+    assert scheduler.deadline(1) == 400
+    assert scheduler.take(1, 400, 3) == ([CLOCK], [])
+
+def test_take_counts_missed_periods():
+    scheduler = poller.PollScheduler()
+    scheduler.add_meter(1, SCHEDULE, 0)
+    scheduler.take(1, 0, 3)
+    (regs, missed) = scheduler.take(1, 35, 3)
+    assert regs == [POWER]
+    assert missed == [(POWER, 25)]
+    assert scheduler.meters[1].missed == {POWER: 2}
+    # The next poll stays on the grid of the interval
+    assert scheduler.deadline(1) == 40
+    assert scheduler.take(1, 40, 3) == ([POWER], [])
+
+def test_take_limit_keeps_the_rest_due():
+    scheduler = poller.PollScheduler()
+    scheduler.add_meter(1, SCHEDULE, 0)
+    assert scheduler.take(1, 0, 1) == ([POWER], [])
+    assert scheduler.due_count(1, 0) == 2
+    assert scheduler.due_meters(0) == [1]
+
+def test_poll_schedule_option():
+    schedule = poller.poll_schedule(SCHEDULE, {"80": 30, "1003": 60})
+    assert schedule[POWER] == (30.0, 0)
+    assert schedule[0x3EB] == (60.0, 3)
+    assert SCHEDULE[POWER] == (10, 0)
+
+#######################################################################
+# MeterLink
+#
+def test_link_retries_then_fails():
+    link = poller.MeterLink(timeout=2, retries=2)
+    t = link.begin(0x10, [POWER], b'', 0)
+    assert link.busy()
+    assert link.check(1.9) is None
+    assert link.check(2) == (poller.MeterLink.RETRY, t)
+    assert link.check(3.9) is None
+    assert link.check(4) == (poller.MeterLink.RETRY, t)
+    assert t.attempts == 3 and t.started == 0 and t.sent == 4
+    assert link.check(6) == (poller.MeterLink.FAILED, t)
+    assert not link.busy()
+    assert link.check(100) is None
+    assert (link.retried, link.failed) == (2, 1)
+
+def test_link_without_retries_fails_at_timeout():
+    link = poller.MeterLink(timeout=2, retries=0)
+    t = link.begin(0x10, [POWER], b'', 0)
+    assert link.check(2) == (poller.MeterLink.FAILED, t)
+
+def test_link_matches_subset_of_registers():
+    link = poller.MeterLink(timeout=2, retries=2)
+    t = link.begin(0x10, [POWER, ENERGY, CLOCK], b'', 0)
+    assert link.match(0x10, [ENERGY, POWER]) is t
+    assert not link.busy()
+
+def test_link_rejects_unrequested_register_and_other_command():
+    link = poller.MeterLink(timeout=2, retries=2)
+    t = link.begin(0x10, [POWER], b'', 0)
+    assert link.match(0x10, [POWER, ENERGY]) is None
+    assert link.match(0x01) is None
+    assert link.busy()
+    assert link.unmatched == 2
+    assert link.match(0x10, [POWER]) is t
+    assert link.match(0x10, [POWER]) is None
+    assert link.unmatched == 3
+
+#######################################################################
+# MeterPoller
+#
+def test_poller_request_and_complete():
+    meters = poller.MeterPoller(registers_per_request=2, timeout=2, retries=1)
+    meters.add_meter(1, SCHEDULE, 0)
+    assert meters.ready(0) == [1]
+    (t, missed, due) = meters.request(1, 0)
+    assert (t.regs, missed, due) == ((POWER, ENERGY), [], 3)
+    # One request at a time per meter
+    assert meters.ready(0) == []
+    assert meters.command(1, 0x02, 0) is None
+    assert meters.complete(1, t.cid, [POWER, ENERGY]) is t
+    assert meters.ready(0) == [1]
+    assert meters.request(1, 0)[0].regs == (CLOCK,)
+
+def test_poller_expire():
+    meters = poller.MeterPoller(timeout=2, retries=1)
+    meters.add_meter(1, SCHEDULE, 0)
+    t = meters.command(1, 0x02, 0)
+    assert meters.expire(2) == [(1, poller.MeterLink.RETRY, t)]
+    assert meters.expire(4) == [(1, poller.MeterLink.FAILED, t)]
+    assert meters.ready(4) == [1]
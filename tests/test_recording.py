@@ -0,0 +1,58 @@
+#           Tests of the MQTT capture in recording.py
+#
+import builtins
+
+import pytest
+
+import recording
+
+MESSAGE = {'Verb': 'PUBLISH', 'Topic': 'tele/sonoff/RESULT', 'Payload': b'{"SerialReceived":"40"}'}
+
+# Keeps the files opened by recording.py
+@pytest.fixture
+def opened(monkeypatch):
+    files = []
+    def tracking_open(*args, **kwargs):
+        f = builtins.open(*args, **kwargs)
+        files.append(f)
+        return f
+    monkeypatch.setattr(recording, 'open', tracking_open, raising=False)
+    return files
+
+def test_record_and_read_back(tmp_path):
+    path = str(tmp_path / 'capture.kmqr')
+    recorder = recording.Recorder(path)
+    recorder.record(1.5, recording.RECEIVED, MESSAGE)
+    recorder.close()
+    with recording.Recording(path) as rec:
+        [(t, direction, message)] = list(rec)
+    assert (t, direction) == (1.5, recording.RECEIVED)
+    assert message['Topic'] == MESSAGE['Topic']
+
+def test_record_cut_short_is_dropped(tmp_path):
+    path = str(tmp_path / 'capture.kmqr')
+    recorder = recording.Recorder(path)
+    recorder.record(1, recording.SENT, MESSAGE)
+    recorder.record(2, recording.SENT, MESSAGE)
+    recorder.close()
+    with open(path, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 3)
+    recorder = recording.Recorder(path)
+    recorder.record(3, recording.SENT, MESSAGE)
+    recorder.close()
+    with recording.Recording(path) as rec:
+        assert [t for t, direction, message in rec] == [1, 3]
+
+def test_recorder_closes_file_which_is_not_a_recording(tmp_path, opened):
+    path = tmp_path / 'capture.kmqr'
+    path.write_bytes(b'not a recording')
+    with pytest.raises(ValueError):
+        recording.Recorder(str(path))
+    assert opened and all(f.closed for f in opened)
+
+def test_recording_closes_file_which_is_not_a_recording(tmp_path, opened):
+    path = tmp_path / 'capture.kmqr'
+    path.write_bytes(b'KM')
+    with pytest.raises(ValueError):
+        recording.Recording(str(path))
+    assert opened and all(f.closed for f in opened)
@@ -0,0 +1,49 @@
+#           Tests of the consistent hash ring in daemon/ring.py
+#
+from daemon.ring import HashRing
+
+TOPICS = ['tasmota/meter_%03d' % i for i in range(1000)]
+
+def owners(ring):
+    return dict((topic, ring.node(topic)) for topic in TOPICS)
+
+def test_empty_ring():
+    ring = HashRing()
+    assert ring.node('tasmota/meter_000') is None
+    assert len(ring) == 0
+
+def test_assign_covers_all_keys():
+    ring = HashRing(['worker-0', 'worker-1', 'worker-2'])
+    assignment = ring.assign(TOPICS)
+    assert set(assignment) == {'worker-0', 'worker-1', 'worker-2'}
+    assert sum(len(topics) for topics in assignment.values()) == len(TOPICS)
+    # Roughly balanced with 100 points per node
+    assert min(len(topics) for topics in assignment.values()) > len(TOPICS) / 6
+
+def test_adding_node_only_moves_keys_to_it():
+    ring = HashRing(['worker-0', 'worker-1', 'worker-2'])
+    before = owners(ring)
+    ring.add('worker-3')
+    after = owners(ring)
+    moved = [topic for topic in TOPICS if before[topic] != after[topic]]
+    assert moved and all(after[topic] == 'worker-3' for topic in moved)
+    assert len(moved) < len(TOPICS) / 2
+
+def test_removing_node_only_moves_its_keys():
+    ring = HashRing(['worker-0', 'worker-1', 'worker-2', 'worker-3'])
+    before = owners(ring)
+    ring.remove('worker-1')
+    after = owners(ring)
+    assert 'worker-1' not in ring and len(ring) == 3
+    for topic in TOPICS:
+        if before[topic] != 'worker-1':
+            assert after[topic] == before[topic]
+        else:
+            assert after[topic] != 'worker-1'
+
+def test_remove_and_add_again_restores_assignment():
+    ring = HashRing(['worker-0', 'worker-1', 'worker-2'])
+    before = owners(ring)
+    ring.remove('worker-2')
+    ring.add('worker-2')
+    assert owners(ring) == before
@@ -0,0 +1,89 @@
+#           Tests of the incremental MQTT subscriptions in subscriptions.py
+#
+import pytest
+
+import subscriptions
+
+def device_topics(name):
+    return ['tasmota/%s/tele/RESULT' % name, 'tasmota/%s/stat/RESULT' % name, 'tasmota/%s/tele/LWT' % name]
+
+@pytest.mark.parametrize('pattern, topic, match', [
+    ('a/b', 'a/b', True),
+    ('a/+', 'a/b', True),
+    ('a/+', 'a/b/c', False),
+    ('+/+', 'a', False),
+    ('a/#', 'a/b/c', True),
+    ('a/#', 'a', True),
+    ('#', 'a/b', True),
+    ('a/+/c', 'a/b/d', False),
+    ('a/b/c', 'a/b', False),
+])
+def test_topic_matches(pattern, topic, match):
+    assert subscriptions.topic_matches(pattern, topic) == match
+
+#######################################################################
+# Coverage and collapsing
+#
+def test_remove_covered_by_hash():
+    topics = {'x/stat/#', 'x/stat/RESULT', 'x/stat/a/b', 'x/tele/RESULT'}
+    assert subscriptions.remove_covered(topics) == {'x/stat/#', 'x/tele/RESULT'}
+    # A '#' topic is covered by a shorter one
+    assert subscriptions.remove_covered({'x/#', 'x/stat/#'}) == {'x/#'}
+
+def test_remove_covered_by_plus():
+    topics = {'tasmota/+/tele/RESULT', 'tasmota/a/tele/RESULT', 'tasmota/a/tele/LWT', 'tasmota/+/+/RESULT'}
+    assert subscriptions.remove_covered(topics) == {'tasmota/+/+/RESULT', 'tasmota/a/tele/LWT'}
+
+def test_remove_covered_without_wildcards():
+    topics = set(device_topics('a'))
+    assert subscriptions.remove_covered(topics) == topics
+
+def test_collapse():
+    topics = set(device_topics('a') + device_topics('b') + device_topics('c'))
+    assert subscriptions.collapse(topics, 3) == {'tasmota/+/tele/RESULT', 'tasmota/+/stat/RESULT', 'tasmota/+/tele/LWT'}
+    assert subscriptions.collapse(topics, 4) == topics
+    assert subscriptions.collapse(topics, 0) == topics
+
+def test_collapse_largest_group_first():
+    topics = {'a/1/x', 'a/2/x', 'a/3/x', 'a/1/y'}
+    assert subscriptions.collapse(topics, 2) == {'a/+/x', 'a/1/y'}
+
+#######################################################################
+# SubscriptionManager
+#
+def test_sync_is_incremental():
+    manager = subscriptions.SubscriptionManager()
+    manager.set('config', ['tasmota/a/tele/RESULT'])
+    manager.set(1, device_topics('b'))
+    (subscribe, unsubscribe) = manager.sync()
+    assert subscribe == sorted(['tasmota/a/tele/RESULT'] + device_topics('b'))
+    assert unsubscribe == []
+    assert manager.sync() == ([], [])
+    # Setting the same topics again does not mark the subscriptions dirty
+    manager.set(1, device_topics('b'))
+    assert not manager.dirty
+    manager.set(2, device_topics('c'))
+    manager.discard(1)
+    assert manager.sync() == (sorted(device_topics('c')), sorted(device_topics('b')))
+
+def test_sync_collapses_into_wildcard_and_back():
+    manager = subscriptions.SubscriptionManager(wildcards=3)
+    manager.set(1, device_topics('a'))
+    manager.set(2, device_topics('b'))
+    manager.sync()
+    manager.set(3, device_topics('c'))
+    (subscribe, unsubscribe) = manager.sync()
+    assert subscribe == ['tasmota/+/stat/RESULT', 'tasmota/+/tele/LWT', 'tasmota/+/tele/RESULT']
+    assert unsubscribe == sorted(device_topics('a') + device_topics('b'))
+    manager.discard(3)
+    (subscribe, unsubscribe) = manager.sync()
+    assert subscribe == sorted(device_topics('a') + device_topics('b'))
+    assert unsubscribe == ['tasmota/+/stat/RESULT', 'tasmota/+/tele/LWT', 'tasmota/+/tele/RESULT']
+
+def test_reset_resubscribes_after_reconnect():
+    manager = subscriptions.SubscriptionManager()
+    manager.set(1, device_topics('a'))
+    manager.sync()
+    manager.reset()
+    assert manager.sync() == (sorted(device_topics('a')), [])
+    assert manager.sync() == ([], [])
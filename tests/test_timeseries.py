@@ -0,0 +1,49 @@
+#           Tests of the register time series in timeseries.py
+#
+from decimal import Decimal
+
+import kmp
+import timeseries
+
+# Counter readings with the largest 32 bit mantissa, as the plugin appends them
+READINGS = [(4294967295, -3), (4294967294, -3), (123456789, -3), (1, 0)]
+
+def series(readings=READINGS, capacity=10):
+    ts = timeseries.TimeSeries(capacity)
+    for t, (m, e) in enumerate(readings):
+        ts.append(t, float(kmp.fixed_value(m, e)))
+    return ts
+
+def test_readings_survive_the_float():
+    for m, e in READINGS:
+        assert timeseries.to_fixed(float(kmp.fixed_value(m, e)), e) == (m, e)
+
+def test_min_max_last_are_exact():
+    ts = series()
+    assert timeseries.to_fixed(ts.aggregate(0, 3, 'max'), -3) == (4294967295, -3)
+    assert timeseries.to_fixed(ts.aggregate(0, 3, 'min'), -3) == (123456789, -3)
+    assert timeseries.to_fixed(ts.aggregate(0, 2, 'last'), -3) == (4294967294, -3)
+
+def test_average_is_exact_decimal():
+    ts = series([(4294967295, -3), (4294967294, -3)])
+    x = ts.aggregate(0, 2, 'avg')
+    assert x == Decimal('4294967.2945')
+    assert timeseries.to_fixed(x, -5) == (429496729450, -5)
+
+def test_aggregate_of_empty_period():
+    ts = series()
+    assert ts.aggregate(10, 20, 'avg') is None
+    assert ts.aggregate(10, 20, 'last') is None
+    assert ts.summary(10, 20) == (0, None, None, None)
+
+def test_ring_evicts_into_spill(tmp_path):
+    spill = timeseries.MappedRingBuffer(str(tmp_path / 'spill.kts'), 10)
+    ts = timeseries.TimeSeries(2, spill)
+    for t in range(5):
+        ts.append(t, float(t))
+    assert len(ts) == 5
+    assert [t for t, x in ts.samples()] == [0, 1, 2, 3, 4]
+    spill.close()
+    spill = timeseries.MappedRingBuffer(str(tmp_path / 'spill.kts'), 10)
+    assert [t for t, x in spill.samples()] == [0, 1, 2]
+    spill.close()
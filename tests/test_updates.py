@@ -0,0 +1,97 @@
+#           Tests of the deadbands and queued device updates of plugin.py
+#
+#           The plugin is loaded with the simulated Domoticz of simulator/,
+#           device updates are queued and flushed by calling it directly.
+#
+from decimal import Decimal
+
+import pytest
+
+from simulator import domoticz
+from simulator.harness import Harness
+
+UNIT = 50
+POWER = 0x50
+ENERGY = 0x3C
+
+@pytest.fixture
+def plugin():
+    harness = Harness(meters=0, options={'updateInterval': 10, 'deadbands': {'80': {'abs': 100, 'rel': 0.1}}})
+    harness.start()
+    domoticz.Device(Name='Meter', Unit=UNIT, TypeName='kWh').Create()
+    yield harness.plugin._plugin
+    harness.stop()
+
+#######################################################################
+# Deadbands
+#
+def test_first_value_is_outside_deadband(plugin):
+    assert plugin.outsideDeadband(UNIT, POWER, Decimal(1000))
+
+def test_deadband_absolute_and_relative(plugin):
+    plugin.registerValues[(UNIT, POWER)] = Decimal(1000)
+    # The larger of 100 and 10% of 1000
+    assert not plugin.outsideDeadband(UNIT, POWER, Decimal('1099.9'))
+    assert not plugin.outsideDeadband(UNIT, POWER, Decimal('900.1'))
+    assert plugin.outsideDeadband(UNIT, POWER, Decimal(1100))
+    assert plugin.outsideDeadband(UNIT, POWER, Decimal(900))
+    plugin.registerValues[(UNIT, POWER)] = Decimal(5000)
+    assert not plugin.outsideDeadband(UNIT, POWER, Decimal(5400))
+    assert plugin.outsideDeadband(UNIT, POWER, Decimal(5500))
+
+def test_register_without_deadband(plugin):
+    plugin.registerValues[(UNIT, ENERGY)] = Decimal('123.456')
+    assert not plugin.outsideDeadband(UNIT, ENERGY, Decimal('123.456'))
+    assert plugin.outsideDeadband(UNIT, ENERGY, Decimal('123.457'))
+
+#######################################################################
+# Queued updates
+#
+def test_updates_are_merged(plugin):
+    device = domoticz.Devices[UNIT]
+    plugin.queueUpdate(UNIT, TimedOut=1)
+    plugin.queueUpdate(UNIT, True, nValue=0, sValue='1500;20')
+    plugin.queueUpdate(UNIT, True, nValue=0, sValue='1600;21')
+    assert plugin.deviceValue(device, UNIT, 'sValue') == '1600;21'
+    assert device.updates == 0
+    plugin.flushUpdates(100)
+    assert (device.updates, device.TimedOut, device.sValue) == (1, 1, '1600;21')
+    assert plugin.pendingUpdates == {}
+
+def test_update_waits_for_update_interval(plugin):
+    device = domoticz.Devices[UNIT]
+    plugin.queueUpdate(UNIT, True, nValue=0, sValue='1500;20')
+    plugin.flushUpdates(100)
+    plugin.queueUpdate(UNIT, True, nValue=0, sValue='1600;21')
+    plugin.flushUpdates(109)
+    assert (device.updates, device.sValue) == (1, '1500;20')
+    assert plugin.deviceValue(device, UNIT, 'sValue') == '1600;21'
+    plugin.flushUpdates(110)
+    assert (device.updates, device.sValue) == (2, '1600;21')
+
+def test_forced_update(plugin):
+    device = domoticz.Devices[UNIT]
+    plugin.queueUpdate(UNIT, True, nValue=0, sValue='1500;20')
+    plugin.flushUpdates(100)
+    plugin.queueUpdate(UNIT, True, nValue=0, sValue='1600;21')
+    plugin.flushUpdates(101, True)
+    assert (device.updates, device.sValue) == (2, '1600;21')
+
+def test_unchanged_values_are_not_written(plugin):
+    device = domoticz.Devices[UNIT]
+    plugin.queueUpdate(UNIT, True, nValue=device.nValue, sValue=device.sValue)
+    plugin.queueUpdate(UNIT, TimedOut=device.TimedOut)
+    plugin.flushUpdates(100)
+    assert device.updates == 0
+
+def test_suppress_triggers(plugin):
+    device = domoticz.Devices[UNIT]
+    # Status attributes alone do not trigger events
+    plugin.queueUpdate(UNIT, TimedOut=1)
+    plugin.flushUpdates(100)
+    assert (device.updates, device.triggers) == (1, 0)
+    # Values do, also when merged with status attributes
+    plugin.queueUpdate(UNIT, SignalLevel=7)
+    plugin.queueUpdate(UNIT, True, nValue=0, sValue='1500;20')
+    plugin.flushUpdates(110)
+    assert (device.updates, device.triggers) == (2, 1)
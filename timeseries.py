@@ -0,0 +1,197 @@
+#           Fixed size time series of register readings
+#
+#           This module does not depend on Domoticz. A RingBuffer keeps the
+#           last capacity (time, value) samples in two array('d'), so memory
+#           per register is fixed at 16 bytes per sample. Optionally, samples
+#           which fall out of the ring spill into a larger ring in a memory
+#           mapped file, which also survives restarts:
+#
+#           header (16 bytes): b'KTS1' | capacity | head | count (uint32, little endian)
+#           times (capacity doubles) | values (capacity doubles)
+#
+#           TimeSeries.aggregate downsamples the samples of a period, e.g. the
+#           Domoticz update interval, to their min, max, average or last value.
+#           Samples must be appended in time order, periods are looked up by
+#           bisection.
+#
+#           A reading m * 10**e with up to 15 significant digits, which covers
+#           the 32 bit mantissa of KMP registers, survives the double exactly:
+#           its shortest repr is the reading, to_fixed turns it back into
+#           (m, e). So min, max and last are exact, and the average is summed
+#           in Decimal over those exact readings; only its division is rounded.
+#
+from array import array
+from decimal import Decimal
+import mmap
+import os
+import struct
+
+HEADER = struct.Struct('<4sIII')
+MAGIC = b'KTS1'
+
+AGGREGATES = ('last', 'avg', 'min', 'max')
+
+# Returns the fixed point (m, e) of a float or Decimal x with exponent e, the
+# inverse of kmp.fixed_value for the readings kept as floats here
+def to_fixed(x, e):
+    if not isinstance(x, Decimal):
+        x = Decimal(repr(x))
+    return (int(x.scaleb(-e).to_integral_value()), e)
+
+# Exact average of readings kept as floats, as a Decimal
+def average(values):
+    return sum(Decimal(repr(x)) for x in values) / len(values)
+
+class RingBuffer:
+    __slots__ = ('capacity', 'times', 'values', 'head', 'count')
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.head = 0           # Index of the next sample
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    # Add a sample, returns the (time, value) which was overwritten or None
+    def append(self, t, x):
+        i = self.head
+        evicted = (self.times[i], self.values[i]) if self.count == self.capacity else None
+        self.times[i] = t
+        self.values[i] = x
+        self.head = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        self._stored()
+        return evicted
+
+    def _stored(self):
+        pass
+
+    # Logical index (0 is the oldest sample) of the first sample with a
+    # time >= t. Samples are appended in time order, so this is a bisection.
+    def _find(self, t):
+        times = self.times
+        (capacity, first) = (self.capacity, self.head - self.count)
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[(first + mid) % capacity] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Yields (time, value) of the samples with start <= time < end, oldest first
+    def samples(self, start=float('-inf'), end=float('inf')):
+        (times, values, capacity) = (self.times, self.values, self.capacity)
+        first = self.head - self.count
+        for n in range(self._find(start), self.count):
+            i = (first + n) % capacity
+            t = times[i]
+            if t >= end:
+                break
+            yield (t, values[i])
+
+    def first(self):
+        if not self.count:
+            return None
+        i = (self.head - self.count) % self.capacity
+        return (self.times[i], self.values[i])
+
+    def last(self):
+        if not self.count:
+            return None
+        i = (self.head - 1) % self.capacity
+        return (self.times[i], self.values[i])
+
+# A ring buffer in a memory mapped file, the samples of an existing file
+# with the same capacity are kept
+class MappedRingBuffer(RingBuffer):
+    __slots__ = ('path', 'file', 'map')
+
+    def __init__(self, path, capacity):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        size = HEADER.size + 16 * capacity
+        self.path = path
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        existing = os.fstat(self.file.fileno()).st_size == size
+        if not existing:
+            self.file.truncate(0)
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        (magic, stored_capacity, head, count) = HEADER.unpack_from(self.map, 0)
+        data = memoryview(self.map)[HEADER.size:].cast('d')
+        self.capacity = capacity
+        self.times = data[:capacity]
+        self.values = data[capacity:]
+        if existing and magic == MAGIC and stored_capacity == capacity and head < capacity and count <= capacity:
+            (self.head, self.count) = (head, count)
+        else:
+            (self.head, self.count) = (0, 0)
+            self._stored()
+
+    def _stored(self):
+        HEADER.pack_into(self.map, 0, MAGIC, self.capacity, self.head, self.count)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.times.release()
+        self.values.release()
+        self.map.close()
+        self.file.close()
+
+# Samples of one register: recent samples in memory, older ones optionally
+# spilled to a MappedRingBuffer
+class TimeSeries:
+    __slots__ = ('ring', 'spill')
+
+    def __init__(self, capacity, spill=None):
+        self.ring = RingBuffer(capacity)
+        self.spill = spill
+
+    def __len__(self):
+        return len(self.ring) + (len(self.spill) if self.spill is not None else 0)
+
+    def append(self, t, x):
+        evicted = self.ring.append(t, x)
+        if evicted is not None and self.spill is not None:
+            self.spill.append(*evicted)
+
+    def samples(self, start=float('-inf'), end=float('inf')):
+        oldest = self.ring.first()
+        if self.spill is not None and (oldest is None or oldest[0] > start):
+            yield from self.spill.samples(start, end)
+        yield from self.ring.samples(start, end)
+
+    # Downsample the samples with start <= time < end to a single value,
+    # how is one of AGGREGATES. Returns None if there are no samples, the
+    # average is a Decimal, see average.
+    def aggregate(self, start, end=float('inf'), how='avg'):
+        if how == 'last':
+            last = None
+            for last in self.samples(start, end):
+                pass
+            return last[1] if last is not None else None
+        values = [x for t, x in self.samples(start, end)]
+        if not values:
+            return None
+        if how == 'min':
+            return min(values)
+        if how == 'max':
+            return max(values)
+        return average(values)
+
+    # Returns (count, min, max, avg) of the samples with start <= time < end
+    def summary(self, start, end=float('inf')):
+        values = [x for t, x in self.samples(start, end)]
+        if not values:
+            return (0, None, None, None)
+        return (len(values), min(values), max(values), average(values))